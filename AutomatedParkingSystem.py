@@ -1,45 +1,39 @@
 from CameraManager import CameraManager
+from PlateReadCache import PlateReadCache
 from TollBarManager import TollBarManager, BarrierState
+from GateController import GateController, GateType, SensorMode
 from DataBaseManager import *
-
-max_capacity = 100
+from OccupancyIndex import getSharedOccupancyIndex
+from StatisticsRollup import getSharedStatisticsRollup
+from ParkingLotConfig import max_capacity
+from MetricsManager import metrics, getMetricsDumpPath
 
 class AutomatedParkingSystem:
-    def __init__(self) -> None:
-        self.cameraHandler = CameraManager(['pl', 'en'])
+    def __init__(self, parkingDb=None) -> None:
+        self.cameraHandler = CameraManager(['pl', 'en'], plateReadCache=PlateReadCache())
         self.barrierHandler = TollBarManager()
-        self.parkingDb = ParkingDB()
+        self.parkingDb = parkingDb if parkingDb is not None else getSharedParkingDB()
+        self.statisticsRollup = getSharedStatisticsRollup(self.parkingDb) # created first, so it sees the last journaled events at exit
+        self.occupancyIndex = getSharedOccupancyIndex(self.parkingDb) # gate decisions are answered from memory
 
-    def runEntranceGate(self):
-        vehiclePlateNumber = None
-        while True:
-            if self.barrierHandler.barrier.state == BarrierState.Closed and self.barrierHandler.isVehicleBeforeTollBar():
-                carPhoto = self.cameraHandler.takePhoto()
-                if carPhoto is None:
-                    continue
-                vehiclePlateNumber = self.cameraHandler.getVehiclePlateNumber(carPhoto)
-                self.barrierHandler.openBarrier()
-            if self.barrierHandler.barrier.state == BarrierState.Open:
-                self.barrierHandler.closeBarrier()
-                if self.barrierHandler.isVehicleBehindTollBar():
-                    self.parkingDb.addCarEntryRecord(vehiclePlateNumber)
-            self.barrierHandler.updateSensors()
+    def createGateController(self, gateType, sensorMode=SensorMode.Polling, pollRate=20):
+        return GateController(gateType, self.cameraHandler, self.barrierHandler, self.occupancyIndex, sensorMode, pollRate)
+
+    def runEntranceGate(self, sensorMode=SensorMode.Polling, pollRate=20):
+        self.cameraHandler.warmUpOcr() # load OCR models before the first car arrives
+        self.runGate(GateType.Entrance, sensorMode, pollRate)
     
-    def runExitGate(self):
-        vehiclePlateNumber = None
-        while True:
-            if self.barrierHandler.barrier.state == BarrierState.Closed and self.barrierHandler.isVehicleBeforeTollBar():
-                carPhoto = self.cameraHandler.takePhoto()
-                if carPhoto is None:
-                    continue
-                vehiclePlateNumber = self.cameraHandler.getVehiclePlateNumber(carPhoto)
-                if self.parkingDb.wasFeePaid(vehiclePlateNumber):
-                    self.barrierHandler.openBarrier()
-            if self.barrierHandler.barrier.state == BarrierState.Open:
-                self.barrierHandler.closeBarrier()
-                if self.barrierHandler.isVehicleBehindTollBar():
-                    self.parkingDb.releaseCarFromDb(vehiclePlateNumber)
-            self.barrierHandler.updateSensors()
+    def runExitGate(self, sensorMode=SensorMode.Polling, pollRate=20):
+        self.cameraHandler.warmUpOcr()
+        self.runGate(GateType.Exit, sensorMode, pollRate)
+
+    def runGate(self, gateType, sensorMode, pollRate):
+        # a gate process has no web endpoint, its metrics go to metrics_<gate>_gate.prom
+        metrics.startDumping(getMetricsDumpPath(f"{gateType.name.lower()}_gate"))
+        try:
+            self.createGateController(gateType, sensorMode, pollRate).run()
+        finally:
+            metrics.stopDumping()
     
     def executeEntranceGateLogicOnceWithDummyCar(self, dummyVehiclePlateNumber=None):
         executeOnce = True
@@ -1,75 +1,398 @@
 import cv2
-from matplotlib import pyplot as plt
 import numpy as np
 import imutils
-import easyocr
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from OcrManager import ocrModelCache
+from OcrWorkerPool import OcrPriority, OcrUnavailable
+from CaptureManager import CaptureSession, VideoCaptureSource
+from MetricsManager import metrics
+
+take_photo_seconds = metrics.histogram("camera_take_photo_seconds", "Time to get the latest camera frame")
+photo_failures = metrics.counter("camera_photo_failures_total", "takePhoto calls that got no frame")
+plate_read_stage_seconds = metrics.histogram("plate_read_stage_seconds", "Time of each stage of reading a plate number", ("stage",))
+plate_reads = metrics.counter("plate_reads_total", "Plate reads by result", ("result",))
+ocr_fallbacks = metrics.counter("ocr_fallbacks_total", "Plate reads the OCR pool could not serve, by fallback", ("fallback",))
+plate_candidates_read = metrics.histogram("plate_candidates_read", "Plate candidates read by OCR per photo", buckets=(1, 2, 3, 4, 5))
+
+pl_plate_pattern = re.compile(r"[A-Z]{2,3}(?=[A-Z]{0,4}[0-9])[0-9A-Z]{4,5}") # district code and 4-5 characters, e.g. PO 156VN, WY 8686W
+eu_plate_pattern = re.compile(r"(?=.*[A-Z])(?=.*[0-9])[A-Z0-9]{4,10}") # other European plates: letters and digits
+
+def plateFormatScore(plateNumber):
+    # 1 for text in the Polish plate format, less for other European plates and least for text that is no plate
+    compactPlateNumber = re.sub(r"[^A-Z0-9]", "", plateNumber.upper())
+    if pl_plate_pattern.fullmatch(compactPlateNumber):
+        return 1.0
+    if eu_plate_pattern.fullmatch(compactPlateNumber):
+        return 0.8
+    return 0.3
+
+def boundingBoxIoU(first, second):
+    x1, y1, w1, h1 = first
+    x2, y2, w2, h2 = second
+    intersectionWidth = max(0, min(x1 + w1, x2 + w2) - max(x1, x2))
+    intersectionHeight = max(0, min(y1 + h1, y2 + h2) - max(y1, y2))
+    intersection = intersectionWidth * intersectionHeight
+    return intersection / (w1 * h1 + w2 * h2 - intersection)
+
+class LocalizationMode(Enum):
+    Full = 0 # detection on the whole full-resolution frame
+    Fast = 1 # detection on a downscaled region of interest, full frame as fallback
+
+class OcrFallback(Enum):
+    Local = 0 # the OCR pool is busy or down: read in this process with the cached model
+    Manual = 1 # no read, the plate stays unknown and the gate is left to the attendant
+
+
+class PlateRead:
+    def __init__(self, plateNumber, confidence, candidate=None, ocrRuns=0) -> None:
+        self.plateNumber = plateNumber
+        self.confidence = confidence # 0-1: OCR confidence weighted by the plate format and shape, None for an earlier read without one
+        self.candidate = candidate # index of the plate candidate it was read from
+        self.ocrRuns = ocrRuns # candidates read by OCR, 0 for a cached read
+
+    def __repr__(self):
+        return "<PlateRead(plateNumber={0}, confidence={1}, candidate={2}, ocrRuns={3})>".format(
+            self.plateNumber, self.confidence, self.candidate, self.ocrRuns)
 
 class CameraManager:
-    def __init__(self, ocrLanguages) -> None:
+    def __init__(self, ocrLanguages, ocrCache=None, frameSource=None, localizationMode=LocalizationMode.Full, plateReadCache=None,
+                 ocrPool=None) -> None:
         self.ocrLanguages = ocrLanguages # https://www.jaided.ai/easyocr/
+        self.ocrCache = ocrCache if ocrCache is not None else ocrModelCache
+        self.ocrPool = ocrPool # optional OcrWorkerPool, OCR then runs in its worker processes instead of this one
+        self.ocrPriority = OcrPriority.EntranceGate
+        self.ocrTimeout = 2.0 # time in sec a pooled read may take before the fallback is used
+        self.ocrFallback = OcrFallback.Local
+        self.plateReadCache = plateReadCache # optional per-gate PlateReadCache of recent reads
+        self.frameSource = frameSource if frameSource is not None else VideoCaptureSource(cameraPort=0)
+        self.captureSession = None
+        self.photoTimeout = 1.0 # time in sec to wait for the first frame
+        self.localizationMode = localizationMode
+        self.localizationScale = 0.75 # downscale factor for the fast localization path
+        self.localizationMinWidth = 640 # fast path never downscales the search region below this width
+        self.plateSearchRoi = (0.0, 0.0, 1.0, 1.0) # x, y, width, height as fractions of the frame where plates appear
+        self.plateAspectRatioRange = (1.5, 8.0) # accepted width / height of a plate found by the fast path
+        self.rectifyPlate = False # perspective-correct the plate before OCR instead of cropping its bounding box
+        self.plateCandidates = 3 # plate quadrilaterals kept per photo, the next one is read only while the confidence is low
+        self.minPlateConfidence = 0.5 # reads above it are taken without looking at the other candidates
+
+    def warmUpOcr(self):
+        # with a pool the model is loaded by the workers only, the local one is loaded on the first fallback
+        if self.ocrPool is not None:
+            self.ocrPool.start()
+        else:
+            self.ocrCache.warmUp(self.ocrLanguages)
     
+    def startCapture(self):
+        if self.captureSession is None:
+            self.captureSession = CaptureSession(self.frameSource)
+        self.captureSession.start()
+
+    def closeCapture(self):
+        if self.captureSession is not None:
+            self.captureSession.close()
+            self.captureSession = None
+
     def takePhoto(self):
-        cameraPort = 0
-        camera = cv2.VideoCapture(cameraPort)
-        result, image = camera.read()
-        if result:
+        with take_photo_seconds.time():
+            self.startCapture()
+            image = self.captureSession.getLatestFrame(timeout=self.photoTimeout)
+        if image is not None:
             return image
         else:
+            photo_failures.inc()
             print("No image detected")
             return None
 
     def getVehiclePlateNumber(self, imageBGR):
-        imageGray = cv2.cvtColor(imageBGR, cv2.COLOR_BGR2GRAY)
-        imageGrayFiltered = self.filterNoises(imageGray)
-        plateMask = self.findPlateMask(imageGrayFiltered)
-        if plateMask is None:
-            print("failed to read plate number")
-            return None
-        plateImage = self.cropPlate(imageGray, plateMask)
-        plateNumber = self.readPlateNumber(plateImage)
-        return plateNumber
+        return self.getVehiclePlateNumberWithConfidence(imageBGR).plateNumber
+
+    def getVehiclePlateNumberWithConfidence(self, imageBGR):
+        # Reads the plate candidates best guess first and stops at the first read with minPlateConfidence, so a
+        # clear plate costs one OCR run and a wrong quadrilateral (grille, window, sticker) does not cost a second photo.
+        # Returns the most confident PlateRead, plateNumber None when no plate was found.
+        with plate_read_stage_seconds.time("total"):
+            imageGray = cv2.cvtColor(imageBGR, cv2.COLOR_BGR2GRAY)
+            bestRead = PlateRead(None, 0.0)
+            firstPlateImage = None
+            ocrRuns = 0
+            for candidate, plateCornersCoordinates in enumerate(self.iterPlateCandidates(imageGray)):
+                plateImage = self.cropPlateCandidate(imageGray, plateCornersCoordinates)
+                if firstPlateImage is None:
+                    firstPlateImage = plateImage
+                    if self.plateReadCache is not None:
+                        plateNumber, confidence = self.plateReadCache.lookupWithConfidence(plateImage)
+                        if plateNumber is not None:
+                            plate_reads.inc("cached")
+                            return PlateRead(plateNumber, confidence, candidate)
+                with plate_read_stage_seconds.time("ocr"):
+                    ocrResult = self._readText(plateImage)
+                ocrRuns += 1
+                plateNumber, confidence = self.scorePlateRead(ocrResult, plateCornersCoordinates)
+                if plateNumber is not None and (bestRead.plateNumber is None or confidence > bestRead.confidence):
+                    bestRead = PlateRead(plateNumber, confidence, candidate)
+                if confidence >= self.minPlateConfidence:
+                    break
+            bestRead.ocrRuns = ocrRuns
+            if firstPlateImage is None:
+                plate_reads.inc("no_plate")
+                print("failed to read plate number")
+                return bestRead
+            plate_candidates_read.observe(ocrRuns)
+            plate_reads.inc("read" if bestRead.confidence >= self.minPlateConfidence else "low_confidence")
+            if self.plateReadCache is not None and bestRead.confidence >= self.minPlateConfidence:
+                # keyed by the first candidate, the one the next photo of the same car looks up
+                self.plateReadCache.store(firstPlateImage, bestRead.plateNumber, bestRead.confidence)
+            return bestRead
+
+    def getVehiclePlateNumbers(self, images, workers=4, ocrBatchSize=8, priority=OcrPriority.Archive):
+        # Localization (filter, Canny, contours, crop) runs on a thread pool - OpenCV releases the GIL -
+        # while plate crops are read by OCR in batches, so both stages overlap. Results keep input order.
+        # With an OCR pool the batch is read with the archive priority, behind every gate.
+        plateNumbers = []
+        plateImagesBatch = []
+        pendingLocalizations = deque()
+        maxPending = workers * 2 # bounds memory when images is a long generator of archived snapshots
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for image in images:
+                pendingLocalizations.append(executor.submit(self.locatePlate, image))
+                if len(pendingLocalizations) >= maxPending:
+                    plateImagesBatch.append(pendingLocalizations.popleft().result())
+                if len(plateImagesBatch) >= ocrBatchSize:
+                    plateNumbers.extend(self.readPlateNumbers(plateImagesBatch, priority))
+                    plateImagesBatch = []
+            while pendingLocalizations:
+                plateImagesBatch.append(pendingLocalizations.popleft().result())
+        for start in range(0, len(plateImagesBatch), ocrBatchSize):
+            plateNumbers.extend(self.readPlateNumbers(plateImagesBatch[start : start+ocrBatchSize], priority))
+        return plateNumbers
+
+    def locatePlate(self, imageBGR):
+        with plate_read_stage_seconds.time("localization"):
+            imageGray = cv2.cvtColor(imageBGR, cv2.COLOR_BGR2GRAY)
+            plateCornersCoordinates = self.findPlateQuadrilateral(imageGray)
+            if plateCornersCoordinates is None:
+                return None
+            if self.rectifyPlate:
+                return self.rectifyPlateImage(imageGray, plateCornersCoordinates)
+            return self.cropPlateByCorners(imageGray, plateCornersCoordinates)
+
+    def iterPlateCandidates(self, imageGray):
+        # plate quadrilaterals best guess first; generated lazily, the full frame is searched only when the read of the
+        # fast path candidate was not good enough
+        yieldedBoxes = []
+        if self.localizationMode == LocalizationMode.Fast:
+            plateCornersCoordinates = self.findPlateCornersFast(imageGray)
+            if plateCornersCoordinates is not None:
+                yieldedBoxes.append(cv2.boundingRect(plateCornersCoordinates))
+                yield plateCornersCoordinates
+        imageEdges = self.performCannyEdgeDetection(self.filterNoises(imageGray))
+        for plateCornersCoordinates in self._findPlateCandidates(self._findContours(imageEdges)):
+            if not any(boundingBoxIoU(cv2.boundingRect(plateCornersCoordinates), box) > 0.8 for box in yieldedBoxes):
+                yield plateCornersCoordinates
+
+    def cropPlateCandidate(self, imageGray, plateCornersCoordinates):
+        if self.rectifyPlate:
+            return self.rectifyPlateImage(imageGray, plateCornersCoordinates)
+        return self.cropPlateByCorners(imageGray, plateCornersCoordinates)
+
+    def _isPlateShaped(self, plateBoundingBox):
+        _, _, plateWidth, plateHeight = plateBoundingBox
+        minAspectRatio, maxAspectRatio = self.plateAspectRatioRange
+        return minAspectRatio <= plateWidth / max(plateHeight, 1) <= maxAspectRatio
+
+    def scorePlateRead(self, ocrResult, plateCornersCoordinates):
+        # (plate number, confidence) of one OCR result. Every text box is scored alone and every run of neighbouring
+        # boxes joined left to right, for plates read in pieces ("PL", "PO", "156VN"); the first best text wins, as
+        # ocrResult[0] did before.
+        if not ocrResult:
+            return None, 0.0
+        shapeScore = 1.0 if self._isPlateShaped(cv2.boundingRect(plateCornersCoordinates)) else 0.5
+        texts = [(text, ocrConfidence) for _, text, ocrConfidence in ocrResult]
+        textBoxes = sorted(ocrResult, key=lambda textBox: min(x for x, _ in textBox[0]))[:5]
+        for start in range(len(textBoxes)):
+            for end in range(start + 2, len(textBoxes) + 1):
+                texts.append((" ".join(text for _, text, _ in textBoxes[start:end]),
+                              min(ocrConfidence for _, _, ocrConfidence in textBoxes[start:end])))
+        scores = [ocrConfidence * plateFormatScore(text) * shapeScore for text, ocrConfidence in texts]
+        best = scores.index(max(scores))
+        return texts[best][0], scores[best]
+
+    def findPlateQuadrilateral(self, imageGray):
+        plateCornersCoordinates = None
+        if self.localizationMode == LocalizationMode.Fast:
+            plateCornersCoordinates = self.findPlateCornersFast(imageGray)
+        if plateCornersCoordinates is None:
+            # full-frame path, also the fallback when the fast path misses
+            imageGrayFiltered = self.filterNoises(imageGray)
+            plateCornersCoordinates = self.findPlateCorners(imageGrayFiltered)
+        return plateCornersCoordinates
 
+    def _getRoiInPixels(self, imageShape):
+        height, width = imageShape[:2]
+        roiX, roiY, roiWidth, roiHeight = self.plateSearchRoi
+        x1, y1 = int(roiX * width), int(roiY * height)
+        x2, y2 = min(width, int((roiX + roiWidth) * width)), min(height, int((roiY + roiHeight) * height))
+        return x1, y1, x2, y2
+
+    def findPlateCornersFast(self, imageGray):
+        # searches a downscaled copy of the ROI and maps found corners back to full-resolution coordinates
+        x1, y1, x2, y2 = self._getRoiInPixels(imageGray.shape)
+        roi = imageGray[y1:y2, x1:x2]
+        if roi.size == 0:
+            return None
+        scale = min(1.0, max(self.localizationScale, self.localizationMinWidth / roi.shape[1]))
+        if roi.size * scale * scale > 0.75 * imageGray.size:
+            return None # searched area would barely shrink, the full-frame path is just as fast and more accurate
+        roi = cv2.resize(roi, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        roiFiltered = self.filterNoises(roi, diameter=max(5, int(round(11 * scale))))
+        imageEdges = self.performCannyEdgeDetection(roiFiltered)
+        plateCornersCoordinates = self._findPlateCorners(self._findContours(imageEdges), approxEpsilon=10 * scale)
+        if plateCornersCoordinates is None:
+            return None
+        _, _, plateWidth, plateHeight = cv2.boundingRect(plateCornersCoordinates)
+        minAspectRatio, maxAspectRatio = self.plateAspectRatioRange
+        if not minAspectRatio <= plateWidth / max(plateHeight, 1) <= maxAspectRatio:
+            return None # downscaling can promote other quadrilaterals, treat implausible shapes as a miss
+        plateCornersCoordinates = np.round(plateCornersCoordinates / scale).astype(np.int32)
+        return plateCornersCoordinates + np.array([x1, y1], dtype=np.int32)
     
-    def filterNoises(self, image):
-        diameter = 11 # diameter of each pixel neighborhood
+    def filterNoises(self, image, diameter=11):
+        # diameter - diameter of each pixel neighborhood
         sigmaColor = 17 # value of sigma in the color space. The greater the value, the colors farther to each other will start to get mixed.
         sigmaSpace = 17 # value of sigma in the coordinate space. he greater its value, the more further pixels will mix together, given that their colors lie within the sigmaColor range.
-        return cv2.bilateralFilter(image, diameter, sigmaColor, sigmaSpace)
+        with plate_read_stage_seconds.time("bilateral_filter"):
+            return cv2.bilateralFilter(image, diameter, sigmaColor, sigmaSpace)
     
     def performCannyEdgeDetection(self, image):
         thresholdLower = 30 # lower threshold value in Hysteresis Thresholding
         thresholdUpper = 200 # upper threshold value in Hysteresis Thresholding
-        return cv2.Canny(image, thresholdLower, thresholdUpper)
+        with plate_read_stage_seconds.time("canny"):
+            return cv2.Canny(image, thresholdLower, thresholdUpper)
     
     def _findContours(self, imageEdges):
-        keyPoints = cv2.findContours(imageEdges.copy(), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        contours = imutils.grab_contours(keyPoints)
-        return sorted(contours, key=cv2.contourArea, reverse=True)[:10]
-    
-    def _findPlateCorners(self, contours):
-        for contour in contours:
-            approx = cv2.approxPolyDP(contour, 10, True)
-            if len(approx) == 4:
-                return approx
-        return None
+        with plate_read_stage_seconds.time("contour_search"):
+            keyPoints = cv2.findContours(imageEdges.copy(), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+            contours = imutils.grab_contours(keyPoints)
+            return sorted(contours, key=cv2.contourArea, reverse=True)[:10]
     
-    def findPlateMask(self, image):
+    def _findPlateCorners(self, contours, approxEpsilon=10):
+        with plate_read_stage_seconds.time("quadrilateral_fit"):
+            for contour in contours:
+                approx = cv2.approxPolyDP(contour, approxEpsilon, True)
+                if len(approx) == 4:
+                    return approx
+            return None
+
+    def _findPlateCandidates(self, contours, approxEpsilon=10):
+        # up to plateCandidates 4-vertex approximations, largest first with the plate-shaped ones ahead; the inner and
+        # outer edge of one border give two nearly equal quadrilaterals, only the first one is kept
+        with plate_read_stage_seconds.time("quadrilateral_fit"):
+            plateShaped, otherShapes, boxes = [], [], []
+            for contour in contours:
+                approx = cv2.approxPolyDP(contour, approxEpsilon, True)
+                if len(approx) != 4:
+                    continue
+                box = cv2.boundingRect(approx)
+                if any(boundingBoxIoU(box, otherBox) > 0.8 for otherBox in boxes):
+                    continue
+                boxes.append(box)
+                (plateShaped if self._isPlateShaped(box) else otherShapes).append(approx)
+            return (plateShaped + otherShapes)[:self.plateCandidates]
+
+    def findPlateCorners(self, image):
         imageEdges = self.performCannyEdgeDetection(image)
         imageContours = self._findContours(imageEdges)
-        plateCornersCoordinates = self._findPlateCorners(imageContours)
-        if plateCornersCoordinates is None:
-            return None
-        mask = np.zeros(image.shape, np.uint8)
+        return self._findPlateCorners(imageContours)
+
+    def _createPlateMask(self, imageShape, plateCornersCoordinates):
+        mask = np.zeros(imageShape, np.uint8)
         cv2.drawContours(mask, [plateCornersCoordinates], 0, 255, -1)
         return mask
     
+    def findPlateMask(self, image):
+        plateCornersCoordinates = self.findPlateCorners(image)
+        if plateCornersCoordinates is None:
+            return None
+        return self._createPlateMask(image.shape, plateCornersCoordinates)
+    
     def cropPlate(self, image, mask):
         x, y = np.where(mask==255)
         x1, y1 = (np.min(x), np.min(y))
         x2, y2 = (np.max(x), np.max(y))
         return image[x1 : x2+1, y1 : y2+1]
     
+    def cropPlateByCorners(self, image, plateCornersCoordinates):
+        # same region as cropPlate on a filled mask, taken straight from the bounding rectangle
+        x, y, width, height = cv2.boundingRect(plateCornersCoordinates)
+        x1, y1 = max(x, 0), max(y, 0)
+        x2, y2 = min(x + width, image.shape[1]), min(y + height, image.shape[0])
+        return image[y1:y2, x1:x2]
+
+    def _orderCorners(self, plateCornersCoordinates):
+        # top-left, top-right, bottom-right, bottom-left
+        corners = plateCornersCoordinates.reshape(4, 2).astype(np.float32)
+        cornerSums = corners.sum(axis=1)
+        cornerDiffs = np.diff(corners, axis=1).ravel()
+        return np.array([corners[np.argmin(cornerSums)], corners[np.argmin(cornerDiffs)],
+                         corners[np.argmax(cornerSums)], corners[np.argmax(cornerDiffs)]], dtype=np.float32)
+
+    def rectifyPlateImage(self, image, plateCornersCoordinates):
+        # warps a plate seen at an angle into an axis-aligned rectangle for OCR
+        topLeft, topRight, bottomRight, bottomLeft = self._orderCorners(plateCornersCoordinates)
+        width = int(round(max(np.linalg.norm(topRight - topLeft), np.linalg.norm(bottomRight - bottomLeft))))
+        height = int(round(max(np.linalg.norm(bottomLeft - topLeft), np.linalg.norm(bottomRight - topRight))))
+        if width == 0 or height == 0:
+            return self.cropPlateByCorners(image, plateCornersCoordinates)
+        target = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype=np.float32)
+        transform = cv2.getPerspectiveTransform(np.array([topLeft, topRight, bottomRight, bottomLeft]), target)
+        return cv2.warpPerspective(image, transform, (width, height))
+    
+    def _readText(self, plateImage):
+        if self.ocrPool is not None:
+            try:
+                return self.ocrPool.readtext(plateImage, self.ocrPriority, self.ocrTimeout)
+            except OcrUnavailable as error:
+                ocr_fallbacks.inc(self.ocrFallback.name)
+                print(f"OCR pool unavailable ({error}), {self.ocrFallback.name.lower()} fallback")
+                if self.ocrFallback == OcrFallback.Manual:
+                    return []
+        return self.ocrCache.getReader(self.ocrLanguages).readtext(plateImage)
+
     def readPlateNumber(self, plateImage):
-        ocrReader = easyocr.Reader(self.ocrLanguages)
-        ocrResult = ocrReader.readtext(plateImage)
-        return ocrResult[0][-2]
+        with plate_read_stage_seconds.time("ocr"):
+            ocrResult = self._readText(plateImage)
+        return ocrResult[0][-2] if ocrResult else None
+
+    def _readPlateNumbersInPool(self, plateImages, priority):
+        # every crop is queued at once and read by all workers in parallel, the batch waits for room in the queue
+        # (an archive batch only for the places not reserved for the gates)
+        futures = [self.ocrPool.submit(plateImage, priority, block=True) if plateImage is not None else None
+                   for plateImage in plateImages]
+        plateNumbers = []
+        for future in futures:
+            try:
+                ocrResult = future.result() if future is not None else None
+            except OcrUnavailable:
+                ocrResult = None
+            plateNumbers.append(ocrResult[0][-2] if ocrResult else None)
+        return plateNumbers
+
+    def readPlateNumbers(self, plateImages, priority=OcrPriority.Archive):
+        if self.ocrPool is not None:
+            return self._readPlateNumbersInPool(plateImages, priority)
+        # easyocr readtext_batched resizes every image to one common size, which changes the reads
+        # on plates of different shapes, so the batch shares one reader and is read crop by crop
+        ocrReader = self.ocrCache.getReader(self.ocrLanguages)
+        plateNumbers = []
+        for plateImage in plateImages:
+            if plateImage is None:
+                plateNumbers.append(None)
+                continue
+            with plate_read_stage_seconds.time("ocr"):
+                ocrResult = ocrReader.readtext(plateImage)
+            plateNumbers.append(ocrResult[0][-2] if ocrResult else None)
+        return plateNumbers
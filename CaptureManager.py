@@ -0,0 +1,154 @@
+from collections import deque
+import threading
+import time
+import cv2
+import numpy as np
+
+class VideoCaptureSource:
+    def __init__(self, cameraPort=0) -> None:
+        self.cameraPort = cameraPort
+        self.camera = None
+
+    def open(self):
+        self.camera = cv2.VideoCapture(self.cameraPort)
+        return self.camera.isOpened()
+
+    def read(self):
+        if self.camera is None:
+            return None
+        result, image = self.camera.read()
+        return image if result else None
+
+    def release(self):
+        if self.camera is not None:
+            self.camera.release()
+            self.camera = None
+
+
+class ImageFileSource:
+    # replays images from disk instead of a camera, e.g. testData/vehicle*.jpg
+    def __init__(self, imagePaths, loop=True, frameInterval=0.0) -> None:
+        self.imagePaths = list(imagePaths)
+        self.loop = loop
+        self.frameInterval = frameInterval
+        self.images = []
+        self.index = 0
+
+    def open(self):
+        self.images = [cv2.imread(path) for path in self.imagePaths]
+        self.images = [image for image in self.images if image is not None]
+        self.index = 0
+        return len(self.images) > 0
+
+    def read(self):
+        if self.index >= len(self.images):
+            if not self.loop or not self.images:
+                return None
+            self.index = 0
+        image = self.images[self.index]
+        self.index += 1
+        time.sleep(self.frameInterval)
+        return image
+
+    def release(self):
+        self.images = []
+
+
+class SyntheticFrameSource:
+    # generates random frames of a given size, useful for tests and benchmarks without hardware
+    def __init__(self, width=640, height=480, frameInterval=0.0, seed=0) -> None:
+        self.shape = (height, width, 3)
+        self.frameInterval = frameInterval
+        self.random = np.random.default_rng(seed)
+
+    def open(self):
+        return True
+
+    def read(self):
+        time.sleep(self.frameInterval)
+        return self.random.integers(0, 256, self.shape, dtype=np.uint8)
+
+    def release(self):
+        pass
+
+
+class CaptureSession:
+    # Keeps a frame source open and reads it on a background thread. Only the newest frames are
+    # kept in a small ring buffer, so getLatestFrame does not wait for the device.
+    def __init__(self, frameSource, bufferSize=2, reconnectDelay=1.0, maxFailedReads=5) -> None:
+        self.frameSource = frameSource
+        self.frames = deque(maxlen=bufferSize)
+        self.reconnectDelay = reconnectDelay # time in sec
+        self.maxFailedReads = maxFailedReads
+        self.frameReady = threading.Condition()
+        self.stopEvent = threading.Event()
+        self.thread = None
+        self.isConnected = False
+        self.reconnectCount = 0
+
+    def start(self):
+        if self.isRunning():
+            return
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self._grabFrames, name="CaptureSession", daemon=True)
+        self.thread.start()
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def _connect(self):
+        self.frameSource.release()
+        self.isConnected = self.frameSource.open()
+        if not self.isConnected:
+            print("Could not open frame source, retrying")
+        return self.isConnected
+
+    def _grabFrames(self):
+        failedReads = 0
+        while not self.stopEvent.is_set():
+            if not self.isConnected and not self._connect():
+                self.stopEvent.wait(self.reconnectDelay)
+                continue
+            image = self.frameSource.read()
+            if image is None:
+                failedReads += 1
+                if failedReads >= self.maxFailedReads:
+                    # device was unplugged or stream ended - reopen it
+                    self.isConnected = False
+                    self.reconnectCount += 1
+                    failedReads = 0
+                    self.stopEvent.wait(self.reconnectDelay)
+                continue
+            failedReads = 0
+            with self.frameReady:
+                self.frames.append((time.perf_counter(), image))
+                self.frameReady.notify_all()
+        self.frameSource.release()
+        self.isConnected = False
+
+    def getLatestFrame(self, timeout=None, maxAge=None):
+        # returns the newest frame, waiting up to timeout seconds if none was captured yet
+        with self.frameReady:
+            if not self.frames and timeout:
+                self.frameReady.wait(timeout)
+            if not self.frames:
+                return None
+            timestamp, image = self.frames[-1]
+        if maxAge is not None and time.perf_counter() - timestamp > maxAge:
+            return None
+        return image
+
+    def close(self):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.frameReady:
+            self.frames.clear()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
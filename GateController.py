@@ -0,0 +1,164 @@
+from enum import Enum
+from TollBarManager import BarrierState
+from MetricsManager import metrics
+import threading
+import time
+
+gate_decisions = metrics.counter("gate_decisions_total", "Passage decisions for vehicles before the barrier", ("gate", "decision"))
+gate_passages = metrics.counter("gate_passages_total", "Vehicles that passed the gate", ("gate",))
+
+class GateType(Enum):
+    Entrance = 0
+    Exit = 1
+
+class GateState(Enum):
+    Idle = 0 # barrier closed, waiting for a vehicle
+    Open = 1 # barrier open, waiting for the vehicle to pass and the timer to run out
+    Denied = 2 # vehicle before the barrier is not allowed to pass (e.g. fee not paid)
+
+class SensorMode(Enum):
+    Polling = 0 # sensors are read at a fixed rate with debouncing
+    EdgeTriggered = 1 # GPIO edge callbacks wake the gate, idle gate sleeps
+
+class GateController:
+    # Drives one gate as a state machine. The controller sleeps between sensor reads instead of spinning,
+    # so an idle gate costs next to no CPU and still reacts within one poll period (or one edge).
+    def __init__(self, gateType, cameraHandler, barrierHandler, parkingDb, sensorMode=SensorMode.Polling, pollRate=20, debounceSamples=2,
+                 clock=time.perf_counter, eventClock=None) -> None:
+        self.gateType = gateType
+        self.cameraHandler = cameraHandler
+        self.barrierHandler = barrierHandler
+        self.parkingDb = parkingDb
+        self.sensorMode = sensorMode
+        self.pollInterval = 1 / pollRate # time in sec between sensor reads
+        self.idleTimeout = 1.0 # time in sec, edge-triggered gate re-reads sensors at least this often in case an edge was missed
+        self.deniedRecheckInterval = 2.0 # time in sec between fee checks for a denied vehicle
+        self.clock = clock # time in sec of the gate timers
+        self.eventClock = eventClock # datetime of recorded passages, None lets the database use the current time
+        self.barrierHandler.debounceSamples = debounceSamples if sensorMode == SensorMode.Polling else 1
+        self.state = GateState.Idle
+        self.vehiclePlateNumber = None
+        self.lastDeniedCheck = 0
+        self.wakeEvent = threading.Event()
+        self.stopEvent = threading.Event()
+
+    def onSensorEdge(self, channel=None):
+        self.wakeEvent.set()
+
+    # ---- decisions of the state machine, shared with AsyncGateController which only awaits the blocking calls ----
+    def _needsFeeCheck(self):
+        return self.gateType == GateType.Exit
+
+    def _decidePassage(self, wasFeePaid=None):
+        # the exit gate passes the fee status read from the database
+        isAllowed = not self._needsFeeCheck() or bool(wasFeePaid)
+        gate_decisions.inc(self.gateType.name, "allowed" if isAllowed else "denied")
+        return isAllowed
+
+    def _getPassageRecord(self):
+        # (ParkingDB method, arguments) writing the passage of the vehicle
+        eventTime = self.eventClock() if self.eventClock is not None else None
+        gate_passages.inc(self.gateType.name)
+        methodName = "addCarEntryRecord" if self.gateType == GateType.Entrance else "releaseCarFromDb"
+        return methodName, (self.vehiclePlateNumber, eventTime)
+
+    def _readPlate(self):
+        carPhoto = self.cameraHandler.takePhoto()
+        if carPhoto is None:
+            return None, False
+        return self.cameraHandler.getVehiclePlateNumber(carPhoto), True
+
+    def _isVehicleWaiting(self):
+        return self.barrierHandler.barrier.state == BarrierState.Closed and self.barrierHandler.isVehicleBeforeTollBar()
+
+    def _onPlateRead(self, plateNumber):
+        self.vehiclePlateNumber = plateNumber
+        self.lastDeniedCheck = self.clock()
+
+    def _onPassageDecision(self, isAllowed):
+        if isAllowed:
+            self.barrierHandler.startOpening()
+            self.state = GateState.Open
+        else:
+            self.state = GateState.Denied
+
+    def _isFeeRecheckDue(self):
+        # a denied vehicle that drove away frees the gate, one that waits is checked again every deniedRecheckInterval
+        if not self.barrierHandler.isVehicleBeforeTollBar():
+            self._finishPassage()
+            return False
+        if self.clock() - self.lastDeniedCheck < self.deniedRecheckInterval:
+            return False
+        self.lastDeniedCheck = self.clock()
+        return True
+
+    def _advanceBarrier(self):
+        # barrier moves in the background, True once it closed again after the vehicle
+        if self.barrierHandler.barrier.state == BarrierState.Open:
+            self.barrierHandler.startClosing()
+            return False
+        return self.barrierHandler.barrier.state == BarrierState.Closed
+
+    def _finishPassage(self):
+        self.state = GateState.Idle
+        self.vehiclePlateNumber = None
+
+    def isPassageAllowed(self):
+        wasFeePaid = self.parkingDb.wasFeePaid(self.vehiclePlateNumber) if self._needsFeeCheck() else None
+        return self._decidePassage(wasFeePaid)
+
+    def recordPassage(self):
+        methodName, args = self._getPassageRecord()
+        getattr(self.parkingDb, methodName)(*args)
+
+    def step(self):
+        # one transition of the state machine for the current sensor values
+        if self.state == GateState.Idle:
+            self._handleIdle()
+        elif self.state == GateState.Denied:
+            self._handleDenied()
+        if self.state == GateState.Open:
+            self._handleOpen()
+
+    def _handleIdle(self):
+        if not self._isVehicleWaiting():
+            return
+        plateNumber, wasPhotoTaken = self._readPlate()
+        if not wasPhotoTaken:
+            return
+        self._onPlateRead(plateNumber)
+        self._onPassageDecision(self.isPassageAllowed())
+
+    def _handleDenied(self):
+        if self._isFeeRecheckDue():
+            self._onPassageDecision(self.isPassageAllowed())
+
+    def _handleOpen(self):
+        # the gate keeps reading sensors while the barrier moves
+        if self._advanceBarrier():
+            if self.barrierHandler.isVehicleBehindTollBar():
+                self.recordPassage()
+            self._finishPassage()
+
+    def _getWaitTime(self):
+        if self.sensorMode == SensorMode.Polling or self.state != GateState.Idle:
+            return self.pollInterval
+        return self.idleTimeout
+
+    def run(self):
+        if self.sensorMode == SensorMode.EdgeTriggered:
+            self.barrierHandler.enableSensorEvents(self.onSensorEdge)
+        try:
+            self.barrierHandler.updateSensors()
+            while not self.stopEvent.is_set():
+                self.step()
+                self.wakeEvent.wait(self._getWaitTime())
+                self.wakeEvent.clear()
+                self.barrierHandler.updateSensors()
+        finally:
+            if self.sensorMode == SensorMode.EdgeTriggered:
+                self.barrierHandler.disableSensorEvents()
+
+    def stop(self):
+        self.stopEvent.set()
+        self.wakeEvent.set()
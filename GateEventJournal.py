@@ -0,0 +1,298 @@
+from DataBaseManager import ParkingEventType
+from datetime import datetime
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # no file locks (Windows), run a single gate process per journal directory
+import threading
+import glob
+import zlib
+import json
+import time
+import os
+
+# state directory of the journals of not yet persisted gate events, created on first use;
+# set the PARKING_JOURNAL_DIR environment variable to move it
+default_journal_dir = os.path.join(os.environ.get("XDG_STATE_HOME", os.path.join(os.path.expanduser("~"), ".local", "state")), "parking_lot")
+legacy_journal_dir = "." # older versions wrote the journals to the current directory
+
+class JournalInUse(Exception):
+    # another process holds the journal, two writers would overwrite each other's checkpoint
+    pass
+
+def _getJournalDir():
+    return os.environ.get("PARKING_JOURNAL_DIR", default_journal_dir)
+
+def _getJournalPrefix(db_string, journalDir):
+    return os.path.join(journalDir, f"gate_events_{zlib.crc32(db_string.encode()):08x}")
+
+def getJournalPath(db_string, writer=None):
+    # one journal per database and writing process (pid by default), so events are never replayed into
+    # another database and the gate processes never share a journal file or its checkpoint;
+    # an in-memory database does not outlive the process, its journal is kept in memory too
+    if db_string in ("sqlite://", "sqlite:///:memory:"):
+        return None
+    journalDir = _getJournalDir()
+    os.makedirs(journalDir, exist_ok=True)
+    return f"{_getJournalPrefix(db_string, journalDir)}_{writer if writer is not None else os.getpid()}.journal"
+
+def getJournalPaths(db_string):
+    # journals of every process that wrote gate events of the database, with the ones older versions
+    # left in the current directory unless PARKING_JOURNAL_DIR is set
+    if db_string in ("sqlite://", "sqlite:///:memory:"):
+        return []
+    journalDirs = [_getJournalDir()]
+    if "PARKING_JOURNAL_DIR" not in os.environ:
+        journalDirs.append(legacy_journal_dir)
+    paths = set()
+    for journalDir in journalDirs:
+        prefix = glob.escape(_getJournalPrefix(db_string, journalDir))
+        paths.update(glob.glob(f"{prefix}.journal") + glob.glob(f"{prefix}_*.journal")) # prefix.journal is shared by all processes of older versions
+    return sorted(paths)
+
+def _lockJournalFile(path, create):
+    # opens the journal with an exclusive lock held until it is closed, None when another process holds it
+    # or the file is gone (a removed journal that was adopted meanwhile)
+    try:
+        journalFile = open(path, "a+" if create else "r+")
+    except FileNotFoundError:
+        return None
+    if fcntl is not None:
+        try:
+            fcntl.flock(journalFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            journalFile.close()
+            return None
+    try:
+        isSameFile = os.path.samestat(os.stat(path), os.fstat(journalFile.fileno()))
+    except FileNotFoundError:
+        isSameFile = False
+    if not isSameFile:
+        journalFile.close()
+        return None
+    return journalFile
+
+def _readJournal(journalFile, checkpointPath):
+    # (persisted sequence, last sequence, events after the checkpoint) of an opened journal
+    persistedSequence = 0
+    if os.path.exists(checkpointPath):
+        with open(checkpointPath) as checkpointFile:
+            persistedSequence = int(checkpointFile.read() or 0)
+    lastSequence = persistedSequence
+    pendingEvents = []
+    journalFile.seek(0)
+    for line in journalFile:
+        try:
+            gateEvent = GateEvent.fromJson(line)
+        except ValueError:
+            continue # torn last line of a crashed process
+        lastSequence = max(lastSequence, gateEvent.sequence)
+        if gateEvent.sequence > persistedSequence:
+            pendingEvents.append(gateEvent)
+    journalFile.seek(0, os.SEEK_END)
+    return persistedSequence, lastSequence, pendingEvents
+
+class GateEvent:
+    def __init__(self, sequence, eventType, registration, eventTime, details=None) -> None:
+        self.sequence = sequence
+        self.eventType = eventType
+        self.registration = registration
+        self.eventTime = eventTime
+        self.details = details or {}
+
+    def toJson(self):
+        return json.dumps({"sequence": self.sequence, "eventType": self.eventType.name, "registration": self.registration,
+                           "eventTime": self.eventTime.isoformat(), "details": self.details})
+
+    @classmethod
+    def fromJson(cls, line):
+        record = json.loads(line)
+        return cls(record["sequence"], ParkingEventType[record["eventType"]], record["registration"],
+                   datetime.fromisoformat(record["eventTime"]), record["details"])
+
+    def __repr__(self):
+        return "<GateEvent(sequence={0}, eventType={1}, registration={2}, eventTime={3}, details={4})>".format(
+            self.sequence, self.eventType.name, self.registration, self.eventTime, self.details)
+
+
+class GateEventJournal:
+    # Write-behind log of gate events. append() only writes a line to the local journal file, so a gate
+    # never waits for the database; a background flusher fsyncs the file and writes the pending events
+    # to Parking_lot in batches (ParkingDB.applyEvents). The sequence number of the last persisted event is
+    # kept in a checkpoint file, events after it are replayed when the journal is opened after a crash.
+    # The journal file is locked while it is open, a second writer gets JournalInUse. With path=None events are only kept in memory (no crash recovery), e.g. for tests.
+    def __init__(self, parkingDb, path=None, flushInterval=0.1, maxBatchSize=500, retryDelay=1.0, maxJournalSize=1 << 20) -> None:
+        self.parkingDb = parkingDb
+        self.path = path
+        self.checkpointPath = path + ".checkpoint" if path is not None else None
+        self.flushInterval = flushInterval # time in sec between batches
+        self.maxBatchSize = maxBatchSize
+        self.retryDelay = retryDelay # time in sec before a failed batch is retried
+        self.maxJournalSize = maxJournalSize # bytes, journal is truncated once everything in it is persisted
+        self.lock = threading.Lock()
+        self.flushedCondition = threading.Condition(self.lock)
+        self.pendingEvents = []
+        self.persistedSequence = 0
+        self.nextSequence = 1
+        self.journalFile = None
+        self.isSyncNeeded = False
+        self.stats = {"appended": 0, "persisted": 0, "batches": 0, "errors": 0, "replayed": 0, "adopted": 0}
+        self.lastError = None
+        if path is not None:
+            self._open()
+        self.wakeEvent = threading.Event()
+        self.stopEvent = threading.Event()
+        self.flusherThread = threading.Thread(target=self._runFlusher, name="gate-event-journal", daemon=True)
+        self.flusherThread.start()
+
+    def _open(self):
+        self.journalFile = _lockJournalFile(self.path, create=True)
+        if self.journalFile is None:
+            raise JournalInUse(f"gate event journal {self.path} is used by another process")
+        self.persistedSequence, lastSequence, self.pendingEvents = _readJournal(self.journalFile, self.checkpointPath)
+        self.nextSequence = lastSequence + 1
+        self.stats["replayed"] = len(self.pendingEvents)
+
+    def _append(self, eventType, registration, eventTime, details):
+        gateEvent = GateEvent(self.nextSequence, eventType, registration, eventTime, details)
+        self.nextSequence += 1
+        if self.journalFile is not None:
+            # reaches the OS before returning (survives a crash of the process), fsync is batched by the flusher
+            self.journalFile.write(gateEvent.toJson() + "\n")
+            self.journalFile.flush()
+            self.isSyncNeeded = True
+        self.pendingEvents.append(gateEvent)
+        return gateEvent
+
+    def append(self, eventType, registration, eventTime, **details):
+        with self.lock:
+            gateEvent = self._append(eventType, registration, eventTime, details)
+            self.stats["appended"] += 1
+        return gateEvent.sequence
+
+    def adoptOrphanedJournals(self, paths):
+        # Takes over the not persisted events of journals left by processes that crashed (a running process
+        # holds the lock of its journal and is skipped). The events are copied to this journal and synced
+        # before the orphan is removed, so a crash in between replays them twice at worst, never loses them.
+        adopted = 0
+        for path in paths:
+            if self.path is not None and os.path.abspath(path) == os.path.abspath(self.path):
+                continue
+            orphanFile = _lockJournalFile(path, create=False)
+            if orphanFile is None:
+                continue
+            try:
+                _, _, orphanEvents = _readJournal(orphanFile, path + ".checkpoint")
+                with self.lock:
+                    for gateEvent in orphanEvents:
+                        self._append(gateEvent.eventType, gateEvent.registration, gateEvent.eventTime, gateEvent.details)
+                    self.stats["adopted"] += len(orphanEvents)
+                self._sync()
+                for orphanPath in (path + ".checkpoint", path):
+                    if os.path.exists(orphanPath):
+                        os.remove(orphanPath)
+            finally:
+                orphanFile.close()
+            adopted += len(orphanEvents)
+        return adopted
+
+    def getPendingEvents(self):
+        with self.lock:
+            return list(self.pendingEvents)
+
+    def _sync(self):
+        with self.lock:
+            if self.journalFile is None or not self.isSyncNeeded:
+                return
+            os.fsync(self.journalFile.fileno())
+            self.isSyncNeeded = False
+
+    def _writeCheckpoint(self, sequence):
+        temporaryPath = self.checkpointPath + ".tmp"
+        with open(temporaryPath, "w") as checkpointFile:
+            checkpointFile.write(str(sequence))
+            checkpointFile.flush()
+            os.fsync(checkpointFile.fileno())
+        os.replace(temporaryPath, self.checkpointPath)
+
+    def _truncateIfPersisted(self):
+        with self.lock:
+            if self.journalFile is None or self.pendingEvents or self.journalFile.tell() < self.maxJournalSize:
+                return
+            self.journalFile.seek(0)
+            self.journalFile.truncate()
+
+    def _flushBatch(self):
+        # returns True when a batch was written to the database
+        self._sync() # the database is never ahead of the journal on disk
+        with self.lock:
+            batch = self.pendingEvents[:self.maxBatchSize]
+        if not batch:
+            return False
+        self.parkingDb.applyEvents(batch)
+        if self.checkpointPath is not None:
+            self._writeCheckpoint(batch[-1].sequence)
+        with self.lock:
+            del self.pendingEvents[:len(batch)]
+            self.persistedSequence = batch[-1].sequence
+            self.stats["persisted"] += len(batch)
+            self.stats["batches"] += 1
+            self.flushedCondition.notify_all()
+        if self.journalFile is not None:
+            self._truncateIfPersisted()
+        return True
+
+    def _runFlusher(self):
+        while True:
+            self.wakeEvent.wait(self.flushInterval)
+            self.wakeEvent.clear()
+            try:
+                while self._flushBatch():
+                    pass
+            except Exception as error:
+                # database unavailable, the events stay in the journal and are retried
+                self.stats["errors"] += 1
+                self.lastError = repr(error)
+                if self.stopEvent.is_set():
+                    break
+                self.stopEvent.wait(self.retryDelay)
+                continue
+            if self.stopEvent.is_set():
+                break
+
+    def flush(self, timeout=None):
+        # waits until every event appended so far is in the database, returns False on timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self.lock:
+            sequence = self.nextSequence - 1
+        self.wakeEvent.set()
+        with self.flushedCondition:
+            while self.persistedSequence < sequence:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.flushedCondition.wait(remaining)
+        return True
+
+    def close(self, timeout=10.0):
+        # persists what it can within the timeout, anything left is replayed on the next start;
+        # a journal with everything persisted is removed, so every process run does not leave a file behind
+        self.stopEvent.set()
+        self.wakeEvent.set()
+        self.flusherThread.join(timeout)
+        self._sync()
+        with self.lock:
+            if self.journalFile is not None:
+                if not self.pendingEvents and not self.flusherThread.is_alive():
+                    for path in (self.checkpointPath, self.path):
+                        if os.path.exists(path):
+                            os.remove(path) # still locked, no other process adopts it meanwhile
+                self.journalFile.close()
+                self.journalFile = None
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["pending"] = len(self.pendingEvents)
+            stats["lastError"] = self.lastError
+            return stats
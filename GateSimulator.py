@@ -0,0 +1,378 @@
+from TollBarManager import TollBarManager, MotionProfile
+from GateController import GateController, GateType, GateState, SensorMode
+from PaymentManager import PaymentManager, PaymentOutcome
+from collections import deque
+from datetime import datetime, timedelta
+import itertools
+import random
+import string
+import heapq
+import time
+
+class VirtualClock:
+    # Simulated time. Called like time.perf_counter it gives seconds since the start of the simulation,
+    # now() gives the matching datetime written to the database.
+    def __init__(self, start=None) -> None:
+        self.start = start or datetime.now().replace(microsecond=0)
+        self.seconds = 0.0
+
+    def __call__(self):
+        return self.seconds
+
+    def now(self):
+        return self.start + timedelta(seconds=self.seconds)
+
+    def advanceTo(self, seconds):
+        if seconds < self.seconds:
+            raise ValueError("virtual clock can not go back")
+        self.seconds = seconds
+
+
+class SimulatedPWM:
+    def __init__(self, port, frequency) -> None:
+        self.port = port
+        self.frequency = frequency
+        self.dutyCycle = 0
+
+    def start(self, dutyCycle):
+        self.dutyCycle = dutyCycle
+
+    def ChangeDutyCycle(self, dutyCycle):
+        self.dutyCycle = dutyCycle
+
+    def stop(self):
+        pass
+
+
+class SimulatedGPIO:
+    # RPi.GPIO interface for one TollBarManager, the sensor inputs are set by the simulator
+    BCM = 11
+    IN = 1
+    OUT = 0
+    PUD_UP = 22
+    BOTH = 33
+
+    def __init__(self) -> None:
+        self.levels = {}
+        self.callbacks = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, port, direction, initial=0, pull_up_down=None):
+        self.levels.setdefault(port, False)
+
+    def input(self, port):
+        return self.levels.get(port, False)
+
+    def setInput(self, port, level):
+        changed = self.levels.get(port, False) != level
+        self.levels[port] = level
+        if changed and port in self.callbacks:
+            self.callbacks[port](port)
+
+    def PWM(self, port, frequency):
+        return SimulatedPWM(port, frequency)
+
+    def add_event_detect(self, port, edge, callback=None, bouncetime=None):
+        self.callbacks[port] = callback
+
+    def remove_event_detect(self, port):
+        self.callbacks.pop(port, None)
+
+    def cleanup(self):
+        pass
+
+
+class SensorTrace:
+    # Levels of the (before, under, behind) sensors while one vehicle passes, at seconds after the barrier
+    # started opening. The vehicle waits before the closed barrier until the first step and drives away once
+    # the barrier closed behind it.
+    def __init__(self, steps) -> None:
+        self.steps = sorted(steps, key=lambda step: step[0])
+
+default_sensor_trace = SensorTrace([(3.0, (False, True, False)), # drives under the open barrier
+                                    (4.5, (False, False, True))]) # passed the barrier
+
+
+class SimulatedCamera:
+    # reads the plate of the vehicle the simulator put in front of the lane
+    def __init__(self) -> None:
+        self.plateNumber = None
+
+    def warmUpOcr(self):
+        pass
+
+    def closeCapture(self):
+        pass
+
+    def takePhoto(self):
+        return self.plateNumber
+
+    def getVehiclePlateNumber(self, image):
+        return image
+
+
+district_codes = ["PO", "WY", "WA", "KR", "GD", "WR", "LU", "SZ", "BI", "EL", "DW", "PZ"]
+
+def syntheticPlates(seed=None):
+    # endless unique plates in the Polish format, e.g. "PO 1234A"
+    generator = random.Random(seed)
+    issued = set()
+    while True:
+        plate = "{0} {1}{2}".format(generator.choice(district_codes), generator.randrange(1000, 10000),
+                                    generator.choice(string.ascii_uppercase))
+        if plate not in issued:
+            issued.add(plate)
+            yield plate
+
+
+class SimulatedCar:
+    def __init__(self, plateNumber, arrivalTime) -> None:
+        self.plateNumber = plateNumber
+        self.arrivalTime = arrivalTime # virtual time in sec
+        self.queuedAt = arrivalTime
+
+
+class SimulatedLane:
+    # one real GateController and TollBarManager driven through a SimulatedGPIO
+    def __init__(self, name, gateType, gateDb, clock) -> None:
+        self.name = name
+        self.gpio = SimulatedGPIO()
+        self.camera = SimulatedCamera()
+        self.barrierHandler = TollBarManager(gpio=self.gpio, clock=clock)
+        # the barrier moves in one servo step inside the gate step, its travel time is added on the virtual clock
+        self.barrierHandler.isMotionInBackground = False
+        self.barrierHandler.motionProfile = MotionProfile(stepDegrees=self.barrierHandler.openPosition)
+        self.gate = GateController(gateType, self.camera, self.barrierHandler, gateDb, SensorMode.EdgeTriggered,
+                                   clock=clock, eventClock=clock.now)
+        self.queue = deque()
+        self.isBusy = False
+
+    def setSensors(self, before, under, behind):
+        for sensor, level in zip(self.barrierHandler.sensors, (before, under, behind)):
+            self.gpio.setInput(sensor.port, level)
+
+    def tick(self):
+        # what the gate loop does after a sensor edge
+        self.barrierHandler.updateSensors()
+        self.gate.step()
+
+
+class SimulationReport:
+    def __init__(self) -> None:
+        self.cars = {"arrived": 0, "entered": 0, "exited": 0, "deniedAtExit": 0, "declinedPayments": 0, "stuck": 0}
+        self.realTime = 0.0 # sec
+        self.simulatedTime = 0.0 # sec
+        self.peakOccupancy = 0
+        self.queues = {} # lane group -> {"max": cars, "mean": cars}
+        self.waits = {"entrance queue": [], "exit queue": [], "lane passage": [], "parking": []} # virtual sec
+        self.stages = {"plate read and decision": [], "passage recorded": [], "end of parking and payment": []} # real sec
+
+    @staticmethod
+    def _summary(values, scale=1.0):
+        if not values:
+            return None
+        values = sorted(values)
+        return {"mean": sum(values) / len(values) * scale, "p95": values[int(0.95 * (len(values) - 1))] * scale,
+                "max": values[-1] * scale}
+
+    def toDict(self):
+        return {"cars": dict(self.cars), "realTime": self.realTime, "simulatedTime": self.simulatedTime,
+                "carsPerSecond": self.cars["exited"] / self.realTime if self.realTime else None,
+                "carsPerSimulatedHour": self.cars["exited"] / self.simulatedTime * 3600 if self.simulatedTime else None,
+                "peakOccupancy": self.peakOccupancy, "queues": self.queues,
+                "waitsSeconds": {name: self._summary(values) for name, values in self.waits.items()},
+                "stagesMilliseconds": {name: self._summary(values, 1000) for name, values in self.stages.items()}}
+
+    def __str__(self):
+        report = self.toDict()
+        lines = [f"cars: {report['cars']}",
+                 f"simulated {report['simulatedTime'] / 3600:.1f} h in {report['realTime']:.2f} s: "
+                 f"{report['carsPerSecond'] or 0:.0f} cars/s, {report['carsPerSimulatedHour'] or 0:.0f} cars per simulated hour",
+                 f"peak occupancy: {report['peakOccupancy']}"]
+        for name, queue in report["queues"].items():
+            lines.append(f"{name} queue: max {queue['max']} cars, mean {queue['mean']:.2f} cars")
+        for name, summary in report["waitsSeconds"].items():
+            if summary:
+                lines.append(f"{name}: mean {summary['mean']:.1f} s, p95 {summary['p95']:.1f} s, max {summary['max']:.1f} s")
+        for name, summary in report["stagesMilliseconds"].items():
+            if summary:
+                lines.append(f"{name}: mean {summary['mean']:.3f} ms, p95 {summary['p95']:.3f} ms, max {summary['max']:.3f} ms")
+        return "\n".join(lines)
+
+
+class GateSimulator:
+    # Discrete-event simulation of the parking lot on a virtual clock. Cars arrive at random (arrivalRate
+    # per hour), queue at the entrance lanes, park for a random time (departureRate per hour, so on average
+    # 1 / departureRate hours), end parking and pay at a pay station, then queue at the exit lanes. Every
+    # lane is a real GateController and TollBarManager driven by sensor traces through a SimulatedGPIO, the
+    # records go to the real database and payments through the real PaymentManager. Only the waiting is
+    # simulated, so thousands of cars run through the code per second of real time.
+    def __init__(self, parkingDb, gateDb=None, paymentManager=None, arrivalRate=600.0, departureRate=1.0,
+                 entranceLanes=1, exitLanes=1, sensorTrace=None, seed=None, clock=None) -> None:
+        self.parkingDb = parkingDb
+        self.gateDb = gateDb if gateDb is not None else parkingDb # e.g. an OccupancyIndex
+        self.clock = clock if clock is not None else VirtualClock()
+        self.paymentManager = paymentManager if paymentManager is not None else PaymentManager(parkingDb, clock=self.clock.now)
+        self.arrivalRate = arrivalRate # cars per hour
+        self.departureRate = departureRate # per hour
+        self.sensorTrace = sensorTrace if sensorTrace is not None else default_sensor_trace
+        self.random = random.Random(seed)
+        self.plates = syntheticPlates(self.random.random())
+        self.plateReadTime = 0.5 # virtual time in sec from the car stopping at the barrier to the gate decision
+        self.barrierTravelTime = 2.0 # virtual time in sec to open or close the barrier
+        self.paymentRetryTime = 60.0 # virtual time in sec before a declined payment is tried again
+        self.walkToExitTime = 180.0 # virtual time in sec from the pay station to the exit lane
+        self.maxCloseAttempts = 10 # a lane whose barrier does not close after this many tries is reported stuck
+        self.lanes = {"entrance": [SimulatedLane(f"entrance {lane}", GateType.Entrance, self.gateDb, self.clock)
+                                   for lane in range(entranceLanes)],
+                      "exit": [SimulatedLane(f"exit {lane}", GateType.Exit, self.gateDb, self.clock)
+                               for lane in range(exitLanes)]}
+        self.events = [] # heap of (virtual time, sequence, callback)
+        self.sequence = itertools.count()
+        self.report = SimulationReport()
+        self.occupancy = 0
+        self.queueArea = {group: 0.0 for group in self.lanes} # integral of the queue length over virtual time
+        self.queueChangedAt = {group: 0.0 for group in self.lanes}
+        self.maxQueueLength = {group: 0 for group in self.lanes}
+
+    # ---- event loop ----
+    def _schedule(self, delay, callback):
+        heapq.heappush(self.events, (self.clock() + delay, next(self.sequence), callback))
+
+    def _start(self, process):
+        # process is a generator yielding the virtual time in sec to wait before it continues
+        try:
+            delay = next(process)
+        except StopIteration:
+            return
+        self._schedule(delay, lambda: self._start(process))
+
+    def run(self, cars=None, duration=None):
+        # runs until `cars` cars arrived or `duration` virtual sec passed and every car has left again
+        if cars is None and duration is None:
+            raise ValueError("set the number of cars or the duration of the simulation")
+        begin = time.perf_counter()
+        self._start(self._arrivals(cars, duration))
+        while self.events:
+            eventTime, _, callback = heapq.heappop(self.events)
+            self.clock.advanceTo(eventTime)
+            callback()
+        self.report.realTime = time.perf_counter() - begin
+        self.report.simulatedTime = self.clock()
+        for group in self.lanes:
+            self._queueChanged(group)
+            self.report.queues[group] = {"max": self.maxQueueLength[group],
+                                         "mean": self.queueArea[group] / self.clock() if self.clock() else 0.0}
+        return self.report
+
+    # ---- processes ----
+    def _arrivals(self, cars, duration):
+        for _ in itertools.count() if cars is None else range(cars):
+            delay = self.random.expovariate(self.arrivalRate / 3600)
+            if duration is not None and self.clock() + delay > duration:
+                return
+            yield delay
+            self.report.cars["arrived"] += 1
+            self._enqueue("entrance", SimulatedCar(next(self.plates), self.clock()))
+
+    def _queueChanged(self, group):
+        # called before the queue length changes
+        now = self.clock()
+        self.queueArea[group] += sum(len(lane.queue) for lane in self.lanes[group]) * (now - self.queueChangedAt[group])
+        self.queueChangedAt[group] = now
+
+    def _enqueue(self, group, car):
+        lane = min(self.lanes[group], key=lambda lane: len(lane.queue) + lane.isBusy)
+        self._queueChanged(group)
+        car.queuedAt = self.clock()
+        lane.queue.append(car)
+        self.maxQueueLength[group] = max(self.maxQueueLength[group], sum(len(lane.queue) for lane in self.lanes[group]))
+        if not lane.isBusy:
+            self._start(self._serveLane(group, lane))
+
+    def _serveLane(self, group, lane):
+        lane.isBusy = True
+        while lane.queue:
+            self._queueChanged(group)
+            car = lane.queue.popleft()
+            self.report.waits[f"{group} queue"].append(self.clock() - car.queuedAt)
+            passageStart = self.clock()
+            passed = yield from self._passage(lane, car)
+            self.report.waits["lane passage"].append(self.clock() - passageStart)
+            if not passed:
+                continue
+            if group == "entrance":
+                self.report.cars["entered"] += 1
+                self.occupancy += 1
+                self.report.peakOccupancy = max(self.report.peakOccupancy, self.occupancy)
+                car.enteredAt = self.clock()
+                parkingTime = self.random.expovariate(self.departureRate / 3600)
+                self._schedule(parkingTime, lambda car=car: self._start(self._payAndLeave(car)))
+            else:
+                self.report.cars["exited"] += 1
+                self.occupancy -= 1
+        lane.isBusy = False
+
+    def _timedTick(self, lane, stage):
+        start = time.perf_counter()
+        lane.tick()
+        self.report.stages[stage].append(time.perf_counter() - start)
+
+    def _passage(self, lane, car):
+        # returns True when the car passed the lane, False when the gate did not let it through or got stuck
+        lane.camera.plateNumber = car.plateNumber
+        lane.setSensors(True, False, False)
+        yield self.plateReadTime
+        self._timedTick(lane, "plate read and decision")
+        if lane.gate.state != GateState.Open:
+            # the driver backs out of the lane, e.g. the fee is not paid
+            self.report.cars["deniedAtExit"] += 1
+            lane.setSensors(False, False, False)
+            lane.tick()
+            return False
+        openedAt = self.clock()
+        for offset, levels in self.sensorTrace.steps:
+            yield max(openedAt + offset - self.clock(), 0)
+            lane.setSensors(*levels)
+            lane.tick()
+        # the barrier closes openGateTime after it opened, the passage is recorded once it is down
+        isClosed = yield from self._closeBarrier(lane)
+        lane.setSensors(False, False, False)
+        if not isClosed:
+            # the passage is never recorded, the car is taken out of the lane and does not count as entered
+            # or exited; the barrier closes once the lane is clear, before the next car drives up
+            self.report.cars["stuck"] += 1
+            yield from self._closeBarrier(lane)
+            return False
+        lane.tick()
+        return True
+
+    def _closeBarrier(self, lane):
+        # returns False when the barrier did not close within maxCloseAttempts tries
+        for _ in range(self.maxCloseAttempts):
+            if lane.gate.state == GateState.Idle:
+                return True
+            yield max(lane.barrierHandler.startTimerForBarrier + lane.barrierHandler.openGateTime - self.clock(), 0)
+            lane.tick()
+            yield self.barrierTravelTime
+            self._timedTick(lane, "passage recorded")
+        return lane.gate.state == GateState.Idle
+
+    def _payAndLeave(self, car):
+        self.report.waits["parking"].append(self.clock() - car.enteredAt)
+        start = time.perf_counter()
+        if hasattr(self.gateDb, "flush"):
+            self.gateDb.flush() # the pay station reads the database, hours after the journaled entry
+        self.parkingDb.updateParkingEndTime(car.plateNumber, self.clock.now()) # parking ends once, a declined card retries the same fee
+        while True:
+            result = self.paymentManager.pay(car.plateNumber)
+            self.report.stages["end of parking and payment"].append(time.perf_counter() - start)
+            if result.outcome in (PaymentOutcome.Approved, PaymentOutcome.AlreadyPaid):
+                break
+            self.report.cars["declinedPayments"] += 1
+            yield self.paymentRetryTime
+            start = time.perf_counter()
+        yield self.walkToExitTime
+        self._enqueue("exit", car)
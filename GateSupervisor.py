@@ -0,0 +1,257 @@
+from CameraManager import CameraManager
+from CaptureManager import VideoCaptureSource, ImageFileSource
+from PlateReadCache import PlateReadCache
+from TollBarManager import TollBarManager
+from GateController import GateController, GateType, GateState, SensorMode
+from DataBaseManager import getSharedParkingDB
+from OccupancyIndex import getSharedOccupancyIndex
+from StatisticsRollup import getSharedStatisticsRollup
+from MetricsManager import metrics, getMetricsDumpPath
+from OcrWorkerPool import OcrWorkerPool, OcrPriority
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import asyncio
+import json
+import sys
+import time
+
+class GateConfig:
+    # one lane of the parking lot, e.g. {"name": "entrance-1", "gateType": "Entrance", "sensorBeforeTollBarPort": 17,
+    # "sensorUnderTollBarPort": 18, "sensorBehindTollBarPort": 19, "barrierPort": 20, "cameraPort": 0}
+    def __init__(self, name, gateType, sensorBeforeTollBarPort, sensorUnderTollBarPort, sensorBehindTollBarPort, barrierPort,
+                 cameraPort=0, imagePaths=None, sensorMode=SensorMode.Polling, pollRate=20) -> None:
+        self.name = name
+        self.gateType = gateType
+        self.sensorBeforeTollBarPort = sensorBeforeTollBarPort
+        self.sensorUnderTollBarPort = sensorUnderTollBarPort
+        self.sensorBehindTollBarPort = sensorBehindTollBarPort
+        self.barrierPort = barrierPort
+        self.cameraPort = cameraPort
+        self.imagePaths = imagePaths # replay images instead of a camera when given
+        self.sensorMode = sensorMode
+        self.pollRate = pollRate
+
+    @classmethod
+    def fromDict(cls, config):
+        config = dict(config)
+        config["gateType"] = GateType[config["gateType"]]
+        if "sensorMode" in config:
+            config["sensorMode"] = SensorMode[config["sensorMode"]]
+        return cls(**config)
+
+    def createFrameSource(self):
+        if self.imagePaths:
+            return ImageFileSource(self.imagePaths)
+        return VideoCaptureSource(self.cameraPort)
+
+
+def loadGateConfigs(path):
+    with open(path) as configFile:
+        return [GateConfig.fromDict(config) for config in json.load(configFile)]
+
+
+class GateStats:
+    def __init__(self, historySize=256) -> None:
+        self.vehiclesServed = 0
+        self.plateReadLatencies = deque(maxlen=historySize) # time in sec
+        self.dbLatencies = deque(maxlen=historySize) # time in sec
+        self.errors = 0
+        self.lastError = None
+        self.lastHeartbeat = time.monotonic()
+
+    def _percentile(self, values, percentile):
+        if not values:
+            return None
+        values = sorted(values)
+        return values[min(len(values) - 1, int(percentile / 100 * len(values)))]
+
+    def summary(self):
+        return {"vehiclesServed": self.vehiclesServed,
+                "plateReadP50": self._percentile(self.plateReadLatencies, 50),
+                "plateReadP95": self._percentile(self.plateReadLatencies, 95),
+                "dbP50": self._percentile(self.dbLatencies, 50),
+                "dbP95": self._percentile(self.dbLatencies, 95),
+                "errors": self.errors,
+                "lastError": self.lastError}
+
+
+class AsyncParkingDB:
+    # runs blocking ParkingDB calls on a bounded thread pool shared by all gates;
+    # the SQLAlchemy connection pool behind ParkingDB is thread-safe
+    def __init__(self, parkingDb, executor) -> None:
+        self.parkingDb = parkingDb
+        self.executor = executor
+
+    async def call(self, methodName, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, getattr(self.parkingDb, methodName), *args)
+
+
+class AsyncGateController(GateController):
+    # Same state machine as GateController, with its decisions, but plate reads and database calls are
+    # awaited on shared executors, so a slow OCR or query on one lane never blocks the other lanes.
+    def __init__(self, name, gateType, cameraHandler, barrierHandler, asyncParkingDb, ocrExecutor,
+                 sensorMode=SensorMode.Polling, pollRate=20, eventClock=None) -> None:
+        super().__init__(gateType, cameraHandler, barrierHandler, asyncParkingDb.parkingDb, sensorMode, pollRate, eventClock=eventClock)
+        self.name = name
+        self.asyncParkingDb = asyncParkingDb
+        self.ocrExecutor = ocrExecutor
+        self.stats = GateStats()
+        self.loop = None
+        self.asyncWakeEvent = None
+
+    async def _callDb(self, methodName, *args):
+        start = time.perf_counter()
+        try:
+            return await self.asyncParkingDb.call(methodName, *args)
+        finally:
+            self.stats.dbLatencies.append(time.perf_counter() - start)
+
+    async def isPassageAllowedAsync(self):
+        wasFeePaid = await self._callDb("wasFeePaid", self.vehiclePlateNumber) if self._needsFeeCheck() else None
+        return self._decidePassage(wasFeePaid)
+
+    async def recordPassageAsync(self):
+        methodName, args = self._getPassageRecord()
+        await self._callDb(methodName, *args)
+        self.stats.vehiclesServed += 1
+
+    async def stepAsync(self):
+        if self.state == GateState.Idle:
+            await self._handleIdleAsync()
+        elif self.state == GateState.Denied:
+            await self._handleDeniedAsync()
+        if self.state == GateState.Open:
+            await self._handleOpenAsync()
+
+    async def _handleIdleAsync(self):
+        if not self._isVehicleWaiting():
+            return
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        plateNumber, wasPhotoTaken = await loop.run_in_executor(self.ocrExecutor, self._readPlate)
+        if not wasPhotoTaken:
+            return
+        self.stats.plateReadLatencies.append(time.perf_counter() - start)
+        self._onPlateRead(plateNumber)
+        self._onPassageDecision(await self.isPassageAllowedAsync())
+
+    async def _handleDeniedAsync(self):
+        if self._isFeeRecheckDue():
+            self._onPassageDecision(await self.isPassageAllowedAsync())
+
+    async def _handleOpenAsync(self):
+        if self._advanceBarrier():
+            if self.barrierHandler.isVehicleBehindTollBar():
+                await self.recordPassageAsync()
+            self._finishPassage()
+
+    def onSensorEdge(self, channel=None):
+        # called from the GPIO thread
+        asyncWakeEvent = self.asyncWakeEvent
+        if asyncWakeEvent is not None:
+            self.loop.call_soon_threadsafe(asyncWakeEvent.set)
+
+    async def runAsync(self):
+        self.loop = asyncio.get_running_loop()
+        self.asyncWakeEvent = asyncio.Event()
+        if self.sensorMode == SensorMode.EdgeTriggered:
+            self.barrierHandler.enableSensorEvents(self.onSensorEdge)
+        try:
+            self.barrierHandler.updateSensors()
+            while not self.stopEvent.is_set():
+                try:
+                    await self.stepAsync()
+                except Exception as error:
+                    # keep the lane alive, the failure shows up in the gate health
+                    self.stats.errors += 1
+                    self.stats.lastError = repr(error)
+                    self.state = GateState.Idle
+                self.stats.lastHeartbeat = time.monotonic()
+                try:
+                    await asyncio.wait_for(self.asyncWakeEvent.wait(), self._getWaitTime())
+                except asyncio.TimeoutError:
+                    pass
+                self.asyncWakeEvent.clear()
+                self.barrierHandler.updateSensors()
+        finally:
+            self.asyncWakeEvent = None
+            if self.sensorMode == SensorMode.EdgeTriggered:
+                self.barrierHandler.disableSensorEvents()
+
+    def stop(self):
+        self.stopEvent.set()
+        self.onSensorEdge()
+
+
+class GateSupervisor:
+    # runs any number of entrance and exit gates in one process on a single asyncio loop
+    def __init__(self, gateConfigs, parkingDb=None, ocrWorkers=2, dbWorkers=4, ocrProcesses=0) -> None:
+        # gates talk to the in-memory occupancy index of the shared database unless a parkingDb is given
+        if parkingDb is None:
+            getSharedStatisticsRollup(getSharedParkingDB()) # hourly and daily statistics follow the gate events
+            parkingDb = getSharedOccupancyIndex(getSharedParkingDB())
+        self.parkingDb = parkingDb
+        # with ocrProcesses the threads only take photos and locate plates, OCR runs in a pool of worker processes
+        self.ocrPool = OcrWorkerPool(['pl', 'en'], ocrProcesses) if ocrProcesses else None
+        self.ocrExecutor = ThreadPoolExecutor(max_workers=ocrWorkers, thread_name_prefix="ocr")
+        self.dbExecutor = ThreadPoolExecutor(max_workers=dbWorkers, thread_name_prefix="db")
+        self.asyncParkingDb = AsyncParkingDB(self.parkingDb, self.dbExecutor)
+        self.gates = [self.createGate(config) for config in gateConfigs]
+
+    def createGate(self, config):
+        cameraHandler = CameraManager(['pl', 'en'], frameSource=config.createFrameSource(), plateReadCache=PlateReadCache(),
+                                      ocrPool=self.ocrPool)
+        cameraHandler.ocrPriority = OcrPriority.ExitGate if config.gateType == GateType.Exit else OcrPriority.EntranceGate
+        barrierHandler = TollBarManager(config.sensorBeforeTollBarPort, config.sensorUnderTollBarPort,
+                                        config.sensorBehindTollBarPort, config.barrierPort)
+        return AsyncGateController(config.name, config.gateType, cameraHandler, barrierHandler, self.asyncParkingDb,
+                                   self.ocrExecutor, config.sensorMode, config.pollRate)
+
+    def getGate(self, name):
+        for gate in self.gates:
+            if gate.name == name:
+                return gate
+        return None
+
+    def getHealth(self, maxHeartbeatAge=5.0):
+        health = {}
+        now = time.monotonic()
+        for gate in self.gates:
+            gateHealth = gate.stats.summary()
+            gateHealth["state"] = gate.state.name
+            gateHealth["healthy"] = now - gate.stats.lastHeartbeat <= maxHeartbeatAge
+            health[gate.name] = gateHealth
+        return health
+
+    async def run(self):
+        if self.gates:
+            # load the OCR model once before the first car, without blocking the loop
+            await asyncio.get_running_loop().run_in_executor(self.ocrExecutor, self.gates[0].cameraHandler.warmUpOcr)
+        await asyncio.gather(*(gate.runAsync() for gate in self.gates))
+
+    def stop(self):
+        for gate in self.gates:
+            gate.stop()
+
+    def close(self):
+        self.stop()
+        for gate in self.gates:
+            gate.cameraHandler.closeCapture()
+        self.ocrExecutor.shutdown(wait=True)
+        if self.ocrPool is not None:
+            self.ocrPool.close()
+        self.dbExecutor.shutdown(wait=True)
+        if hasattr(self.parkingDb, "flush"):
+            self.parkingDb.flush(timeout=10) # events not persisted by then stay in the journal
+
+
+if __name__ == "__main__":
+    # python GateSupervisor.py gates.json [OCR worker processes]
+    supervisor = GateSupervisor(loadGateConfigs(sys.argv[1]), ocrProcesses=int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    metrics.startDumping(getMetricsDumpPath("gate_supervisor"))
+    try:
+        asyncio.run(supervisor.run())
+    finally:
+        supervisor.close()
+        metrics.stopDumping()
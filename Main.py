@@ -1,37 +1,112 @@
-import AutomatedParkingSystem
-from AutomatedParkingSystem import max_capacity
+from ParkingLotConfig import max_capacity # not AutomatedParkingSystem, the web app does not load the vision stack
 from DataBaseManager import *
-import pandas as pd
+from OccupancyCache import OccupancyCache
+from MetricsManager import metrics
+from datetime import timedelta
 #Flask
-from flask import Flask, jsonify, render_template
-import numpy as np
+from flask import Flask, jsonify, render_template, stream_template, request, make_response, url_for
 
 app = Flask(__name__)
-database = ParkingDB()
+database = getSharedParkingDB()
+# pages are served from memory, the database is read at most once per ttl
+occupancyCache = OccupancyCache(database, max_capacity, ttl=5.0)
 
-def getOccupancyData():
-    currently_parked = database.getNumberOfCarsInAParkingLot()
-    free = max_capacity - currently_parked
-    occupancy_percentage = currently_parked / max_capacity * 100
+def isNotModified(snapshot):
+    # conditional GET: the client already has this version of the data
+    if request.if_none_match:
+        return request.if_none_match.contains(snapshot.etag)
+    return request.if_modified_since is not None and snapshot.lastModified <= request.if_modified_since
 
-    return currently_parked, free, occupancy_percentage
+def conditionalResponse(snapshot, render):
+    if request.method == "GET" and isNotModified(snapshot):
+        response = make_response("", 304)
+    else:
+        response = make_response(render())
+    response.set_etag(snapshot.etag)
+    response.last_modified = snapshot.lastModified
+    response.cache_control.no_cache = True # clients revalidate on every poll
+    return response
     
 
 @app.route("/", methods=("POST", "GET"))
 def home_screen():
-    parked, free, percentage = getOccupancyData()
-    return render_template("home.html", parked=parked, free=free, percentage=percentage)
+    snapshot = occupancyCache.getSnapshot()
+    return conditionalResponse(snapshot, lambda: render_template("home.html", parked=snapshot.parked, free=snapshot.free,
+                                                                 percentage=snapshot.percentage))
+
+stats_sort_columns = {"entrance": "Entrance_time", "plate": "Registration_number"}
+stats_page_size = 50
+stats_max_page_size = 500
+
+def encodePageKey(row, sort):
+    # keyset cursor of the next page: sort value and ID of the last row shown
+    sortValue = row.Entrance_time.isoformat() if sort == "entrance" else row.Registration_number
+    return f"{row.ID}:{sortValue}"
+
+def decodePageKey(after, sort):
+    id, sortValue = after.split(":", 1)
+    return (datetime.fromisoformat(sortValue) if sort == "entrance" else sortValue), int(id)
 
 @app.route("/stats", methods=("POST", "GET"))
 def show_stats():
-    parked, free, percentage = getOccupancyData()
-    mapper_results, column_names = database.getParkedCarsTable()
-    df = pd.DataFrame.from_records(mapper_results)
-    if len(df) > 0:
-        df.columns = column_names
-    return render_template("stats.html", table_html=[df.to_html(classes='data', header='true')], 
-                           last_refresh_time=datetime.now().replace(microsecond=0),
-                           parked=parked, free=free, percentage=percentage)
+    snapshot = occupancyCache.getSnapshot()
+    sort = request.args.get("sort", "entrance")
+    sort = sort if sort in stats_sort_columns else "entrance"
+    descending = request.args.get("order") == "desc"
+    search = request.args.get("search", "").strip()
+    limit = min(max(request.args.get("limit", stats_page_size, type=int), 1), stats_max_page_size)
+    after = request.args.get("after")
+
+    def render():
+        try:
+            pageKey = decodePageKey(after, sort) if after else None
+        except ValueError:
+            pageKey = None # malformed cursor, start from the first page
+        rows = database.getParkedCarsPage(limit, pageKey, stats_sort_columns[sort], descending, search)
+        nextPageUrl = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            nextPageUrl = url_for("show_stats", sort=sort, order="desc" if descending else "asc", search=search or None,
+                                  limit=limit, after=encodePageKey(rows[-1], sort))
+        # the page is sent while it is rendered, the table is never built as one string
+        return stream_template("stats.html", rows=rows, next_page_url=nextPageUrl, sort=sort, descending=descending,
+                               search=search, limit=limit,
+                               last_refresh_time=snapshot.lastModified.astimezone().replace(tzinfo=None),
+                               parked=snapshot.parked, free=snapshot.free, percentage=snapshot.percentage)
+    return conditionalResponse(snapshot, render)
+
+def getStatisticsRange():
+    # ?granularity=hour|day&start=2024-01-01&end=2024-02-01, by default the last 30 days
+    granularity = StatisticsGranularity(request.args.get("granularity", "day"))
+    end = datetime.fromisoformat(request.args["end"]) if "end" in request.args else datetime.now()
+    start = datetime.fromisoformat(request.args["start"]) if "start" in request.args else end - timedelta(days=30)
+    return granularity, start, end
+
+@app.route("/history", methods=("GET",))
+def show_history():
+    granularity, start, end = getStatisticsRange()
+    statistics = database.getStatistics(granularity, start, end)
+    max_entries = max([period["entries"] for period in statistics] + [1])
+    return render_template("history.html", statistics=statistics, granularity=granularity.value, max_entries=max_entries)
+
+@app.route("/api/statistics", methods=("GET",))
+def statistics_json():
+    try:
+        granularity, start, end = getStatisticsRange()
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    return jsonify([dict(period, periodStart=period["periodStart"].isoformat())
+                    for period in database.getStatistics(granularity, start, end)])
+
+@app.route("/api/occupancy", methods=("GET",))
+def occupancy_json():
+    snapshot = occupancyCache.getSnapshot()
+    return conditionalResponse(snapshot, lambda: jsonify(snapshot.toDict()))
+
+@app.route("/metrics", methods=("GET",))
+def metrics_exposition():
+    # Prometheus text format, the metrics of this process (web app and its database calls)
+    return metrics.exposition(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
 
 if __name__ == "__main__":
     print("Automated Parking System")
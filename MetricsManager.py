@@ -0,0 +1,208 @@
+from bisect import bisect_left
+import functools
+import threading
+import time
+import os
+
+# upper bounds in sec, from a cached plate read to a slow OCR or a barrier movement
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _formatLabels(labelNames, labelValues, extra=""):
+    labels = ",".join('{0}="{1}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                      for name, value in zip(labelNames, labelValues))
+    labels = ",".join(part for part in (labels, extra) if part)
+    return "{" + labels + "}" if labels else ""
+
+def _formatValue(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, registry, name, help, labelNames=()) -> None:
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.lock = threading.Lock()
+        self.values = {} # label values -> count
+
+    def inc(self, *labelValues, amount=1):
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def get(self, *labelValues):
+        return self.values.get(labelValues, 0)
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = sorted(self.values.items())
+        for labelValues, value in values:
+            lines.append(f"{self.name}{_formatLabels(self.labelNames, labelValues)} {_formatValue(value)}")
+        return lines
+
+
+class Timer:
+    __slots__ = ("histogram", "labelValues", "start")
+
+    def __init__(self, histogram, labelValues) -> None:
+        self.histogram = histogram
+        self.labelValues = labelValues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labelValues)
+
+
+class NullTimer:
+    # returned while metrics are switched off, costs one method call
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        pass
+
+null_timer = NullTimer()
+
+
+class Histogram:
+    def __init__(self, registry, name, help, labelNames=(), buckets=latency_buckets) -> None:
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.series = {} # label values -> [count per bucket..., count above the last bucket, sum]
+
+    def observe(self, value, *labelValues):
+        if not self.registry.enabled:
+            return
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labelValues)
+            if series is None:
+                series = self.series[labelValues] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bucket] += 1
+            series[-1] += value
+
+    def time(self, *labelValues):
+        # with histogram.time("ocr"): ...
+        return Timer(self, labelValues) if self.registry.enabled else null_timer
+
+    def getCount(self, *labelValues):
+        series = self.series.get(labelValues)
+        return sum(series[:-1]) if series is not None else 0
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = sorted((labelValues, list(values)) for labelValues, values in self.series.items())
+        for labelValues, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values[:-1]):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_formatLabels(self.labelNames, labelValues, le)} {cumulative}")
+            labels = _formatLabels(self.labelNames, labelValues)
+            lines.append(f"{self.name}_sum{labels} {_formatValue(values[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    # Counters and latency histograms of one process, exposed in the Prometheus text format. Recording costs
+    # a dict lookup and a short lock, so it stays on in production; setEnabled(False) turns every metric into
+    # a no-op (PARKING_METRICS=off does it at startup).
+    def __init__(self, enabled=True) -> None:
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.dumpThread = None
+        self.dumpStopEvent = threading.Event()
+
+    def setEnabled(self, enabled):
+        self.enabled = enabled
+
+    def _getOrCreate(self, metricType, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metricType(self, name, *args, **kwargs)
+            elif not isinstance(metric, metricType):
+                raise ValueError(f"metric {name} already registered as {type(metric).__name__}")
+            return metric
+
+    def counter(self, name, help, labelNames=()):
+        return self._getOrCreate(Counter, name, help, labelNames)
+
+    def histogram(self, name, help, labelNames=(), buckets=latency_buckets):
+        return self._getOrCreate(Histogram, name, help, labelNames, buckets)
+
+    def exposition(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.exposition())
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        # written to a temporary file and renamed, a reader (e.g. the node_exporter textfile collector) never sees half a file
+        temporaryPath = path + ".tmp"
+        with open(temporaryPath, "w") as dumpFile:
+            dumpFile.write(self.exposition())
+        os.replace(temporaryPath, path)
+
+    def startDumping(self, path, interval=15.0):
+        # dumps the metrics every interval sec from a background thread and once more when stopped
+        self.stopDumping()
+        self.dumpStopEvent.clear()
+
+        def runDumper():
+            while not self.dumpStopEvent.wait(interval):
+                try:
+                    self.dump(path)
+                except OSError as error:
+                    print(f"Could not write metrics: {error!r}")
+            self.dump(path)
+        self.dumpThread = threading.Thread(target=runDumper, name="metrics-dump", daemon=True)
+        self.dumpThread.start()
+
+    def stopDumping(self):
+        if self.dumpThread is not None:
+            self.dumpStopEvent.set()
+            self.dumpThread.join()
+            self.dumpThread = None
+
+
+def timed(histogram, *labelValues, errors=None):
+    # decorator recording the duration of every call, and the failed calls in the errors counter
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not histogram.registry.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(*labelValues)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start, *labelValues)
+        return wrapper
+    return decorator
+
+def getMetricsDumpPath(processName):
+    # set the PARKING_METRICS_DIR environment variable to move the dump files
+    return os.path.join(os.environ.get("PARKING_METRICS_DIR", "."), f"metrics_{processName}.prom")
+
+
+metrics = MetricsRegistry(enabled=os.environ.get("PARKING_METRICS", "on") != "off") # process-wide registry
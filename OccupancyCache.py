@@ -0,0 +1,67 @@
+from DataBaseManager import ParkingEventType
+from datetime import datetime, timezone
+import threading
+import zlib
+import time
+
+class OccupancySnapshot:
+    # read-only view served to the web pages, a new snapshot is made on every change
+    def __init__(self, parked, maxCapacity, version, lastModified) -> None:
+        self.parked = parked # cars inside the parking lot
+        self.free = maxCapacity - self.parked
+        self.percentage = self.parked / maxCapacity * 100
+        self.version = version # changes whenever a car enters or exits
+        self.lastModified = lastModified
+        self.etag = format(version, "08x")
+
+    def toDict(self):
+        return {"parked": self.parked, "free": self.free, "percentage": self.percentage,
+                "lastModified": self.lastModified.isoformat()}
+
+
+class OccupancyCache:
+    # Occupancy of the parking lot for the Flask pages. Gate events of this process update it incrementally;
+    # the database is re-read at most once per ttl to pick up gates running in other processes.
+    def __init__(self, parkingDb, maxCapacity, ttl=5.0, clock=time.monotonic) -> None:
+        self.parkingDb = parkingDb
+        self.maxCapacity = maxCapacity
+        self.ttl = ttl # time in sec
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.fingerprint = None
+        self.loadedAt = None
+        self.reloads = 0
+        self.parkingDb.addEventListener(self.onDatabaseEvent)
+
+    def close(self):
+        self.parkingDb.removeEventListener(self.onDatabaseEvent)
+
+    def _currentTime(self):
+        # HTTP dates have a resolution of one second
+        return datetime.now(timezone.utc).replace(microsecond=0)
+
+    def _reload(self):
+        fingerprint = self.parkingDb.getOpenSessionsFingerprint()
+        if fingerprint != self.fingerprint:
+            # same open sessions give the same ETag in every web server process
+            self.fingerprint = fingerprint
+            self.snapshot = OccupancySnapshot(fingerprint[0], self.maxCapacity, zlib.crc32(repr(fingerprint).encode()),
+                                              self._currentTime())
+        self.loadedAt = self.clock()
+        self.reloads += 1
+
+    def getSnapshot(self):
+        with self.lock:
+            if self.snapshot is None or self.clock() - self.loadedAt >= self.ttl:
+                self._reload()
+            return self.snapshot
+
+    def onDatabaseEvent(self, eventType, registration, eventTime, **details):
+        # only entries and exits change the cars inside
+        with self.lock:
+            if self.snapshot is None or eventType not in (ParkingEventType.Entry, ParkingEventType.Exit):
+                return
+            parked = self.snapshot.parked + (1 if eventType == ParkingEventType.Entry else -1)
+            version = zlib.crc32(f"{eventType.name} {registration} {eventTime}".encode(), self.snapshot.version)
+            self.snapshot = OccupancySnapshot(parked, self.maxCapacity, version, self._currentTime())
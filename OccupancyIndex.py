@@ -0,0 +1,175 @@
+from DataBaseManager import ParkingEventType
+from GateEventJournal import GateEventJournal, getJournalPath, getJournalPaths
+from datetime import datetime
+import threading
+import atexit
+
+class ParkingSession:
+    def __init__(self, registration, entranceTime, endTime=None, isPaid=False, fee=None) -> None:
+        self.registration = registration
+        self.entranceTime = entranceTime
+        self.endTime = endTime
+        self.isPaid = isPaid
+        self.fee = fee
+
+    def __repr__(self):
+        return "<ParkingSession(Registration_number={0}, Entrance_time={1}, End_time={2}, IsPaid={3}, Fee={4})>".format(
+            self.registration, self.entranceTime, self.endTime, self.isPaid, self.fee)
+
+
+class OccupancyIndex:
+    # In-memory index of open parking sessions keyed by plate. Gate decisions are answered from memory in O(1);
+    # writes update memory first and are appended to a GateEventJournal, which persists them to ParkingDB in batches.
+    # Writes made directly through ParkingDB (pay stations, other tools) reach the index through its event listener;
+    # writes of other processes are not seen, an exit check that finds the car unpaid or unknown asks the database.
+    def __init__(self, parkingDb, journal=None) -> None:
+        self.parkingDb = parkingDb
+        self.journal = journal if journal is not None else GateEventJournal(parkingDb)
+        self.sessions = {}
+        self.lock = threading.RLock()
+        self.rebuild()
+        self.parkingDb.addEventListener(self.onDatabaseEvent)
+
+    def rebuild(self):
+        # open sessions of the database plus the journaled events that have not reached it yet
+        # (read first, an event persisted meanwhile is applied twice, which changes nothing)
+        pendingEvents = self.journal.getPendingEvents()
+        sessions = {}
+        for registration, entranceTime, endTime, isPaid, fee in self.parkingDb.getOpenSessions():
+            sessions[registration] = ParkingSession(registration, entranceTime, endTime, bool(isPaid), fee)
+        with self.lock:
+            self.sessions = sessions
+            for gateEvent in pendingEvents:
+                self._apply(gateEvent.eventType, gateEvent.registration, gateEvent.eventTime, **gateEvent.details)
+
+    def close(self):
+        self.parkingDb.removeEventListener(self.onDatabaseEvent)
+        self.journal.close()
+
+    def flush(self, timeout=None):
+        # waits until every write accepted so far is in the database
+        return self.journal.flush(timeout)
+
+    def onDatabaseEvent(self, eventType, registration, eventTime, journaled=False, **details):
+        if journaled:
+            return # written by the journal, memory was updated before the event was journaled
+        self._apply(eventType, registration, eventTime, **details)
+
+    def _apply(self, eventType, registration, eventTime, **details):
+        with self.lock:
+            session = self.sessions.get(registration)
+            if eventType == ParkingEventType.Entry:
+                if session is None:
+                    self.sessions[registration] = ParkingSession(registration, eventTime)
+            elif session is None:
+                return
+            elif eventType == ParkingEventType.End:
+                session.endTime = eventTime
+                session.fee = details["fee"]
+            elif eventType == ParkingEventType.Payment:
+                session.isPaid = details.get("paid", True)
+            elif eventType == ParkingEventType.Exit:
+                del self.sessions[registration]
+            elif eventType == ParkingEventType.FeeChange and session.endTime == eventTime:
+                session.fee = details["fee"]
+
+    def _record(self, eventType, registration, eventTime, **details):
+        # the journal keeps the same order of events as memory
+        self._apply(eventType, registration, eventTime, **details)
+        self.journal.append(eventType, registration, eventTime, **details)
+
+    # ---- gate decisions, answered from memory ----
+    def isCarParked(self, registration):
+        return registration in self.sessions
+
+    def wasFeePaid(self, registration):
+        session = self.sessions.get(registration)
+        if session is None or not session.isPaid:
+            # paid at a pay station of another process or entered through a gate of another process
+            session = self.refreshSession(registration)
+        if session is None:
+            print("W bazie nie istnieje dany numer")
+            return None
+        return session.isPaid
+
+    def refreshSession(self, registration):
+        # merges the open session of the database into memory; memory may be ahead of the database
+        # (events still in the journal), so a session is only added or marked paid, never rolled back
+        openSession = self.parkingDb.getOpenSession(registration)
+        with self.lock:
+            session = self.sessions.get(registration)
+            if openSession is None:
+                return session
+            _, entranceTime, endTime, isPaid, fee = openSession
+            if session is None:
+                if any(gateEvent.registration == registration for gateEvent in self.journal.getPendingEvents()):
+                    return None # left through this process, the exit has not reached the database yet
+                session = self.sessions[registration] = ParkingSession(registration, entranceTime, endTime, bool(isPaid), fee)
+            elif isPaid and not session.isPaid:
+                session.isPaid = True
+                if session.endTime is None:
+                    session.endTime, session.fee = endTime, fee
+            return session
+
+    def getFee(self, registration):
+        session = self.sessions.get(registration)
+        return session.fee if session is not None else None
+
+    def getSession(self, registration):
+        return self.sessions.get(registration)
+
+    def getNumberOfCarsInAParkingLot(self):
+        return len(self.sessions)
+
+    # ---- gate writes, memory first then journaled ----
+    def addCarEntryRecord(self, registration, entranceTime=None):
+        with self.lock:
+            if registration in self.sessions:
+                print("Car with given registration number is already parked!")
+                return None
+            self._record(ParkingEventType.Entry, registration, entranceTime or datetime.now().replace(microsecond=0))
+
+    def updateParkingEndTime(self, registration, endTime=None):
+        with self.lock:
+            session = self.sessions.get(registration)
+            if session is None:
+                print("W bazie nie istnieje dany numer")
+                return None
+            if session.endTime is not None:
+                print("Parking of the car has already ended")
+                return None
+            endTime = endTime or datetime.now().replace(microsecond=0)
+            minutes = self.parkingDb.tariff.calculateDuration(session.entranceTime, endTime)
+            fee = self.parkingDb.calculateSessionFee(registration, session.entranceTime, endTime)
+            self._record(ParkingEventType.End, registration, endTime, minutes=minutes, fee=fee)
+
+    def updatePaymentStatus(self, registration, paid=True, paymentTime=None):
+        with self.lock:
+            if registration not in self.sessions:
+                print("W bazie nie istnieje dany numer")
+                return None
+            self._record(ParkingEventType.Payment, registration, paymentTime or datetime.now().replace(microsecond=0), paid=paid)
+
+    def releaseCarFromDb(self, registration, exitTime=None):
+        with self.lock:
+            if registration not in self.sessions:
+                print("W bazie nie istnieje dany numer")
+                return None
+            self._record(ParkingEventType.Exit, registration, exitTime or datetime.now().replace(microsecond=0))
+
+
+shared_occupancy_indexes = {}
+shared_occupancy_indexes_lock = threading.Lock()
+
+def getSharedOccupancyIndex(parkingDb):
+    # one index per ParkingDB, so every gate of the process sees the same open sessions;
+    # every process writes its own journal and replays the ones left behind by crashed processes
+    with shared_occupancy_indexes_lock:
+        occupancyIndex = shared_occupancy_indexes.get(parkingDb)
+        if occupancyIndex is None:
+            journal = GateEventJournal(parkingDb, getJournalPath(parkingDb.db_string))
+            journal.adoptOrphanedJournals(getJournalPaths(parkingDb.db_string)) # events of crashed gate processes
+            occupancyIndex = OccupancyIndex(parkingDb, journal)
+            atexit.register(occupancyIndex.close) # persist the journaled events on a clean shutdown
+            shared_occupancy_indexes[parkingDb] = occupancyIndex
+        return occupancyIndex
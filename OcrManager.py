@@ -0,0 +1,60 @@
+import threading
+import time
+import zlib
+
+class OcrModelCache:
+    # Loading easyocr detection and recognition models from disk takes seconds,
+    # so readers are built once per language list and shared by every CameraManager in the process.
+    def __init__(self, downloadEnabled=True) -> None:
+        self.downloadEnabled = downloadEnabled # False fails on missing models instead of downloading them
+        self.readers = {}
+        self.lock = threading.Lock()
+
+    def _key(self, ocrLanguages):
+        return tuple(ocrLanguages)
+
+    def isLoaded(self, ocrLanguages):
+        return self._key(ocrLanguages) in self.readers
+
+    def getReader(self, ocrLanguages):
+        key = self._key(ocrLanguages)
+        reader = self.readers.get(key)
+        if reader is not None:
+            return reader
+        with self.lock:
+            # another thread could have loaded the model while we were waiting for the lock
+            if key not in self.readers:
+                import easyocr # loads torch, imported on the first read or warm-up instead of at startup
+                self.readers[key] = easyocr.Reader(list(key), download_enabled=self.downloadEnabled)
+            return self.readers[key]
+
+    def warmUp(self, ocrLanguages):
+        self.getReader(ocrLanguages)
+
+    def release(self, ocrLanguages=None):
+        with self.lock:
+            if ocrLanguages is None:
+                self.readers.clear()
+            else:
+                self.readers.pop(self._key(ocrLanguages), None)
+
+
+class SimulatedOcrReader:
+    # stands in for easyocr.Reader in tests and benchmarks without the OCR models: keeps the CPU busy for cpuTime sec
+    # holding the GIL, as the inference does, and "reads" a checksum of the exact pixels it was given
+    def __init__(self, cpuTime=0.0, confidence=0.9) -> None:
+        self.cpuTime = cpuTime
+        self.confidence = confidence
+
+    def readtext(self, image):
+        deadline = time.thread_time() + self.cpuTime # CPU time of this thread, threads waiting for the GIL do not advance it
+        while time.thread_time() < deadline:
+            pass
+        height, width = image.shape[:2]
+        return [([[0, 0], [width, 0], [width, height], [0, height]], simulatedPlateText(image), self.confidence)]
+
+def simulatedPlateText(image):
+    return f"{zlib.crc32(image.tobytes()):08X}"
+
+
+ocrModelCache = OcrModelCache() # process-wide cache shared by all gates
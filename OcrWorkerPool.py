@@ -0,0 +1,275 @@
+from OcrManager import OcrModelCache
+from MetricsManager import metrics
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from multiprocessing import shared_memory
+from enum import Enum
+import multiprocessing
+import itertools
+import threading
+import heapq
+import queue
+import time
+import os
+import numpy as np
+
+ocr_queue_wait_seconds = metrics.histogram("ocr_pool_queue_wait_seconds", "Time OCR requests wait for a worker", ("priority",))
+ocr_requests = metrics.counter("ocr_pool_requests_total", "OCR pool requests by result", ("priority", "result"))
+
+class OcrPriority(Enum):
+    ExitGate = 0 # a car waits at the exit barrier and blocks the lane, served first
+    EntranceGate = 1
+    Archive = 2 # reprocessing of stored snapshots, only gets the workers the gates leave idle
+
+class OcrUnavailable(Exception):
+    # the pool could not read the plate: queue full, timed out, worker failed or pool closed
+    pass
+
+
+def _runOcrWorker(workerIndex, ocrLanguages, slotName, readerFactory, downloadEnabled, taskQueue, resultQueue):
+    slot = shared_memory.SharedMemory(name=slotName) # spawned workers share the resource tracker of the pool, which unlinks the slot
+    try:
+        reader = readerFactory() if readerFactory is not None else OcrModelCache(downloadEnabled).getReader(ocrLanguages)
+    except Exception as error:
+        resultQueue.put(("failed", workerIndex, None, repr(error)))
+        slot.close()
+        return
+    resultQueue.put(("ready", workerIndex, None, os.getpid()))
+    for requestId, shape, dtype in iter(taskQueue.get, None):
+        plateImage = np.ndarray(shape, dtype, buffer=slot.buf)
+        try:
+            ocrResult = [([[float(x), float(y)] for x, y in box], text, float(confidence))
+                         for box, text, confidence in reader.readtext(plateImage)]
+            resultQueue.put(("result", workerIndex, requestId, ocrResult))
+        except Exception as error:
+            resultQueue.put(("error", workerIndex, requestId, repr(error)))
+        del plateImage # no view of the slot may outlive it
+    slot.close()
+
+
+class OcrRequest:
+    def __init__(self, requestId, plateImage, priority, deadline) -> None:
+        self.requestId = requestId
+        self.plateImage = plateImage
+        self.priority = priority
+        self.deadline = deadline # time.monotonic() after which the request is not sent to a worker, None waits forever
+        self.submitTime = time.monotonic()
+        self.future = Future()
+
+
+class OcrWorker:
+    def __init__(self, index, slot) -> None:
+        self.index = index
+        self.slot = slot # shared memory the crop is copied into, only its shape goes through the pipe
+        self.process = None
+        self.taskQueue = None
+        self.request = None # request being read
+        self.isReady = False # model loaded
+        self.pid = None
+
+
+class OcrWorkerPool:
+    # Reads plate crops in worker processes, each with its own preloaded model, so lanes of one process no longer
+    # wait for each other's inference behind the GIL. Requests wait in a bounded priority queue, exit gates first
+    # and archive reprocessing last; archive requests may fill only part of the queue so a gate always gets in.
+    # A gate never blocks on the queue: a full queue, a timeout or a dead worker raises OcrUnavailable and the
+    # gate falls back to its own path (see CameraManager.ocrFallback). Dead workers are restarted.
+    def __init__(self, ocrLanguages, workers=2, maxQueueSize=32, slotSize=4 << 20, readerFactory=None, downloadEnabled=True) -> None:
+        self.ocrLanguages = list(ocrLanguages)
+        self.maxQueueSize = maxQueueSize
+        self.reservedForGates = max(1, maxQueueSize // 4) # queue places archive requests cannot take
+        self.slotSize = slotSize # bytes, largest crop a worker accepts
+        self.readerFactory = readerFactory # picklable callable returning a reader, easyocr.Reader of ocrLanguages by default
+        self.downloadEnabled = downloadEnabled
+        self.healthCheckInterval = 0.5 # time in sec between checks for dead workers
+        self.context = multiprocessing.get_context("spawn") # a fork would copy the torch threads of this process
+        self.condition = threading.Condition()
+        self.queue = [] # heap of (priority, request id, request)
+        self.requestIds = itertools.count()
+        self.resultQueue = self.context.Queue()
+        self.workers = [OcrWorker(index, shared_memory.SharedMemory(create=True, size=slotSize)) for index in range(workers)]
+        self.stats = {"ok": 0, "timeout": 0, "rejected": 0, "failed": 0, "restarts": 0}
+        self.startError = None
+        self.isStarted = False
+        self.isClosed = False
+        self.dispatcher = None
+        self.collector = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def _startWorker(self, worker):
+        worker.isReady = False
+        worker.taskQueue = self.context.Queue()
+        worker.process = self.context.Process(target=_runOcrWorker, name=f"ocr-worker-{worker.index}", daemon=True,
+                                              args=(worker.index, self.ocrLanguages, worker.slot.name, self.readerFactory,
+                                                    self.downloadEnabled, worker.taskQueue, self.resultQueue))
+        worker.process.start()
+
+    def start(self, timeout=120.0):
+        # starts the workers and waits until every one of them has loaded its model
+        with self.condition:
+            if not self.isStarted:
+                self.isStarted = True
+                for worker in self.workers:
+                    self._startWorker(worker)
+                self.collector = threading.Thread(target=self._collectResults, name="ocr-pool-results", daemon=True)
+                self.dispatcher = threading.Thread(target=self._dispatchRequests, name="ocr-pool-dispatch", daemon=True)
+                self.collector.start()
+                self.dispatcher.start()
+            deadline = time.monotonic() + timeout
+            while not all(worker.isReady for worker in self.workers):
+                if self.startError is not None:
+                    raise OcrUnavailable(f"OCR worker could not load the model: {self.startError}")
+                if self.isClosed or time.monotonic() >= deadline:
+                    raise OcrUnavailable("OCR workers did not start in time")
+                self.condition.wait(deadline - time.monotonic())
+        return self
+
+    def _finish(self, request, result, ocrResult=None, error=None):
+        self.stats[result] += 1
+        ocr_requests.inc(request.priority.name, result)
+        if error is not None:
+            request.future.set_exception(error)
+        else:
+            request.future.set_result(ocrResult)
+
+    def _purgeCancelled(self):
+        self.queue = [entry for entry in self.queue if not entry[2].future.cancelled()]
+        heapq.heapify(self.queue)
+
+    def submit(self, plateImage, priority=OcrPriority.EntranceGate, timeout=None, block=False):
+        # returns a Future of the readtext result; block=True waits for room in the queue (archive jobs), gates never wait
+        if plateImage.nbytes > self.slotSize:
+            raise ValueError(f"plate image of {plateImage.nbytes} bytes does not fit the {self.slotSize} bytes OCR slot")
+        limit = self.maxQueueSize - self.reservedForGates if priority == OcrPriority.Archive else self.maxQueueSize
+        with self.condition:
+            request = OcrRequest(next(self.requestIds), plateImage, priority, time.monotonic() + timeout if timeout is not None else None)
+            if len(self.queue) >= limit:
+                self._purgeCancelled()
+            while len(self.queue) >= limit and block and not self.isClosed:
+                self.condition.wait()
+            if self.isClosed:
+                raise OcrUnavailable("OCR pool is closed")
+            if len(self.queue) >= limit:
+                self.stats["rejected"] += 1
+                ocr_requests.inc(priority.name, "rejected")
+                raise OcrUnavailable("OCR queue is full")
+            heapq.heappush(self.queue, (priority.value, request.requestId, request))
+            self.condition.notify_all()
+        return request.future
+
+    def readtext(self, plateImage, priority=OcrPriority.EntranceGate, timeout=None):
+        # same result as easyocr.Reader.readtext, raises OcrUnavailable instead of waiting longer than timeout sec
+        future = self.submit(plateImage, priority, timeout)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel() # still queued: never sent to a worker; already being read: the late result is dropped
+            with self.condition:
+                self.stats["timeout"] += 1
+            ocr_requests.inc(priority.name, "timeout")
+            raise OcrUnavailable("OCR request timed out")
+
+    def _getIdleWorker(self):
+        for worker in self.workers:
+            if worker.isReady and worker.request is None:
+                return worker
+        return None
+
+    def _dispatchRequests(self):
+        with self.condition:
+            while not self.isClosed:
+                worker = self._getIdleWorker()
+                if worker is None or not self.queue:
+                    self.condition.wait()
+                    continue
+                _, _, request = heapq.heappop(self.queue)
+                self.condition.notify_all() # room for a blocked submitter
+                if not request.future.set_running_or_notify_cancel():
+                    continue # the caller gave up while it waited
+                now = time.monotonic()
+                if request.deadline is not None and now > request.deadline:
+                    self._finish(request, "timeout", error=OcrUnavailable("OCR request expired in the queue"))
+                    continue
+                ocr_queue_wait_seconds.observe(now - request.submitTime, request.priority.name)
+                plateImage = request.plateImage
+                np.ndarray(plateImage.shape, plateImage.dtype, buffer=worker.slot.buf)[...] = plateImage
+                worker.request = request
+                worker.taskQueue.put((request.requestId, plateImage.shape, plateImage.dtype.str))
+
+    def _collectResults(self):
+        while True:
+            try:
+                kind, workerIndex, requestId, payload = self.resultQueue.get(timeout=self.healthCheckInterval)
+            except queue.Empty:
+                kind = None
+            if kind == "stop":
+                return
+            with self.condition:
+                if kind is not None:
+                    self._handleMessage(kind, self.workers[workerIndex], requestId, payload)
+                self._restartDeadWorkers()
+                self.condition.notify_all()
+
+    def _handleMessage(self, kind, worker, requestId, payload):
+        if kind == "ready":
+            worker.isReady = True
+            worker.pid = payload
+        elif kind == "failed":
+            self.startError = payload
+        elif worker.request is not None and worker.request.requestId == requestId:
+            request, worker.request = worker.request, None
+            if kind == "result":
+                self._finish(request, "ok", ocrResult=payload)
+            else:
+                self._finish(request, "failed", error=OcrUnavailable(f"OCR failed: {payload}"))
+
+    def _restartDeadWorkers(self):
+        for worker in self.workers:
+            if self.isClosed or self.startError is not None or worker.process is None or worker.process.is_alive():
+                continue
+            request, worker.request = worker.request, None
+            if request is not None:
+                self._finish(request, "failed", error=OcrUnavailable("OCR worker died"))
+            self.stats["restarts"] += 1
+            print(f"OCR worker {worker.index} died with exit code {worker.process.exitcode}, restarting")
+            self._startWorker(worker)
+
+    def getStats(self):
+        with self.condition:
+            return dict(self.stats, queued=len(self.queue), busy=sum(worker.request is not None for worker in self.workers),
+                        workerPids=[worker.pid for worker in self.workers])
+
+    def close(self, timeout=5.0):
+        with self.condition:
+            if self.isClosed:
+                return
+            self.isClosed = True
+            pending = [request for _, _, request in self.queue]
+            self.queue = []
+            self.condition.notify_all()
+        for request in pending:
+            if request.future.set_running_or_notify_cancel():
+                request.future.set_exception(OcrUnavailable("OCR pool is closed"))
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.taskQueue.put(None)
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(timeout)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+                    worker.process.join()
+        if self.collector is not None:
+            self.resultQueue.put(("stop", None, None, None)) # after the last result of the workers
+            self.collector.join()
+            self.dispatcher.join()
+        for worker in self.workers:
+            if worker.request is not None:
+                worker.request.future.set_exception(OcrUnavailable("OCR pool is closed"))
+                worker.request = None
+            worker.slot.close()
+            worker.slot.unlink()
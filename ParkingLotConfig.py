@@ -0,0 +1,4 @@
+# Settings of the parking lot shared by the gates and the web app. Keep this module free of heavy imports,
+# the web app reads it without loading the vision stack.
+
+max_capacity = 100 # parking spaces
@@ -0,0 +1,782 @@
+from CameraManager import CameraManager, LocalizationMode, boundingBoxIoU
+from OcrManager import OcrModelCache, SimulatedOcrReader
+from OcrWorkerPool import OcrWorkerPool, OcrPriority, OcrUnavailable
+from DataBaseManager import ParkingDB, Parking_lot, StatisticsGranularity, getSharedParkingDB
+from StatisticsRollup import StatisticsRollup
+from TariffManager import Tariff, TariffBand
+from OccupancyIndex import OccupancyIndex
+from GateEventJournal import GateEventJournal
+from PaymentManager import PaymentManager, PaymentOutcome, SimulatedPaymentTerminal
+from GateSimulator import GateSimulator
+from MetricsManager import metrics
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import event, text, select
+import subprocess
+import functools
+import traceback
+import argparse
+import platform
+import json
+import tempfile
+import sys
+import time
+import os
+import cv2
+import numpy as np
+
+testImagePaths = [f'testData/vehicle{i}.jpg' for i in range(4)]
+testPlateNumbers = ['PO 156VN', 'HR.26 BR 9044', 'WY 8686W', 'WY 726XE'] # what is on testImagePaths
+
+def loadTestImages():
+    return [cv2.imread(path) for path in testImagePaths]
+
+results = {} # name -> result of this run, written to the JSON file and compared with the baseline
+
+def recordResult(name, value, unit, higherIsBetter=False, **details):
+    results[name] = dict(value=value, unit=unit, higherIsBetter=higherIsBetter, **details)
+
+def _percentile(timings, percentile):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(percentile / 100 * len(timings)))]
+
+def printResult(name, timings):
+    timings = sorted(timings)
+    mean = sum(timings) / len(timings)
+    print(f"{name:<40} mean {mean * 1000:10.2f} ms   min {timings[0] * 1000:10.2f} ms   max {timings[-1] * 1000:10.2f} ms")
+    # the median is compared with the baseline, a single slow outlier does not move it
+    recordResult(name, _percentile(timings, 50), "s", mean=mean, min=timings[0], max=timings[-1],
+                 p99=_percentile(timings, 99), samples=len(timings))
+
+def printRate(name, value, unit):
+    print(f"{name:<40} {value:10.2f} {unit}")
+    recordResult(name, value, unit, higherIsBetter=True)
+
+
+def benchmarkOcrColdVsWarm():
+    images = loadTestImages()
+
+    # cold: models are loaded for every plate (previous behaviour of readPlateNumber)
+    coldTimings = []
+    for image in images:
+        cameraManager = CameraManager(['pl', 'en'], OcrModelCache())
+        start = time.perf_counter()
+        cameraManager.getVehiclePlateNumber(image)
+        coldTimings.append(time.perf_counter() - start)
+
+    # warm: shared cache loaded once at gate startup
+    cameraManager = CameraManager(['pl', 'en'], OcrModelCache())
+    cameraManager.warmUpOcr()
+    warmTimings = []
+    for image in images:
+        start = time.perf_counter()
+        cameraManager.getVehiclePlateNumber(image)
+        warmTimings.append(time.perf_counter() - start)
+
+    printResult("per-plate latency, cold OCR model", coldTimings)
+    printResult("per-plate latency, warm OCR model", warmTimings)
+
+
+def benchmarkBatchRecognition(repeats=10, workers=4):
+    images = loadTestImages() * repeats
+    cameraManager = CameraManager(['pl', 'en'])
+    cameraManager.warmUpOcr()
+
+    start = time.perf_counter()
+    serialPlateNumbers = [cameraManager.getVehiclePlateNumber(image) for image in images]
+    serialTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batchPlateNumbers = cameraManager.getVehiclePlateNumbers(images, workers=workers)
+    batchTime = time.perf_counter() - start
+
+    assert batchPlateNumbers == serialPlateNumbers, "batch results differ from the serial path"
+    printRate("serial recognition", len(images) / serialTime, "images/s")
+    printRate(f"batch recognition ({workers} workers)", len(images) / batchTime, "images/s")
+
+
+def benchmarkPlateRecognition(repeats=5, ocrModelCache=None):
+    # stages of one plate read on the testData images; OCR is skipped when the models are not on disk, it never downloads
+    ocrModelCache = ocrModelCache if ocrModelCache is not None else OcrModelCache(downloadEnabled=False)
+    cameraManager = CameraManager(['pl', 'en'], ocrModelCache)
+    images = loadTestImages()
+    plateImages = [cameraManager.locatePlate(image) for image in images]
+    timings = []
+    for _ in range(repeats):
+        for image in images:
+            start = time.perf_counter()
+            cameraManager.locatePlate(image)
+            timings.append(time.perf_counter() - start)
+    printResult("plate localization", timings)
+    try:
+        cameraManager.warmUpOcr()
+    except Exception as error:
+        print(f"{'plate OCR':<40} skipped, OCR models not available offline ({type(error).__name__})")
+        return
+    for name, read in (("plate OCR", lambda index: cameraManager.readPlateNumber(plateImages[index])),
+                       ("plate read, end to end", lambda index: cameraManager.getVehiclePlateNumber(images[index]))):
+        timings = []
+        for _ in range(repeats):
+            for index in range(len(images)):
+                if plateImages[index] is None:
+                    continue
+                start = time.perf_counter()
+                read(index)
+                timings.append(time.perf_counter() - start)
+        printResult(name, timings)
+
+
+def benchmarkOcrWorkerPool(lanes=4, readsPerLane=10, cpuTime=0.05, workers=None, archiveBacklog=40):
+    # lanes of one gate process reading plates at once: OCR on threads of the process against the worker pool.
+    # The simulated reader holds the GIL for cpuTime sec per read like the inference; the real model is used
+    # instead when it is on disk. On a single CPU both take the same time, the pool only helps with more cores.
+    workers = workers or os.cpu_count()
+    plateImages = [plate for plate in (CameraManager(['pl', 'en']).locatePlate(image) for image in loadTestImages()) if plate is not None]
+    readerFactory = functools.partial(SimulatedOcrReader, cpuTime=cpuTime)
+    ocrModelCache = OcrModelCache(downloadEnabled=False)
+    try:
+        localReader = ocrModelCache.getReader(['pl', 'en'])
+        readerFactory, name = None, "easyocr"
+    except Exception:
+        localReader, name = readerFactory(), f"simulated {cpuTime * 1000:.0f} ms"
+
+    def readLane(read):
+        timings = []
+        for index in range(readsPerLane):
+            start = time.perf_counter()
+            read(plateImages[index % len(plateImages)])
+            timings.append(time.perf_counter() - start)
+        return timings
+
+    def runLanes(read):
+        begin = time.perf_counter()
+        with ThreadPoolExecutor(lanes) as executor:
+            timings = [timing for laneTimings in executor.map(readLane, [read] * lanes) for timing in laneTimings]
+        return timings, time.perf_counter() - begin
+
+    timings, totalTime = runLanes(localReader.readtext)
+    printResult(f"OCR {name}, {lanes} lanes on threads", timings)
+    printRate(f"OCR {name}, threads throughput", len(timings) / totalTime, "reads/s")
+    with OcrWorkerPool(['pl', 'en'], workers, readerFactory=readerFactory, downloadEnabled=False) as pool:
+        timings, totalTime = runLanes(lambda plateImage: pool.readtext(plateImage, OcrPriority.EntranceGate))
+        printResult(f"OCR {name}, {lanes} lanes, {workers} processes", timings)
+        printRate(f"OCR {name}, pool throughput", len(timings) / totalTime, "reads/s")
+
+        # an exit gate read arriving behind a backlog of archive reprocessing
+        timings = []
+        for _ in range(5):
+            backlog = []
+            for index in range(archiveBacklog):
+                try:
+                    backlog.append(pool.submit(plateImages[index % len(plateImages)], OcrPriority.Archive))
+                except OcrUnavailable:
+                    break # archive share of the queue is full
+            start = time.perf_counter()
+            pool.readtext(plateImages[0], OcrPriority.ExitGate)
+            timings.append(time.perf_counter() - start)
+            for future in backlog:
+                future.result()
+        printResult(f"OCR exit gate read, {len(backlog)} archive queued", timings)
+
+
+def benchmarkLocalizationModes(scales=(0.4, 0.5, 0.6, 0.75), repeats=5):
+    # accuracy = bounding box IoU of the located plate against the full-frame result
+    imagesGray = [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) for image in loadTestImages()]
+    fullCamera = CameraManager(['pl', 'en'])
+    referenceBoxes = [cv2.boundingRect(fullCamera.findPlateCorners(fullCamera.filterNoises(image))) for image in imagesGray]
+
+    timings = []
+    for _ in range(repeats):
+        for image in imagesGray:
+            start = time.perf_counter()
+            fullCamera.findPlateCorners(fullCamera.filterNoises(image))
+            timings.append(time.perf_counter() - start)
+    printResult("localization, full frame", timings)
+
+    for scale in scales:
+        fastCamera = CameraManager(['pl', 'en'], localizationMode=LocalizationMode.Fast)
+        fastCamera.localizationScale = scale
+        timings = []
+        for _ in range(repeats):
+            for image in imagesGray:
+                start = time.perf_counter()
+                fastCamera.findPlateCornersFast(image)
+                timings.append(time.perf_counter() - start)
+        hits = [fastCamera.findPlateCornersFast(image) for image in imagesGray]
+        ious = [boundingBoxIoU(cv2.boundingRect(corners), reference)
+                for corners, reference in zip(hits, referenceBoxes) if corners is not None]
+        printResult(f"localization, fast path x{scale}", timings)
+        print(f"{'':<40} hits {len(ious)}/{len(hits)}   mean IoU of hits {np.mean(ious) if ious else 0.0:.2f}"
+              f"   (misses fall back to the full frame)")
+
+
+def benchmarkPlateCandidates(repeats=3, photosPerCar=3):
+    # First quadrilateral and first text box (single) against top-K candidates with confidence scoring, on testData.
+    # A car is served with the first correct read; a wrong read costs one more photo and read, up to photosPerCar,
+    # and a car still wrong after that is stuck at the gate. The photos of one car are the same test image.
+    cameraManager = CameraManager(['pl', 'en'], OcrModelCache(downloadEnabled=False))
+    imagesGray = [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) for image in loadTestImages()]
+    timings = []
+    for _ in range(repeats):
+        for imageGray in imagesGray:
+            start = time.perf_counter()
+            list(cameraManager.iterPlateCandidates(imageGray))
+            timings.append(time.perf_counter() - start)
+    printResult("localization, top-K candidates", timings)
+    try:
+        cameraManager.warmUpOcr()
+    except Exception as error:
+        print(f"{'plate candidates, OCR':<40} skipped, OCR models not available offline ({type(error).__name__})")
+        return
+
+    def readSingle(image):
+        plateImage = cameraManager.locatePlate(image)
+        return (cameraManager.readPlateNumber(plateImage) if plateImage is not None else None), 1
+    def readCandidates(image):
+        plateRead = cameraManager.getVehiclePlateNumberWithConfidence(image)
+        return plateRead.plateNumber, plateRead.ocrRuns
+
+    for name, read in (("single candidate", readSingle), ("top-K candidates", readCandidates)):
+        timings, retries, ocrRuns, stuckCars = [], 0, 0, 0
+        for _ in range(repeats):
+            for image, expectedPlateNumber in zip(loadTestImages(), testPlateNumbers):
+                start = time.perf_counter()
+                for photo in range(photosPerCar):
+                    plateNumber, runs = read(image)
+                    ocrRuns += runs
+                    if plateNumber == expectedPlateNumber:
+                        break
+                    retries += 1
+                else:
+                    stuckCars += 1
+                timings.append(time.perf_counter() - start)
+        cars = repeats * len(testPlateNumbers)
+        printResult(f"plate read per car, {name}", timings)
+        print(f"{'':<40} {retries / cars:.2f} retries per car   {ocrRuns / cars:.2f} OCR runs per car   {stuckCars} stuck of {cars}")
+        recordResult(f"plate read retries per car, {name}", retries / cars, "retries/car")
+
+
+def benchmarkPlateCropping(repeats=20):
+    cameraManager = CameraManager(['pl', 'en'])
+    imagesGray = [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) for image in loadTestImages()]
+    plateCorners = [cameraManager.findPlateCorners(cameraManager.filterNoises(image)) for image in imagesGray]
+
+    maskTimings, cornerTimings = [], []
+    for _ in range(repeats):
+        for image, corners in zip(imagesGray, plateCorners):
+            start = time.perf_counter()
+            cameraManager.cropPlate(image, cameraManager._createPlateMask(image.shape, corners))
+            maskTimings.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            cameraManager.cropPlateByCorners(image, corners)
+            cornerTimings.append(time.perf_counter() - start)
+    printResult("plate crop, full-frame mask", maskTimings)
+    printResult("plate crop, bounding rectangle", cornerTimings)
+
+
+def countRoundTrips(engine):
+    # returns a one element list incremented for every statement sent to the database
+    roundTrips = [0]
+    def onExecute(*args):
+        roundTrips[0] += 1
+    event.listen(engine, "before_cursor_execute", onExecute)
+    return roundTrips
+
+def benchmarkCarLifecycle(parkingDb=None, cars=200):
+    # entry, end of parking with fee, payment, fee check at the exit and release
+    parkingDb = parkingDb if parkingDb is not None else getSharedParkingDB()
+    roundTrips = countRoundTrips(parkingDb.engine)
+    timings = []
+    roundTrips[0] = 0
+    for car in range(cars):
+        registration = f"BENCH {car:05d}"
+        start = time.perf_counter()
+        parkingDb.addCarEntryRecord(registration)
+        parkingDb.updateParkingEndTime(registration)
+        parkingDb.updatePaymentStatus(registration)
+        parkingDb.wasFeePaid(registration)
+        parkingDb.releaseCarFromDb(registration)
+        timings.append(time.perf_counter() - start)
+    printResult("car lifecycle latency", timings)
+    recordResult("car lifecycle round trips", roundTrips[0] / cars, "statements/car")
+    print(f"{'':<40} {roundTrips[0] / cars:.1f} database round trips per car")
+
+
+def fillHistoricalSessions(parkingDb, rows, chunkSize=10000):
+    # closed sessions of 50000 different plates, spread over the past years
+    table = parkingDb.Parking_lot_table
+    missingRows = rows - parkingDb.getTableLength()
+    start = datetime.now().replace(microsecond=0) - timedelta(minutes=missingRows)
+    with parkingDb.engine.begin() as connection:
+        for chunkStart in range(0, max(missingRows, 0), chunkSize):
+            records = []
+            for row in range(chunkStart, min(chunkStart + chunkSize, missingRows)):
+                entranceTime = start + timedelta(minutes=row)
+                records.append({"Registration_number": f"HIST {row % 50000:05d}", "Entrance_time": entranceTime,
+                                "End_time": entranceTime + timedelta(minutes=90), "Parking_duration": 90, "Fee": 3.0,
+                                "IsPaid": True, "Payment_time": entranceTime + timedelta(minutes=91),
+                                "Exit_time": entranceTime + timedelta(minutes=95)})
+            connection.execute(table.insert(), records)
+
+def _timeGateLookups(parkingDb, lookups):
+    timings = []
+    for lookup in range(lookups):
+        registration = f"HIST {lookup * 97 % 50000:05d}"
+        start = time.perf_counter()
+        parkingDb.isCarParked(registration)
+        parkingDb.wasFeePaid(registration)
+        parkingDb.getNumberOfCarsInAParkingLot()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def benchmarkDatabaseOperations(parkingDb=None, tableSizes=(1000, 10000, 100000), cars=200):
+    # every ParkingDB operation of a car's visit and of the web pages, the table grows to each size with closed sessions
+    parkingDb = parkingDb if parkingDb is not None else ParkingDB("sqlite://")
+    for tableSize in sorted(tableSizes):
+        fillHistoricalSessions(parkingDb, tableSize)
+        plates = [f"OPS {car:05d}" for car in range(cars)]
+        operations = (("addCarEntryRecord", parkingDb.addCarEntryRecord), ("isCarParked", parkingDb.isCarParked),
+                      ("findLastIdByRegistration", parkingDb.findLastIdByRegistration),
+                      ("getNumberOfCarsInAParkingLot", lambda plate: parkingDb.getNumberOfCarsInAParkingLot()),
+                      ("getParkedCarsPage", lambda plate: parkingDb.getParkedCarsPage(50, search=plate)),
+                      ("updateParkingEndTime", parkingDb.updateParkingEndTime), ("getFee", parkingDb.getFee),
+                      ("updatePaymentStatus", parkingDb.updatePaymentStatus), ("wasFeePaid", parkingDb.wasFeePaid),
+                      ("releaseCarFromDb", parkingDb.releaseCarFromDb))
+        for name, operation in operations:
+            timings = []
+            for plate in plates:
+                start = time.perf_counter()
+                operation(plate)
+                timings.append(time.perf_counter() - start)
+            printResult(f"db {name}, {tableSize} rows", timings)
+
+
+def benchmarkHistoricalTable(parkingDb=None, historicalRows=1_000_000, lookups=300):
+    # drops and recreates the Parking_lot indexes - run it against a scratch database
+    parkingDb = parkingDb if parkingDb is not None else getSharedParkingDB()
+    fillHistoricalSessions(parkingDb, historicalRows)
+    printResult(f"gate lookups, {historicalRows} rows, indexed", _timeGateLookups(parkingDb, lookups))
+    for index in Parking_lot.__table__.indexes:
+        index.drop(parkingDb.engine, checkfirst=True)
+    printResult(f"gate lookups, {historicalRows} rows, no index", _timeGateLookups(parkingDb, lookups))
+    parkingDb.migrateParkingLotTable()
+
+
+def benchmarkDatabaseStartup(db_string=None, repeats=5):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        parkingDb = ParkingDB(db_string)
+        parkingDb.getNumberOfCarsInAParkingLot() # first query opens the first pooled connection
+        timings.append(time.perf_counter() - start)
+        parkingDb.engine.dispose()
+    printResult("ParkingDB startup", timings)
+
+
+vision_modules = ("cv2", "imutils", "easyocr", "torch", "matplotlib")
+
+def _timeProcessStartup(code, repeats):
+    # fresh interpreter every time, nothing is cached in sys.modules
+    timings = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", "import time, sys\nstart = time.perf_counter()\n" + code +
+                                 "\nprint(time.perf_counter() - start)\nprint(' '.join(m for m in %r if m in sys.modules))" % (vision_modules,)],
+                                capture_output=True, text=True, check=True).stdout.splitlines()
+        timings.append(float(output[-2]))
+    return timings, output[-1].split()
+
+def benchmarkStartup(repeats=5, warmUpOcr=False):
+    # time from interpreter start to a ready web app / gate process, and which vision libraries each one loads
+    timings, loadedModules = _timeProcessStartup("import Main", repeats)
+    printResult("web app startup", timings)
+    print(f"{'  vision modules loaded':<40} {', '.join(loadedModules) or 'none'}")
+    gateCode = "import AutomatedParkingSystem\nparkingSystem = AutomatedParkingSystem.AutomatedParkingSystem()"
+    if warmUpOcr:
+        gateCode += "\nparkingSystem.cameraHandler.warmUpOcr()"
+    timings, loadedModules = _timeProcessStartup(gateCode, repeats)
+    printResult("gate startup" + (", OCR warmed up" if warmUpOcr else ""), timings)
+    print(f"{'  vision modules loaded':<40} {', '.join(loadedModules) or 'none'}")
+
+
+def benchmarkOccupancyIndex(parkingDb=None, lookups=1000):
+    parkingDb = parkingDb if parkingDb is not None else getSharedParkingDB()
+    occupancyIndex = OccupancyIndex(parkingDb)
+    printResult("gate lookups, database", _timeGateLookups(parkingDb, lookups))
+    printResult("gate lookups, occupancy index", _timeGateLookups(occupancyIndex, lookups))
+    occupancyIndex.close()
+
+
+def _timeGateWrites(gateDb, cars, prefix):
+    # entry and exit of every car, as written by the entrance and the exit gate
+    timings = []
+    for car in range(cars):
+        for write in (gateDb.addCarEntryRecord, gateDb.releaseCarFromDb):
+            start = time.perf_counter()
+            write(f"{prefix} {car:05d}")
+            timings.append(time.perf_counter() - start)
+    return timings
+
+def benchmarkGateEventJournal(parkingDb=None, dbDelay=0.02, cars=200):
+    # every statement is delayed by dbDelay sec to simulate a slow or remote database
+    parkingDb = parkingDb if parkingDb is not None else getSharedParkingDB()
+    slowDown = lambda *args: time.sleep(dbDelay)
+    event.listen(parkingDb.engine, "before_cursor_execute", slowDown)
+    try:
+        timings = _timeGateWrites(parkingDb, cars, "DIRECT")
+        printResult(f"gate write, direct, db +{dbDelay * 1000:.0f} ms", timings)
+        print(f"{'':<40} worst case {max(timings) * 1000:.2f} ms   {len(timings) / sum(timings):.0f} events/s")
+
+        with tempfile.TemporaryDirectory() as journalDir:
+            journal = GateEventJournal(parkingDb, os.path.join(journalDir, "gate_events.journal"))
+            occupancyIndex = OccupancyIndex(parkingDb, journal)
+            start = time.perf_counter()
+            timings = _timeGateWrites(occupancyIndex, cars, "JOURNAL")
+            occupancyIndex.flush()
+            persistTime = time.perf_counter() - start
+            printResult(f"gate write, journal, db +{dbDelay * 1000:.0f} ms", timings)
+            print(f"{'':<40} worst case {max(timings) * 1000:.2f} ms   {len(timings) / persistTime:.0f} events/s persisted"
+                  f"   {journal.getStats()['batches']} batches")
+            occupancyIndex.close()
+    finally:
+        event.remove(parkingDb.engine, "before_cursor_execute", slowDown)
+
+
+def benchmarkDashboardLoad(path="/", requests=2000, clients=8):
+    # lobby screens polling the home page; the uncached run re-reads the database on every request (ttl = 0)
+    import Main
+    def poll(headers):
+        client = Main.app.test_client()
+        timings = []
+        for _ in range(requests // clients):
+            start = time.perf_counter()
+            client.get(path, headers=headers)
+            timings.append(time.perf_counter() - start)
+        return timings
+
+    defaultTtl = Main.occupancyCache.ttl
+    etag = Main.app.test_client().get(path).headers["ETag"]
+    for name, ttl, headers in (("uncached", 0, {}), ("cached", defaultTtl, {}), ("cached, If-None-Match", defaultTtl, {"If-None-Match": etag})):
+        Main.occupancyCache.ttl = ttl
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            timings = [timing for clientTimings in executor.map(poll, [headers] * clients) for timing in clientTimings]
+        totalTime = time.perf_counter() - start
+        print(f"{f'GET {path}, {name}':<40} {len(timings) / totalTime:10.0f} requests/s   p50 {_percentile(timings, 50) * 1000:8.2f} ms"
+              f"   p99 {_percentile(timings, 99) * 1000:8.2f} ms")
+        recordResult(f"GET {path}, {name}", len(timings) / totalTime, "requests/s", higherIsBetter=True,
+                     p50=_percentile(timings, 50), p99=_percentile(timings, 99), clients=clients)
+    Main.occupancyCache.ttl = defaultTtl
+
+
+def benchmarkStatsPage(openSessions=10000, repeats=20):
+    # parked cars table with many open sessions: whole table through pandas vs one keyset page
+    import Main
+    import pandas as pd
+    parkingDb = ParkingDB("sqlite://")
+    start = datetime.now().replace(microsecond=0) - timedelta(minutes=openSessions)
+    with parkingDb.engine.begin() as connection:
+        connection.execute(parkingDb.Parking_lot_table.insert(),
+                           [{"Registration_number": f"OPEN {car:05d}", "Entrance_time": start + timedelta(minutes=car),
+                             "IsPaid": False} for car in range(openSessions)])
+
+    timings = []
+    for _ in range(repeats):
+        begin = time.perf_counter()
+        results, columns = parkingDb.getParkedCarsTable()
+        df = pd.DataFrame.from_records(results)
+        df.columns = columns
+        df.to_html(classes='data', header='true')
+        timings.append(time.perf_counter() - begin)
+    printResult(f"stats table, pandas, {openSessions} open", timings)
+
+    database, Main.database = Main.database, parkingDb
+    try:
+        client = Main.app.test_client()
+        lastPageKey = parkingDb.getParkedCarsPage(Main.stats_page_size, descending=True)[-1]
+        for name, url in (("first page", "/stats"), ("last page", f"/stats?after={Main.encodePageKey(lastPageKey, 'entrance')}"),
+                          ("plate search", "/stats?search=OPEN%2009")):
+            timings = []
+            for _ in range(repeats):
+                begin = time.perf_counter()
+                client.get(url).get_data()
+                timings.append(time.perf_counter() - begin)
+            printResult(f"stats page, keyset, {name}", timings)
+    finally:
+        Main.database = database
+
+
+def benchmarkStatisticsRollup(parkingDb=None, repeats=20):
+    # rewrites the summary tables - run it against a scratch database, e.g. one filled by fillHistoricalSessions
+    parkingDb = parkingDb if parkingDb is not None else getSharedParkingDB()
+    statisticsRollup = StatisticsRollup(parkingDb, flushInterval=3600)
+    start = time.perf_counter()
+    statisticsRollup.backfill()
+    backfillTime = time.perf_counter() - start
+    print(f"{f'rollup backfill, {parkingDb.getTableLength()} rows':<40} {backfillTime:10.2f} s")
+    recordResult("rollup backfill", backfillTime, "s", rows=parkingDb.getTableLength())
+    statisticsRollup.close()
+
+    end = datetime.now()
+    yearStart = end - timedelta(days=365)
+    for granularity in StatisticsGranularity:
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            parkingDb.getStatistics(granularity, yearStart, end)
+            timings.append(time.perf_counter() - start)
+        printResult(f"one year per {granularity.value}, rollup", timings)
+
+    if parkingDb.engine.dialect.name == "postgresql":
+        rawQuery = text('SELECT date_trunc(\'day\', "Entrance_time"), COUNT(*) FROM "Parking_lot" '
+                        'WHERE "Entrance_time" >= :start AND "Entrance_time" < :end GROUP BY 1')
+        timings = []
+        for _ in range(repeats // 4 or 1):
+            start = time.perf_counter()
+            parkingDb.engine.execute(rawQuery, start=yearStart, end=end).fetchall()
+            timings.append(time.perf_counter() - start)
+        printResult("one year per day, raw table scan", timings)
+
+
+def benchmarkFeeReconciliation(parkingDb=None, sessions=20000, repeats=3):
+    # end-of-day reconciliation: per-row recalculation against the NumPy batch over the same ended sessions
+    parkingDb = parkingDb if parkingDb is not None else ParkingDB("sqlite://")
+    parkingDb.tariff = Tariff([TariffBand(0, 7, 1.0), TariffBand(7, 19, 3.0), TariffBand(19, 24, 1.5)], dailyCap=20, gracePeriod=15)
+    random = np.random.default_rng(0)
+    start = datetime.now().replace(microsecond=0) - timedelta(days=1)
+    with parkingDb.engine.begin() as connection:
+        records = []
+        for car, duration in enumerate(random.integers(0, 12 * 60, sessions)):
+            entranceTime = start + timedelta(seconds=int(car * 86400 / sessions))
+            records.append({"Registration_number": f"DAY {car:05d}", "Entrance_time": entranceTime,
+                            "End_time": entranceTime + timedelta(minutes=int(duration)), "IsPaid": True,
+                            "Exit_time": entranceTime + timedelta(minutes=int(duration) + 5)})
+        connection.execute(parkingDb.Parking_lot_table.insert(), records)
+    ids = [row[0] for row in parkingDb.engine.execute(parkingDb._selectEndedSessions(start, None)).fetchall()]
+
+    begin = time.perf_counter()
+    perRowFees = [parkingDb.updateFee(id) for id in ids]
+    perRowTime = time.perf_counter() - begin
+    timings = []
+    for _ in range(repeats):
+        begin = time.perf_counter()
+        parkingDb.recalculateFees(start)
+        timings.append(time.perf_counter() - begin)
+    columns = parkingDb.Parking_lot_table.columns
+    batchFees = [row[0] for row in parkingDb.engine.execute(select(columns.Fee).where(columns.ID.in_(ids)).order_by(columns.ID))]
+    assert batchFees == perRowFees, "batch fees differ from the per-row path"
+    print(f"{f'fee reconciliation, per row, {len(ids)}':<40} {perRowTime * 1000:10.2f} ms")
+    recordResult(f"fee reconciliation, per row, {len(ids)}", perRowTime, "s")
+    printResult(f"fee reconciliation, batch, {len(ids)}", timings)
+
+
+def benchmarkConcurrentPayments(parkingDb=None, cars=300, attemptsPerCar=3, workers=32, terminalLatency=0.01):
+    # every car is paid attemptsPerCar times at once by different pay stations, each session must be charged once
+    parkingDb = parkingDb if parkingDb is not None else getSharedParkingDB()
+    terminal = SimulatedPaymentTerminal(latency=terminalLatency)
+    paymentManager = PaymentManager(parkingDb, terminal)
+    prefix = "PAY " + str(time.time_ns())[-6:]
+    plates = [f"{prefix} {car:04d}" for car in range(cars)]
+    entranceTime = datetime.now().replace(microsecond=0) - timedelta(hours=2)
+    for car, plate in enumerate(plates):
+        parkingDb.addCarEntryRecord(plate, entranceTime)
+        parkingDb.updateParkingEndTime(plate, entranceTime + timedelta(minutes=30 + car))
+
+    def pay(plate):
+        start = time.perf_counter()
+        result = paymentManager.pay(plate)
+        return time.perf_counter() - start, result
+    begin = time.perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        results = list(executor.map(pay, plates * attemptsPerCar))
+    totalTime = time.perf_counter() - begin
+
+    approved = sum(result.outcome == PaymentOutcome.Approved for _, result in results)
+    assert approved == len(terminal.charges) == cars, "a session was charged twice or not at all"
+    assert all(parkingDb.wasFeePaid(plate) for plate in plates), "a payment was lost"
+    for plate in plates:
+        parkingDb.releaseCarFromDb(plate)
+    printResult(f"pay station, {len(results)} concurrent attempts", [timing for timing, _ in results])
+    printRate("pay station throughput", len(results) / totalTime, "payments/s")
+
+
+def benchmarkGateSimulation(cars=5000, arrivalRate=400.0, departureRate=0.5, entranceLanes=2, exitLanes=2):
+    # capacity planning run: a busy day through the real gates, journal, database and payments on a virtual clock
+    parkingDb = ParkingDB("sqlite://")
+    occupancyIndex = OccupancyIndex(parkingDb, GateEventJournal(parkingDb, flushInterval=0.05))
+    simulator = GateSimulator(parkingDb, occupancyIndex, arrivalRate=arrivalRate, departureRate=departureRate,
+                              entranceLanes=entranceLanes, exitLanes=exitLanes, seed=0)
+    report = simulator.run(cars=cars)
+    occupancyIndex.close()
+    print(f"gate simulation, {cars} cars, {arrivalRate:.0f} arrivals/h, {entranceLanes}+{exitLanes} lanes")
+    print("  " + str(report).replace("\n", "\n  "))
+    recordResult(f"gate simulation, {cars} cars", cars / report.realTime, "cars/s", higherIsBetter=True)
+
+
+def benchmarkMetricsOverhead(calls=20000):
+    # cost of the instrumentation on the hottest database call, recorded, switched off and not wrapped at all
+    parkingDb = ParkingDB("sqlite://")
+    parkingDb.addCarEntryRecord('PO 156VN')
+    bareIsCarParked = ParkingDB.isCarParked.__wrapped__
+    results = {}
+    for name, enabled, call in (("recorded", True, parkingDb.isCarParked), ("switched off", False, parkingDb.isCarParked),
+                                ("not instrumented", True, lambda plate: bareIsCarParked(parkingDb, plate))):
+        metrics.setEnabled(enabled)
+        timings = []
+        for _ in range(calls):
+            start = time.perf_counter()
+            call('PO 156VN')
+            timings.append(time.perf_counter() - start)
+        results[name] = timings
+    metrics.setEnabled(True)
+    for name, timings in results.items():
+        printResult(f"isCarParked, metrics {name}", timings)
+    overhead = sum(results["recorded"]) / calls - sum(results["not instrumented"]) / calls
+    print(f"{'metrics overhead per call':<40} {overhead * 1e6:10.2f} us")
+
+    histogram = metrics.histogram("benchmark_seconds", "Benchmark only")
+    start = time.perf_counter()
+    for _ in range(calls):
+        with histogram.time():
+            pass
+    print(f"{'histogram.time() alone':<40} {(time.perf_counter() - start) / calls * 1e6:10.2f} us")
+
+
+
+def getSuite(name, parkingDb):
+    # quick and full need no network, no camera and no GPIO: test images, a scratch database and the Flask test client
+    quick = name == "quick"
+    return [
+        ("plate recognition", lambda: benchmarkPlateRecognition(repeats=2 if quick else 5)),
+        ("OCR worker pool", lambda: benchmarkOcrWorkerPool(readsPerLane=5 if quick else 20)),
+        ("plate candidates", lambda: benchmarkPlateCandidates(repeats=1 if quick else 3)),
+        ("localization modes", lambda: benchmarkLocalizationModes(repeats=2 if quick else 5)),
+        ("plate cropping", lambda: benchmarkPlateCropping(repeats=5 if quick else 20)),
+        ("database operations", lambda: benchmarkDatabaseOperations(parkingDb, (1000, 10000) if quick else (1000, 10000, 100000),
+                                                                    cars=50 if quick else 200)),
+        ("car lifecycle", lambda: benchmarkCarLifecycle(parkingDb, cars=50 if quick else 200)),
+        ("occupancy index", lambda: benchmarkOccupancyIndex(parkingDb, lookups=200 if quick else 1000)),
+        ("statistics rollup", lambda: benchmarkStatisticsRollup(parkingDb, repeats=5 if quick else 20)),
+        ("fee reconciliation", lambda: benchmarkFeeReconciliation(sessions=2000 if quick else 20000)),
+        ("concurrent payments", lambda: benchmarkConcurrentPayments(parkingDb, cars=50 if quick else 300)),
+        ("gate simulation", lambda: benchmarkGateSimulation(cars=500 if quick else 5000)),
+        ("dashboard load", lambda: benchmarkDashboardLoad("/", requests=400 if quick else 2000)),
+        ("stats load", lambda: benchmarkDashboardLoad("/stats", requests=400 if quick else 2000)),
+        ("stats page", lambda: benchmarkStatsPage(openSessions=2000 if quick else 10000, repeats=5 if quick else 20)),
+        ("metrics overhead", lambda: benchmarkMetricsOverhead(calls=2000 if quick else 20000)),
+    ]
+
+def runSuite(name, db_string):
+    # returns the names of the benchmarks that failed, the others still run
+    parkingDb = ParkingDB(db_string)
+    failed = []
+    for benchmarkName, benchmark in getSuite(name, parkingDb):
+        print(f"--- {benchmarkName}")
+        try:
+            benchmark()
+        except Exception:
+            traceback.print_exc()
+            failed.append(benchmarkName)
+    parkingDb.engine.dispose()
+    return failed
+
+def runAll():
+    # everything, against the configured database, including the cold OCR model loads and the 1M row table
+    benchmarkOcrColdVsWarm()
+    benchmarkBatchRecognition()
+    benchmarkOcrWorkerPool()
+    benchmarkPlateCandidates()
+    benchmarkLocalizationModes()
+    benchmarkPlateCropping()
+    benchmarkStartup()
+    benchmarkDatabaseStartup()
+    benchmarkCarLifecycle()
+    benchmarkOccupancyIndex()
+    benchmarkGateEventJournal()
+    benchmarkDashboardLoad()
+    benchmarkDashboardLoad("/stats")
+    benchmarkStatsPage()
+    benchmarkStatisticsRollup()
+    benchmarkFeeReconciliation()
+    benchmarkConcurrentPayments()
+    benchmarkGateSimulation()
+    benchmarkMetricsOverhead()
+    benchmarkHistoricalTable()
+    return []
+
+
+def getEnvironment(db_string):
+    # results of different machines or backends are not comparable, the comparison warns about it
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"python": platform.python_version(), "platform": platform.platform(), "machine": platform.machine(),
+            "cpus": os.cpu_count(), "database": db_string.split(":", 1)[0], "commit": commit}
+
+def compareWithBaseline(current, baseline, tolerance=0.25):
+    # returns (name, baseline value, current value, relative change) of every result worse than the baseline by more than tolerance
+    regressions = []
+    for name, result in current.items():
+        reference = baseline.get(name)
+        if reference is None or reference["unit"] != result["unit"] or not reference["value"]:
+            continue
+        change = result["value"] / reference["value"] - 1
+        if (-change if result["higherIsBetter"] else change) > tolerance:
+            regressions.append((name, reference["value"], result["value"], change))
+    return regressions
+
+def printComparison(current, baseline, tolerance):
+    print(f"\n{'benchmark':<48} {'baseline':>12} {'current':>12} {'change':>8}")
+    regressions = {name for name, *_ in compareWithBaseline(current, baseline, tolerance)}
+    for name, result in current.items():
+        if name not in baseline:
+            print(f"{name:<48} {'new':>12} {result['value']:12.6g}")
+            continue
+        reference = baseline[name]["value"]
+        change = f"{(result['value'] / reference - 1) * 100:+7.1f}%" if reference else ""
+        print(f"{name:<48} {reference:12.6g} {result['value']:12.6g} {change:>8}{'  REGRESSION' if name in regressions else ''}")
+    return regressions
+
+
+if __name__ == "__main__":
+    # the baseline is recorded on the machine that compares with it, it is not kept in the repository:
+    # python ParkingSystemBenchmark.py --suite quick --baseline benchmark_baseline.json --save-baseline
+    # python ParkingSystemBenchmark.py --suite quick --output results.json --baseline benchmark_baseline.json
+    parser = argparse.ArgumentParser(description="Benchmarks of the plate reading, database and web hot paths")
+    parser.add_argument("--suite", choices=("quick", "full", "all"), default="full",
+                        help="quick and full run offline on a scratch database, all runs every benchmark against PARKING_DB_URL")
+    parser.add_argument("--db", help="database of the quick and full suites, a temporary SQLite file by default")
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before a result counts as a regression")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to the --baseline file instead of comparing")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratchDir:
+        db_string = args.db or f"sqlite:///{os.path.join(scratchDir, 'benchmark.db')}"
+        if args.suite != "all":
+            os.environ["PARKING_DB_URL"] = db_string # the web app benchmarks go through the shared ParkingDB too
+        failed = runAll() if args.suite == "all" else runSuite(args.suite, db_string)
+
+    report = {"suite": args.suite, "time": datetime.now().isoformat(timespec="seconds"),
+              "environment": getEnvironment(db_string if args.suite != "all" else os.environ.get("PARKING_DB_URL", "postgresql")),
+              "failed": failed, "results": results}
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            json.dump(report, outputFile, indent=2)
+    regressions = set()
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as baselineFile:
+            json.dump(report, baselineFile, indent=2)
+    elif args.baseline and not os.path.exists(args.baseline):
+        print(f"\nno baseline {args.baseline} yet, record one on this machine with --save-baseline")
+    elif args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        differences = {key: (value, report["environment"][key]) for key, value in baseline["environment"].items()
+                       if key not in ("commit",) and report["environment"].get(key) != value}
+        if differences:
+            print(f"\nwarning: baseline was recorded in another environment {differences}")
+        regressions = printComparison(results, baseline["results"], args.tolerance)
+        print(f"\n{len(regressions)} regressions over {args.tolerance:.0%}, {len(failed)} failed benchmarks")
+    sys.exit(1 if regressions or failed else 0)
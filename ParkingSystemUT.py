@@ -1,9 +1,37 @@
 import unittest
-from CameraManager import CameraManager
-from TollBarManager import SensorLocation, Sensor, BarrierState, Barrier, TollBarManager
+from unittest import mock
+from CameraManager import CameraManager, LocalizationMode, OcrFallback, plateFormatScore
+from OcrManager import SimulatedOcrReader, simulatedPlateText
+from OcrWorkerPool import OcrWorkerPool, OcrPriority, OcrUnavailable
+from PlateReadCache import PlateReadCache
+from CaptureManager import CaptureSession, ImageFileSource, SyntheticFrameSource
+from TollBarManager import SensorLocation, Sensor, BarrierState, Barrier, TollBarManager, MotionProfile, ObstructionBehaviour
 from AutomatedParkingSystem import AutomatedParkingSystem
+from DataBaseManager import ParkingDB, ParkingEventType, StatisticsGranularity, getSharedParkingDB
+from sqlalchemy import event, select, func, text
+from sqlalchemy.exc import IntegrityError
+from GateController import GateController, GateType, GateState, SensorMode
+from GateSupervisor import GateSupervisor, GateConfig, AsyncGateController, AsyncParkingDB
+from OccupancyIndex import OccupancyIndex, getSharedOccupancyIndex
+from GateEventJournal import GateEventJournal, JournalInUse, getJournalPath, getJournalPaths
+from OccupancyCache import OccupancyCache
+from StatisticsRollup import StatisticsRollup
+from TariffManager import Tariff, TariffBand
+from PaymentManager import PaymentManager, PaymentOutcome, PaymentTerminal, SimulatedPaymentTerminal
+from GateSimulator import GateSimulator, SensorTrace, VirtualClock
+from MetricsManager import MetricsRegistry, metrics
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import ParkingSystemBenchmark
+import Main
+import asyncio
 from contextlib import contextmanager
+from datetime import datetime, timedelta
+import subprocess
+import functools
+import tempfile
 import threading
+import sys
 import _thread
 import time
 import cv2
@@ -28,6 +56,24 @@ def time_limit(seconds, msg=''):
         timer.cancel()
 
 
+class StaticOcrCache:
+    def __init__(self, reader=None) -> None:
+        self.reader = reader if reader is not None else SimulatedOcrReader()
+
+    def getReader(self, ocrLanguages):
+        return self.reader
+
+class ScriptedOcrReader:
+    # reads the text and confidence given for the width of the plate crop
+    def __init__(self, readsByWidth) -> None:
+        self.readsByWidth = readsByWidth
+
+    def readtext(self, image):
+        height, width = image.shape[:2]
+        text, confidence = self.readsByWidth.get(width, ("", 0.0))
+        return [([[0, 0], [width, 0], [width, height], [0, height]], text, confidence)]
+
+
 class TestCameraManager(unittest.TestCase):
 
     def testPlateNumberRecognition(self):
@@ -38,6 +84,75 @@ class TestCameraManager(unittest.TestCase):
             plateNumber = cameraManager.getVehiclePlateNumber(image)
             self.assertEqual(plateNumber, expectedPlateNumbers[i])
     
+    def testBatchPlateNumberRecognitionKeepsInputOrder(self):
+        cameraManager = CameraManager(['pl', 'en'])
+        expectedPlateNumbers = ['PO 156VN', 'HR.26 BR 9044', 'WY 8686W', 'WY 726XE']
+        images = [cv2.imread(f'testData/vehicle{i}.jpg') for i in range(4)]
+        plateNumbers = cameraManager.getVehiclePlateNumbers(images * 2, workers=2, ocrBatchSize=3)
+        self.assertEqual(plateNumbers, expectedPlateNumbers * 2)
+
+    def testFastLocalizationMatchesFullFrame(self):
+        fullCamera = CameraManager(['pl', 'en'])
+        fastCamera = CameraManager(['pl', 'en'], localizationMode=LocalizationMode.Fast)
+        for i in range(4):
+            image = cv2.imread(f'testData/vehicle{i}.jpg')
+            fullPlate = fullCamera.locatePlate(image)
+            fastPlate = fastCamera.locatePlate(image)
+            self.assertIsNotNone(fastPlate)
+            # fast path maps corners back to full resolution, so the crop size is within a few pixels
+            self.assertLessEqual(abs(fullPlate.shape[0] - fastPlate.shape[0]), 5)
+            self.assertLessEqual(abs(fullPlate.shape[1] - fastPlate.shape[1]), 5)
+
+    def testCornerCropMatchesMaskCrop(self):
+        cameraManager = CameraManager(['pl', 'en'])
+        for i in range(4):
+            imageGray = cv2.cvtColor(cv2.imread(f'testData/vehicle{i}.jpg'), cv2.COLOR_BGR2GRAY)
+            imageGrayFiltered = cameraManager.filterNoises(imageGray)
+            maskCrop = cameraManager.cropPlate(imageGray, cameraManager.findPlateMask(imageGrayFiltered))
+            plateCorners = cameraManager.findPlateCorners(imageGrayFiltered)
+            self.assertTrue((cameraManager.cropPlateByCorners(imageGray, plateCorners) == maskCrop).all())
+            rectifiedPlate = cameraManager.rectifyPlateImage(imageGray, plateCorners)
+            self.assertLessEqual(rectifiedPlate.shape[0], maskCrop.shape[0])
+            self.assertLessEqual(rectifiedPlate.shape[1], maskCrop.shape[1])
+
+    def testPlateFormatAndTextBoxScoring(self):
+        self.assertEqual([plateFormatScore(text) for text in ['PO 156VN', 'WY 8686W', 'HR.26 BR 9044', 'NISSAN', 'PL']],
+                         [1.0, 1.0, 0.8, 0.3, 0.3])
+        cameraManager = CameraManager(['pl', 'en'])
+        plateCorners = np.array([[[0, 0]], [[460, 0]], [[460, 100]], [[0, 100]]])
+        box = lambda x: [[x, 0], [x + 40, 0], [x + 40, 90], [x, 90]]
+        ocrResult = [(box(200), "156VN", 0.85), (box(0), "PL", 0.99), (box(60), "PO", 0.9)] # country strip and plate in pieces
+        plateNumber, confidence = cameraManager.scorePlateRead(ocrResult, plateCorners)
+        self.assertEqual(plateNumber, "PO 156VN")
+        self.assertAlmostEqual(confidence, 0.85)
+
+    def testLowConfidenceReadTriesNextCandidate(self):
+        image = cv2.imread('testData/vehicle3.jpg') # plate-shaped candidates 312 and 115 px wide, then a 60 px wide one
+        reader = ScriptedOcrReader({312: ("NISSAN", 0.9), 115: ("WY 726XE", 0.8)})
+        cameraManager = CameraManager(['pl', 'en'], StaticOcrCache(reader), plateReadCache=PlateReadCache())
+        plateRead = cameraManager.getVehiclePlateNumberWithConfidence(image)
+        self.assertEqual((plateRead.plateNumber, plateRead.candidate, plateRead.ocrRuns), ('WY 726XE', 1, 2))
+        self.assertAlmostEqual(plateRead.confidence, 0.8)
+        self.assertEqual(cameraManager.getVehiclePlateNumberWithConfidence(image).ocrRuns, 0) # confident reads are cached
+
+        reader.readsByWidth[312] = ("WY 726XE", 0.95)
+        plateRead = CameraManager(['pl', 'en'], StaticOcrCache(reader)).getVehiclePlateNumberWithConfidence(image)
+        self.assertEqual((plateRead.plateNumber, plateRead.candidate, plateRead.ocrRuns), ('WY 726XE', 0, 1))
+
+        # no candidate is good enough: all of them are read and the best one is returned with its low confidence
+        reader.readsByWidth = {312: ("NISSAN", 0.9), 115: ("CITY", 0.95), 60: ("PL", 0.99)}
+        plateRead = CameraManager(['pl', 'en'], StaticOcrCache(reader)).getVehiclePlateNumberWithConfidence(image)
+        self.assertEqual((plateRead.plateNumber, plateRead.candidate, plateRead.ocrRuns), ('CITY', 1, 3))
+        self.assertLess(plateRead.confidence, 0.5)
+
+    def testOcrModelIsSharedBetweenCameras(self):
+        entranceCamera = CameraManager(['pl', 'en'])
+        exitCamera = CameraManager(['pl', 'en'])
+        self.assertIs(entranceCamera.ocrCache, exitCamera.ocrCache)
+        entranceCamera.warmUpOcr()
+        self.assertTrue(exitCamera.ocrCache.isLoaded(['pl', 'en']))
+        self.assertIs(entranceCamera.ocrCache.getReader(['pl', 'en']), exitCamera.ocrCache.getReader(['pl', 'en']))
+
     def testCameraPicturesTaking(self):
         cameraManager = CameraManager(['pl', 'en'])
         # image = cameraManager.takePhoto()
@@ -45,6 +160,62 @@ class TestCameraManager(unittest.TestCase):
         # wasPhotoTaken = os.path.exists("test_image.png")
         # self.assertTrue(wasPhotoTaken, "Photo was not taken")
 
+    def testPhotoTakingFromFileSource(self):
+        cameraManager = CameraManager(['pl', 'en'], frameSource=ImageFileSource(['testData/vehicle0.jpg']))
+        try:
+            image = cameraManager.takePhoto()
+            self.assertIsNotNone(image, "Photo was not taken")
+            self.assertEqual(image.shape, cv2.imread('testData/vehicle0.jpg').shape)
+            self.assertTrue(cameraManager.captureSession.isRunning())
+        finally:
+            cameraManager.closeCapture()
+        self.assertIsNone(cameraManager.captureSession)
+
+    def testCaptureSessionReconnectsAfterLostSource(self):
+        class FlakySource(SyntheticFrameSource):
+            def __init__(self):
+                super().__init__(width=64, height=48)
+                self.framesLeft = 3
+            def read(self):
+                self.framesLeft -= 1
+                return super().read() if self.framesLeft >= 0 else None
+            def open(self):
+                self.framesLeft = 3
+                return True
+
+        with CaptureSession(FlakySource(), reconnectDelay=0.01, maxFailedReads=2) as session:
+            self.assertIsNotNone(session.getLatestFrame(timeout=1))
+            with time_limit(5, "capture reconnect"):
+                while session.reconnectCount == 0:
+                    time.sleep(0.01)
+        self.assertFalse(session.isRunning())
+
+
+class TestPlateReadCache(unittest.TestCase):
+    def setUp(self):
+        cameraManager = CameraManager(['pl', 'en'])
+        self.plateImages = [cameraManager.locatePlate(cv2.imread(f'testData/vehicle{i}.jpg')) for i in range(3)]
+        self.now = 0.0
+        self.plateReadCache = PlateReadCache(maxSize=2, ttl=5.0, clock=lambda: self.now)
+
+    def testSamePlateIsServedFromCache(self):
+        self.assertIsNone(self.plateReadCache.lookup(self.plateImages[0]))
+        self.plateReadCache.store(self.plateImages[0], 'PO 156VN')
+        self.assertEqual(self.plateReadCache.lookup(self.plateImages[0].copy()), 'PO 156VN')
+        self.assertIsNone(self.plateReadCache.lookup(self.plateImages[1]))
+        self.assertEqual(self.plateReadCache.getStats()["hits"], 1)
+        self.assertEqual(self.plateReadCache.getStats()["misses"], 2)
+
+    def testEntriesExpireAndAreBounded(self):
+        self.plateReadCache.store(self.plateImages[0], 'PO 156VN')
+        self.now = 6.0
+        self.assertIsNone(self.plateReadCache.lookup(self.plateImages[0]))
+        for plateImage, plateNumber in zip(self.plateImages, ['PO 156VN', 'HR.26 BR 9044', 'WY 8686W']):
+            self.plateReadCache.store(plateImage, plateNumber)
+        self.assertIsNone(self.plateReadCache.lookup(self.plateImages[0])) # least recently used was dropped
+        self.assertEqual(self.plateReadCache.lookup(self.plateImages[2]), 'WY 8686W')
+        self.assertEqual(self.plateReadCache.getStats()["size"], 2)
+
 
 class TestTollBarManager(unittest.TestCase):
     def testBarrierSensorsLogic(self):
@@ -83,7 +254,844 @@ class TestTollBarManager(unittest.TestCase):
            barrierManager.getSensorByLocation(SensorLocation.UnderTollBar).value = True
            barrierManager.closeBarrier()
         self.assertEqual(barrierManager.barrier.postition, 90) # barrier should not be closed
-        
+
+    def testBarrierReversesWhenVehicleGoesUnderIt(self):
+        barrierManager = TollBarManager()
+        barrierManager.motionProfile = MotionProfile(stepDegrees=1, stepInterval=0.005)
+        barrierManager.openGateTime = 0
+        barrierManager.openBarrier()
+        self.assertTrue(barrierManager.startClosing())
+        self.assertTrue(barrierManager.isMoving()) # closing runs in the background
+        while barrierManager.getPosition() > 60:
+            time.sleep(0.005)
+        barrierManager.getSensorByLocation(SensorLocation.UnderTollBar).value = True
+        self.assertTrue(barrierManager.waitForMotion(timeout=2))
+        self.assertEqual(barrierManager.barrier.state, BarrierState.Open)
+        self.assertEqual(barrierManager.getPosition(), 90)
+        self.assertGreater(barrierManager.obstructionCount, 0)
+
+    def testForegroundPauseLeavesBarrierOpen(self):
+        barrierManager = TollBarManager()
+        barrierManager.isMotionInBackground = False
+        barrierManager.obstructionBehaviour = ObstructionBehaviour.Pause
+        barrierManager.openGateTime = 0
+        barrierManager.openBarrier()
+        barrierManager.getSensorByLocation(SensorLocation.UnderTollBar).value = True
+        with time_limit(2):
+            self.assertTrue(barrierManager.startClosing()) # returns although the vehicle stays under the barrier
+        self.assertEqual(barrierManager.barrier.state, BarrierState.Open)
+        self.assertEqual(barrierManager.getPosition(), 90)
+        barrierManager.getSensorByLocation(SensorLocation.UnderTollBar).value = False
+        barrierManager.closeBarrier()
+        self.assertEqual(barrierManager.barrier.state, BarrierState.Closed)
+
+
+class DummyCamera:
+    def __init__(self, plateNumber):
+        self.plateNumber = plateNumber
+    def warmUpOcr(self):
+        pass
+    def closeCapture(self):
+        pass
+    def takePhoto(self):
+        return "photo"
+    def getVehiclePlateNumber(self, image):
+        return self.plateNumber
+
+class DummyParkingDb:
+    def __init__(self):
+        self.parkedCars = set()
+        self.paidCars = set()
+    def addCarEntryRecord(self, registration, entranceTime=None):
+        self.parkedCars.add(registration)
+    def releaseCarFromDb(self, registration, exitTime=None):
+        self.parkedCars.discard(registration)
+    def wasFeePaid(self, registration):
+        return registration in self.paidCars
+
+
+class TestGateController(unittest.TestCase):
+    def setUp(self):
+        self.barrierManager = TollBarManager()
+        self.barrierManager.openGateTime = 0
+        self.parkingDb = DummyParkingDb()
+
+    def setSensors(self, before, under, behind):
+        self.barrierManager.getSensorByLocation(SensorLocation.BeforeTollBar).value = before
+        self.barrierManager.getSensorByLocation(SensorLocation.UnderTollBar).value = under
+        self.barrierManager.getSensorByLocation(SensorLocation.BehindTollBar).value = behind
+
+    def stepAndWaitForBarrier(self, gate):
+        gate.step()
+        self.barrierManager.waitForMotion()
+
+    def testEntranceGateStateMachine(self):
+        gate = GateController(GateType.Entrance, DummyCamera('PO 156VN'), self.barrierManager, self.parkingDb)
+        gate.step()
+        self.assertEqual(gate.state, GateState.Idle)
+        self.setSensors(True, False, False)
+        self.barrierManager.openGateTime = 60
+        self.stepAndWaitForBarrier(gate)
+        self.assertEqual(gate.state, GateState.Open)
+        self.assertEqual(self.barrierManager.barrier.state, BarrierState.Open)
+        self.barrierManager.openGateTime = 0
+        self.setSensors(False, False, True)
+        self.stepAndWaitForBarrier(gate) # starts closing
+        self.stepAndWaitForBarrier(gate) # barrier closed, vehicle behind it
+        self.assertEqual(gate.state, GateState.Idle)
+        self.assertEqual(self.barrierManager.barrier.state, BarrierState.Closed)
+        self.assertIn('PO 156VN', self.parkingDb.parkedCars)
+
+    def testExitGateWaitsForPayment(self):
+        self.parkingDb.parkedCars.add('WY 8686W')
+        gate = GateController(GateType.Exit, DummyCamera('WY 8686W'), self.barrierManager, self.parkingDb)
+        gate.deniedRecheckInterval = 0
+        self.setSensors(True, False, False)
+        gate.step()
+        self.assertEqual(gate.state, GateState.Denied)
+        self.assertEqual(self.barrierManager.barrier.state, BarrierState.Closed)
+        self.parkingDb.paidCars.add('WY 8686W')
+        self.barrierManager.openGateTime = 60
+        self.stepAndWaitForBarrier(gate)
+        self.assertEqual(gate.state, GateState.Open)
+        self.barrierManager.openGateTime = 0
+        self.setSensors(False, False, True)
+        self.stepAndWaitForBarrier(gate)
+        self.stepAndWaitForBarrier(gate)
+        self.assertNotIn('WY 8686W', self.parkingDb.parkedCars)
+
+    def testIdleGateDoesNotSpin(self):
+        gate = GateController(GateType.Entrance, DummyCamera(None), self.barrierManager, self.parkingDb, SensorMode.Polling, pollRate=50)
+        gateThread = threading.Thread(target=gate.run)
+        cpuTimeStart = time.process_time()
+        gateThread.start()
+        time.sleep(1)
+        gate.stop()
+        gateThread.join(timeout=1)
+        self.assertFalse(gateThread.is_alive())
+        self.assertLess(time.process_time() - cpuTimeStart, 0.5)
+
+
+class SlowDummyCamera(DummyCamera):
+    def getVehiclePlateNumber(self, image):
+        time.sleep(0.5)
+        return self.plateNumber
+
+
+class TestGateSupervisor(unittest.TestCase):
+    def testSlowPlateReadDoesNotStallOtherLanes(self):
+        gateConfigs = [GateConfig("entrance-1", GateType.Entrance, 17, 18, 19, 20),
+                       GateConfig("entrance-2", GateType.Entrance, 21, 22, 23, 24)]
+        supervisor = GateSupervisor(gateConfigs, parkingDb=DummyParkingDb(), ocrWorkers=2)
+        slowGate, fastGate = supervisor.gates
+        slowGate.cameraHandler = SlowDummyCamera('PO 156VN')
+        fastGate.cameraHandler = DummyCamera('WY 8686W')
+        for gate in supervisor.gates:
+            gate.barrierHandler.openGateTime = 0
+            gate.barrierHandler.updateSensors = lambda: None # sensor values are set by the test
+            gate.barrierHandler.getSensorByLocation(SensorLocation.BeforeTollBar).value = True
+
+        async def runForAWhile():
+            supervisorTask = asyncio.ensure_future(supervisor.run())
+            await asyncio.sleep(0.3)
+            supervisor.stop()
+            await supervisorTask
+
+        asyncio.run(runForAWhile())
+        supervisor.close()
+        health = supervisor.getHealth()
+        self.assertLessEqual(len(slowGate.stats.plateReadLatencies), 1)
+        self.assertGreater(len(fastGate.stats.plateReadLatencies), 2)
+        self.assertTrue(health["entrance-2"]["healthy"])
+
+    def testAsyncGateCountsDecisionsAndPassages(self):
+        decisions = metrics.counter("gate_decisions_total", "")
+        passages = metrics.counter("gate_passages_total", "")
+        allowedBefore, passagesBefore = decisions.get("Entrance", "allowed"), passages.get("Entrance")
+        parkingDb = ParkingDB("sqlite://")
+        barrierManager = TollBarManager()
+        entranceTime = datetime(2024, 3, 1, 8, 0)
+        with ThreadPoolExecutor(2) as executor:
+            gate = AsyncGateController("entrance-1", GateType.Entrance, DummyCamera('PO 156VN'), barrierManager,
+                                       AsyncParkingDB(parkingDb, executor), executor, eventClock=lambda: entranceTime)
+            barrierManager.getSensorByLocation(SensorLocation.BeforeTollBar).value = True
+            barrierManager.openGateTime = 60
+            asyncio.run(gate.stepAsync())
+            barrierManager.waitForMotion()
+            self.assertEqual(gate.state, GateState.Open)
+            barrierManager.openGateTime = 0
+            barrierManager.getSensorByLocation(SensorLocation.BeforeTollBar).value = False
+            barrierManager.getSensorByLocation(SensorLocation.BehindTollBar).value = True
+            for _ in range(2): # starts closing, then the barrier is closed behind the vehicle
+                asyncio.run(gate.stepAsync())
+                barrierManager.waitForMotion()
+        self.assertEqual(gate.state, GateState.Idle)
+        self.assertEqual(decisions.get("Entrance", "allowed"), allowedBefore + 1)
+        self.assertEqual(passages.get("Entrance"), passagesBefore + 1)
+        self.assertEqual(gate.stats.vehiclesServed, 1)
+        self.assertEqual(parkingDb.getOpenSession('PO 156VN')[1], entranceTime)
+
+
+class TestParkingDB(unittest.TestCase):
+    def testParkedCarsKeysetPagination(self):
+        parkingDb = ParkingDB("sqlite://")
+        plates = [f'PO {car:03d}AA' for car in range(7)]
+        for plate in plates:
+            parkingDb.addCarEntryRecord(plate)
+        parkingDb.releaseCarFromDb(plates[3])
+        parkingDb.updateParkingEndTime(plates[4]) # still inside until it exits
+        pages, after = [], None
+        while True:
+            rows = parkingDb.getParkedCarsPage(3, after, "Registration_number", descending=True)
+            pages.append([row.Registration_number for row in rows[:3]])
+            if len(rows) <= 3:
+                break
+            after = (rows[2].Registration_number, rows[2].ID)
+        expectedPlates = sorted(plates[:3] + plates[4:], reverse=True)
+        self.assertEqual(pages, [expectedPlates[:3], expectedPlates[3:]])
+        self.assertEqual([row.Registration_number for row in parkingDb.getParkedCarsPage(10, search='05')], [plates[5]])
+        self.assertEqual(parkingDb.getParkedCarsPage(10, search='%'), [])
+
+    def testInMemorySqliteBackend(self):
+        parkingDb = ParkingDB("sqlite://")
+        parkingDb.addCarEntryRecord('PO 156VN')
+        parkingDb.addCarEntryRecord('WY 8686W')
+        self.assertEqual(parkingDb.getNumberOfCarsInAParkingLot(), 2)
+        parkingDb.updateParkingEndTime('PO 156VN')
+        parkingDb.updatePaymentStatus('PO 156VN')
+        self.assertTrue(parkingDb.wasFeePaid('PO 156VN'))
+        parkingDb.releaseCarFromDb('PO 156VN')
+        parkingDb.addCarEntryRecord('PO 156VN')
+        self.assertEqual(parkingDb.findLastIdByRegistration('PO 156VN'), 3)
+        self.assertEqual(parkingDb.getNumberOfCarsInAParkingLot(), 2)
+
+    def testMigrationNeverMovesIdSequenceBack(self):
+        parkingDb = ParkingDB()
+        if parkingDb.engine.dialect.name != "postgresql":
+            self.skipTest("IDs come from a sequence on PostgreSQL only")
+        sequence = parkingDb.engine.execute(text("SELECT pg_get_serial_sequence('\"Parking_lot\"', 'ID')")).scalar()
+        for _ in range(3): # IDs taken by another process, its rows not committed yet
+            issuedId = parkingDb.engine.execute(text(f"SELECT nextval('{sequence}')")).scalar()
+        parkingDb.migrateParkingLotTable()
+        registration = 'TEST ' + str(time.time_ns())[-8:]
+        parkingDb.addCarEntryRecord(registration)
+        self.assertGreater(parkingDb.findLastIdByRegistration(registration), issuedId)
+        parkingDb.releaseCarFromDb(registration)
+
+    def testOneOpenSessionPerPlate(self):
+        parkingDb = ParkingDB("sqlite://")
+        parkingDb.addCarEntryRecord('PO 156VN')
+        secondSession = parkingDb.Parking_lot_table.insert().values(Registration_number='PO 156VN', Entrance_time=datetime.now())
+        self.assertRaises(IntegrityError, parkingDb.engine.execute, secondSession) # e.g. another gate inserting at the same time
+        parkingDb.releaseCarFromDb('PO 156VN')
+        parkingDb.engine.execute(secondSession) # closed sessions do not count
+        parkingDb.engine.execute(parkingDb.Parking_lot_table.insert().values(Registration_number=None))
+        parkingDb.engine.execute(parkingDb.Parking_lot_table.insert().values(Registration_number=None)) # unread plates
+        self.assertEqual(parkingDb.getTableLength(), 4)
+
+    def testConcurrentEntriesOpenOneSession(self):
+        parkingDb = ParkingDB()
+        if parkingDb.engine.dialect.name != "postgresql":
+            self.skipTest("SQLite serializes writers, the gates can not race")
+        registration = 'TEST ' + str(time.time_ns())[-8:]
+        with parkingDb.engine.connect() as otherGate:
+            transaction = otherGate.begin()
+            otherGate.execute(parkingDb.Parking_lot_table.insert().values(Registration_number=registration, Entrance_time=datetime.now()))
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                entry = executor.submit(parkingDb.addCarEntryRecord, registration) # does not see the uncommitted session
+                time.sleep(0.2)
+                transaction.commit()
+                self.assertIsNone(entry.result(10)) # already parked
+        self.assertEqual(parkingDb.engine.execute(select(func.count()).where(parkingDb.Parking_lot_table.columns.Registration_number == registration)).scalar(), 1)
+        parkingDb.releaseCarFromDb(registration)
+
+    def testParkingDbIsSharedInProcess(self):
+        self.assertIs(getSharedParkingDB(), getSharedParkingDB())
+        self.assertIs(AutomatedParkingSystem().parkingDb, getSharedParkingDB())
+        with tempfile.TemporaryDirectory() as dbDir:
+            db_string = "sqlite:///" + os.path.join(dbDir, "parking.db")
+            parkingDb = getSharedParkingDB(db_string)
+            self.assertIsNot(parkingDb, getSharedParkingDB())
+            self.assertIs(parkingDb, getSharedParkingDB(db_string))
+            parkingDb.engine.dispose()
+
+    def testCarLifecycleUsesOneRoundTripPerOperation(self):
+        parkingDb = ParkingDB()
+        statements = []
+        event.listen(parkingDb.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+        registration = 'TEST ' + str(time.time_ns())[-8:]
+        parkingDb.addCarEntryRecord(registration)
+        parkingDb.addCarEntryRecord(registration) # already parked, nothing inserted
+        self.assertEqual(len(statements), 2)
+        parkingDb.updateParkingEndTime(registration)
+        self.assertEqual(len(statements), 4) # locked select and a single update in one transaction
+        parkingDb.updatePaymentStatus(registration)
+        self.assertTrue(parkingDb.wasFeePaid(registration))
+        parkingDb.releaseCarFromDb(registration)
+        self.assertEqual(len(statements), 7)
+        self.assertFalse(parkingDb.isCarParked(registration))
+        self.assertEqual(parkingDb.getFee(registration), 0)
+
+
+class TestOccupancyIndex(unittest.TestCase):
+    def testIndexAnswersFromMemoryAndPersists(self):
+        parkingDb = ParkingDB("sqlite://")
+        parkingDb.addCarEntryRecord('PO 156VN')
+        occupancyIndex = OccupancyIndex(parkingDb, GateEventJournal(parkingDb, flushInterval=60))
+        self.assertTrue(occupancyIndex.isCarParked('PO 156VN')) # rebuilt from the database
+
+        statements = []
+        event.listen(parkingDb.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+        occupancyIndex.addCarEntryRecord('WY 8686W')
+        occupancyIndex.updateParkingEndTime('WY 8686W')
+        occupancyIndex.updatePaymentStatus('WY 8686W')
+        self.assertTrue(occupancyIndex.wasFeePaid('WY 8686W'))
+        self.assertEqual(occupancyIndex.getFee('WY 8686W'), 0)
+        self.assertEqual(occupancyIndex.getNumberOfCarsInAParkingLot(), 2)
+        occupancyIndex.flush()
+        self.assertEqual(len(statements), 4) # one batch: sessions of its plates, then one statement per event of the plate
+        self.assertTrue(parkingDb.wasFeePaid('WY 8686W'))
+
+        occupancyIndex.releaseCarFromDb('WY 8686W')
+        parkingDb.updatePaymentStatus('PO 156VN') # e.g. a pay station writing to the database directly
+        self.assertTrue(occupancyIndex.wasFeePaid('PO 156VN'))
+        occupancyIndex.flush()
+        self.assertEqual(parkingDb.getNumberOfCarsInAParkingLot(), 1)
+        occupancyIndex.rebuild()
+        self.assertEqual(occupancyIndex.getNumberOfCarsInAParkingLot(), 1)
+        occupancyIndex.close()
+
+    def testPaymentOfAnotherProcessOpensExitGate(self):
+        with tempfile.TemporaryDirectory() as dbDir:
+            db_string = "sqlite:///" + os.path.join(dbDir, "parking.db")
+            gateDb = ParkingDB(db_string)
+            occupancyIndex = OccupancyIndex(gateDb, GateEventJournal(gateDb, flushInterval=60))
+            payStationDb = ParkingDB(db_string) # e.g. the web app, its writes never reach the listener of the index
+            payStationDb.addCarEntryRecord('WY 8686W') # entered through the gate of another process
+            payStationDb.updateParkingEndTime('WY 8686W')
+
+            barrierManager = TollBarManager()
+            barrierManager.openGateTime = 60
+            gate = GateController(GateType.Exit, DummyCamera('WY 8686W'), barrierManager, occupancyIndex)
+            gate.deniedRecheckInterval = 0
+            barrierManager.getSensorByLocation(SensorLocation.BeforeTollBar).value = True
+            gate.step()
+            self.assertEqual(gate.state, GateState.Denied)
+            payStationDb.updatePaymentStatus('WY 8686W')
+            gate.step()
+            barrierManager.waitForMotion()
+            self.assertEqual(gate.state, GateState.Open)
+            self.assertTrue(occupancyIndex.getSession('WY 8686W').isPaid)
+            occupancyIndex.close()
+
+    def testGatesShareOneIndex(self):
+        self.assertIs(getSharedOccupancyIndex(getSharedParkingDB()), AutomatedParkingSystem().occupancyIndex)
+
+
+class TestGateEventJournal(unittest.TestCase):
+    def testEventsAreWrittenInBatches(self):
+        parkingDb = ParkingDB("sqlite://")
+        journal = GateEventJournal(parkingDb, flushInterval=60)
+        statements = []
+        event.listen(parkingDb.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+        now = datetime.now().replace(microsecond=0)
+        for registration in ['PO 156VN', 'WY 8686W', 'WY 726XE']:
+            journal.append(ParkingEventType.Entry, registration, now)
+        journal.append(ParkingEventType.Exit, 'WY 726XE', now)
+        self.assertTrue(journal.flush(timeout=5))
+        self.assertEqual(len(statements), 3) # sessions of the plates, all entries in one statement, then the exit
+        self.assertEqual(parkingDb.getNumberOfCarsInAParkingLot(), 2)
+        journal.close()
+
+    def testReplayedEventsAreNotifiedOnce(self):
+        parkingDb = ParkingDB("sqlite://")
+        notified = []
+        parkingDb.addEventListener(lambda eventType, registration, eventTime, **details: notified.append((eventType, registration)))
+        journal = GateEventJournal(parkingDb, flushInterval=60)
+        now = datetime.now().replace(microsecond=0)
+        journal.append(ParkingEventType.Entry, 'PO 156VN', now)
+        journal.append(ParkingEventType.Entry, 'WY 8686W', now)
+        journal.append(ParkingEventType.End, 'WY 8686W', now, minutes=0, fee=0)
+        journal.append(ParkingEventType.Exit, 'WY 8686W', now)
+        journal.append(ParkingEventType.Exit, 'WY 726XE', now) # never parked
+        batch = journal.getPendingEvents()
+        self.assertTrue(journal.flush(timeout=5))
+        self.assertEqual(len(notified), 4)
+
+        parkingDb.applyEvents(batch) # replayed after a crash before the checkpoint was written
+        self.assertEqual(len(notified), 4)
+        self.assertEqual(parkingDb.getTableLength(), 2)
+        self.assertEqual(parkingDb.getNumberOfCarsInAParkingLot(), 1)
+        journal.close()
+
+    def testJournalIsReplayedAfterCrash(self):
+        class UnavailableDb:
+            def applyEvents(self, events):
+                raise ConnectionError("database is down")
+
+        with tempfile.TemporaryDirectory() as journalDir:
+            journalPath = os.path.join(journalDir, "gate_events.journal")
+            crashedJournal = GateEventJournal(UnavailableDb(), journalPath, flushInterval=0.01, retryDelay=60)
+            now = datetime.now().replace(microsecond=0)
+            crashedJournal.append(ParkingEventType.Entry, 'PO 156VN', now)
+            crashedJournal.append(ParkingEventType.Entry, 'WY 8686W', now)
+            crashedJournal.append(ParkingEventType.Exit, 'WY 8686W', now)
+            self.assertFalse(crashedJournal.flush(timeout=0.1))
+            crashedJournal.close(timeout=0.1)
+
+            parkingDb = ParkingDB("sqlite://")
+            journal = GateEventJournal(parkingDb, journalPath, flushInterval=60)
+            self.assertEqual(journal.getStats()["replayed"], 3)
+            occupancyIndex = OccupancyIndex(parkingDb, journal)
+            self.assertTrue(occupancyIndex.isCarParked('PO 156VN')) # known before it reached the database
+            self.assertTrue(occupancyIndex.flush(timeout=5))
+            self.assertEqual(parkingDb.getTableLength(), 2)
+            self.assertEqual(parkingDb.getNumberOfCarsInAParkingLot(), 1)
+            occupancyIndex.close()
+
+            replayedJournal = GateEventJournal(parkingDb, journalPath, flushInterval=60)
+            self.assertEqual(replayedJournal.getStats()["replayed"], 0) # checkpoint moved past the persisted events
+            replayedJournal.close()
+
+    def testEveryProcessWritesItsOwnJournal(self):
+        class UnavailableDb:
+            def applyEvents(self, events):
+                raise ConnectionError("database is down")
+
+        parkingDb = ParkingDB("sqlite://")
+        with tempfile.TemporaryDirectory() as stateDir, mock.patch.dict(os.environ, PARKING_JOURNAL_DIR=os.path.join(stateDir, "journal")):
+            db_string = "sqlite:///parking.db"
+            entranceJournal = GateEventJournal(UnavailableDb(), getJournalPath(db_string, "entrance"), flushInterval=0.01, retryDelay=60)
+            self.assertEqual(os.path.dirname(entranceJournal.path), os.path.join(stateDir, "journal")) # created when missing
+            exitJournal = GateEventJournal(parkingDb, getJournalPath(db_string, "exit"), flushInterval=60)
+            self.assertNotEqual(entranceJournal.path, exitJournal.path)
+            with self.assertRaises(JournalInUse): # a second writer would overwrite the checkpoint
+                GateEventJournal(parkingDb, entranceJournal.path)
+
+            now = datetime.now().replace(microsecond=0)
+            entranceJournal.append(ParkingEventType.Entry, 'PO 156VN', now)
+            exitJournal.append(ParkingEventType.Entry, 'WY 8686W', now)
+            self.assertFalse(entranceJournal.flush(timeout=0.1))
+            entranceJournal.close(timeout=0.1) # crashed before the event reached the database
+            self.assertTrue(exitJournal.flush(timeout=5)) # the checkpoint of the other process is not touched
+
+            journal = GateEventJournal(parkingDb, getJournalPath(db_string), flushInterval=60)
+            self.assertEqual(len(getJournalPaths(db_string)), 3)
+            self.assertEqual(journal.adoptOrphanedJournals(getJournalPaths(db_string)), 1) # the running exit gate is skipped
+            self.assertEqual(len(getJournalPaths(db_string)), 2)
+            self.assertTrue(journal.flush(timeout=5))
+            self.assertTrue(parkingDb.isCarParked('PO 156VN'))
+            self.assertEqual(parkingDb.getNumberOfCarsInAParkingLot(), 2)
+            journal.close()
+            exitJournal.close()
+            self.assertEqual(getJournalPaths(db_string), []) # everything persisted, nothing left to replay
+
+
+class TestOccupancyCache(unittest.TestCase):
+    def testGateEventsUpdateCacheWithoutQueries(self):
+        parkingDb = ParkingDB("sqlite://")
+        parkingDb.addCarEntryRecord('PO 156VN')
+        self.now = 0.0
+        occupancyCache = OccupancyCache(parkingDb, 100, ttl=5.0, clock=lambda: self.now)
+        snapshot = occupancyCache.getSnapshot()
+        self.assertEqual((snapshot.parked, snapshot.free), (1, 99))
+
+        parkingDb.addCarEntryRecord('WY 8686W')
+        parkingDb.updateParkingEndTime('PO 156VN')
+        self.assertEqual(occupancyCache.getSnapshot().parked, 2)
+        self.assertNotEqual(occupancyCache.getSnapshot().etag, snapshot.etag)
+        exitTime = datetime.now().replace(microsecond=0) - timedelta(minutes=1)
+        parkingDb.releaseCarFromDb('PO 156VN', exitTime)
+        self.assertEqual(occupancyCache.getSnapshot().parked, 1)
+        parkingDb.releaseCarFromDb('PO 156VN') # repeated exit read, the car already left
+        self.assertEqual(occupancyCache.getSnapshot().parked, 1)
+        exitTimes = parkingDb.engine.execute(select(parkingDb.Parking_lot_table.columns.Exit_time)).fetchall()
+        self.assertIn((exitTime,), exitTimes)
+        self.assertEqual(occupancyCache.reloads, 1)
+
+        self.now = 6.0 # ttl passed, data re-read
+        etag = occupancyCache.getSnapshot().etag
+        self.now = 12.0
+        self.assertEqual(occupancyCache.getSnapshot().etag, etag) # nothing changed in between
+        self.assertEqual(occupancyCache.reloads, 3)
+        occupancyCache.close()
+
+    def testPollingClientGetsNotModified(self):
+        client = Main.app.test_client()
+        response = client.get("/api/occupancy")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("parked", response.get_json())
+        etag, lastModified = response.headers["ETag"], response.headers["Last-Modified"]
+        response = client.get("/api/occupancy", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        response = client.get("/", headers={"If-Modified-Since": lastModified})
+        self.assertEqual(response.status_code, 304)
+        response = client.get("/stats?sort=plate&order=desc&limit=1")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"<table", response.data)
+
+
+class TestStatisticsRollup(unittest.TestCase):
+    def testIncrementalRollupMatchesBackfill(self):
+        parkingDb = ParkingDB("sqlite://")
+        statisticsRollup = StatisticsRollup(parkingDb, flushInterval=60)
+        day = datetime(2024, 3, 1, 8, 0)
+        parkingDb.addCarEntryRecord('PO 156VN', day)
+        parkingDb.addCarEntryRecord('WY 8686W', day + timedelta(minutes=30))
+        parkingDb.updateParkingEndTime('PO 156VN', day + timedelta(minutes=90))
+        parkingDb.releaseCarFromDb('PO 156VN', day + timedelta(minutes=95))
+        parkingDb.addCarEntryRecord('WY 726XE', day + timedelta(hours=26))
+        statisticsRollup.flush()
+        hourly = parkingDb.getStatistics(StatisticsGranularity.Hour, day, day + timedelta(days=2))
+        daily = parkingDb.getStatistics(StatisticsGranularity.Day)
+
+        self.assertEqual([period["entries"] for period in hourly], [2, 0, 1])
+        self.assertEqual([period["peakOccupancy"] for period in hourly], [2, 2, 2])
+        self.assertEqual(hourly[1]["revenue"], parkingDb.tariff.calculateFee(day, day + timedelta(minutes=90)))
+        self.assertEqual(hourly[1]["averageDuration"], 90)
+        self.assertEqual([(period["entries"], period["exits"]) for period in daily], [(2, 1), (1, 0)])
+
+        statisticsRollup.backfill()
+        self.assertEqual(parkingDb.getStatistics(StatisticsGranularity.Hour, day, day + timedelta(days=2)), hourly)
+        self.assertEqual(parkingDb.getStatistics(StatisticsGranularity.Day), daily)
+        statisticsRollup.close()
+
+    def testPeakOccupancyCountsCarsOfOtherProcesses(self):
+        with tempfile.TemporaryDirectory() as dbDir:
+            db_string = "sqlite:///" + os.path.join(dbDir, "parking.db")
+            parkingDb = ParkingDB(db_string)
+            statisticsRollup = StatisticsRollup(parkingDb, flushInterval=60)
+            otherGateDb = ParkingDB(db_string) # gate of another process, its events never reach the rollup
+            day = datetime(2024, 3, 1, 8, 0)
+            otherGateDb.addCarEntryRecord('WY 726XE', day - timedelta(hours=1))
+            otherGateDb.addCarEntryRecord('PO 156VN', day + timedelta(minutes=5))
+            parkingDb.addCarEntryRecord('WY 8686W', day + timedelta(minutes=10))
+            parkingDb.updateParkingEndTime('WY 8686W', day + timedelta(hours=2, minutes=10))
+            statisticsRollup.flush()
+            hourly = parkingDb.getStatistics(StatisticsGranularity.Hour, day, day + timedelta(days=1))
+            self.assertEqual([period["peakOccupancy"] for period in hourly], [3, 3])
+            self.assertEqual(parkingDb.getStatistics(StatisticsGranularity.Day)[0]["peakOccupancy"], 3)
+            statisticsRollup.close()
+
+    def testRevenueFollowsRecalculatedFees(self):
+        parkingDb = ParkingDB("sqlite://")
+        statisticsRollup = StatisticsRollup(parkingDb, flushInterval=60)
+        day = datetime(2024, 3, 1, 8, 0)
+        parkingDb.addCarEntryRecord('PO 156VN', day)
+        parkingDb.addCarEntryRecord('WY 8686W', day)
+        parkingDb.updateParkingEndTime('PO 156VN', day + timedelta(minutes=90))
+        parkingDb.updateParkingEndTime('WY 8686W', day + timedelta(minutes=30))
+        self.assertIsNone(parkingDb.updateParkingEndTime('PO 156VN', day + timedelta(hours=5))) # parking ends once
+        self.assertEqual(parkingDb.getFee('PO 156VN'), 3.0)
+        statisticsRollup.flush()
+        self.assertEqual(parkingDb.getStatistics(StatisticsGranularity.Day)[0]["revenue"], 4.0)
+
+        parkingDb.tariff = Tariff([TariffBand(0, 24, 4.0)])
+        parkingDb.updateFee(parkingDb.findLastIdByRegistration('WY 8686W'))
+        statisticsRollup.flush()
+        self.assertEqual(parkingDb.getStatistics(StatisticsGranularity.Day)[0]["revenue"], 5.0)
+        self.assertEqual(parkingDb.recalculateFees(day, day + timedelta(days=1)), 2)
+        statisticsRollup.flush()
+        revenue = [period["revenue"] for period in parkingDb.getStatistics(StatisticsGranularity.Hour)]
+        self.assertEqual(revenue, [2.0, 6.0])
+        self.assertEqual(parkingDb.getStatistics(StatisticsGranularity.Day)[0]["revenue"], 8.0)
+        statisticsRollup.backfill()
+        self.assertEqual([period["revenue"] for period in parkingDb.getStatistics(StatisticsGranularity.Hour)], revenue)
+        statisticsRollup.close()
+
+    def testStatisticsApi(self):
+        response = Main.app.test_client().get("/api/statistics?granularity=hour&start=2024-01-01&end=2024-01-02")
+        self.assertEqual(response.status_code, 200)
+        self.assertIsInstance(response.get_json(), list)
+        self.assertEqual(Main.app.test_client().get("/api/statistics?granularity=week").status_code, 400)
+
+
+class TestTariff(unittest.TestCase):
+    def setUp(self):
+        self.tariff = Tariff([TariffBand(0, 7, 1.0), TariffBand(7, 19, 3.0), TariffBand(19, 24, 1.5)], dailyCap=20, gracePeriod=15)
+
+    def testTariffRules(self):
+        day = datetime(2024, 3, 1)
+        self.assertEqual(self.tariff.calculateFee(day + timedelta(hours=8), day + timedelta(hours=8, minutes=15)), 0.0)
+        self.assertEqual(self.tariff.calculateFee(day + timedelta(hours=6), day + timedelta(hours=8)), 4.0)
+        self.assertEqual(self.tariff.calculateFee(day + timedelta(hours=18), day + timedelta(hours=20, minutes=20)), 5.0)
+        self.assertEqual(self.tariff.calculateFee(day, day + timedelta(days=2)), 40.0) # capped every day
+        self.assertEqual(self.tariff.calculateFee(day, day + timedelta(hours=5), hasMonthlyPass=True), 0.0)
+        self.assertEqual(Tariff().calculateFee(day, day + timedelta(minutes=90)), 3.0) # default tariff: 2/h all day
+
+    def testBatchFeesMatchPerRow(self):
+        random = np.random.default_rng(7)
+        start = datetime(2024, 1, 1)
+        entranceTimes = [start + timedelta(seconds=int(offset)) for offset in random.integers(0, 90 * 86400, 5000)]
+        endTimes = [entranceTime + timedelta(seconds=int(duration))
+                    for entranceTime, duration in zip(entranceTimes, random.integers(0, 3 * 86400, 5000))]
+        hasPass = random.random(5000) < 0.05
+        fees = self.tariff.calculateFees(entranceTimes, endTimes, hasPass).tolist()
+        self.assertEqual(fees, [self.tariff.calculateFee(*session) for session in zip(entranceTimes, endTimes, hasPass)])
+        minutes = self.tariff.calculateDurations(entranceTimes, endTimes).tolist()
+        self.assertEqual(minutes, [self.tariff.calculateDuration(*session) for session in zip(entranceTimes, endTimes)])
+
+    def testDatabaseReconciliationMatchesPerRow(self):
+        parkingDb = ParkingDB("sqlite://", tariff=self.tariff)
+        day = datetime(2024, 3, 1, 6, 40)
+        for car in range(20):
+            registration = f'PO {car:03d}AA'
+            parkingDb.addCarEntryRecord(registration, day + timedelta(minutes=37 * car))
+            parkingDb.updateParkingEndTime(registration, day + timedelta(minutes=37 * car + 11 * car * car))
+        parkingDb.addMonthlyPass('PO 003AA', day + timedelta(days=30))
+        perRowFees = [parkingDb.updateFee(id) for id in range(1, 21)]
+        self.assertEqual(perRowFees[3], 0.0)
+        self.assertEqual(parkingDb.recalculateFees(), 20)
+        self.assertEqual([parkingDb.getFee(f'PO {car:03d}AA') for car in range(20)], perRowFees)
+        parkingDb.engine.execute(parkingDb.Parking_lot_table.update().values(Parking_duration=None, Fee=None))
+        self.assertEqual([parkingDb.updateFee(id) for id in range(1, 21)], perRowFees)
+        self.assertEqual(parkingDb.getParkingDurationInMinutes('PO 010AA'), 1100) # duration is written with the fee
+        self.assertEqual(perRowFees[10], 27.5) # 12:50 to 7:10 next day: first day capped at 20, then 7 x 1.0/h + 10 min x 3.0/h
+
+        parkingDb.addCarEntryRecord('WY 8686W')
+        self.assertIsNone(parkingDb.updateFee(parkingDb.findLastIdByRegistration('WY 8686W'))) # not ended yet
+
+
+class TestPaymentManager(unittest.TestCase):
+    def testRetriedPaymentIsChargedOnce(self):
+        parkingDb = ParkingDB("sqlite://")
+        terminal = SimulatedPaymentTerminal()
+        paymentManager = PaymentManager(parkingDb, terminal)
+        parkingDb.addCarEntryRecord('PO 156VN', datetime(2024, 3, 1, 8))
+        self.assertEqual(paymentManager.pay('PO 156VN').outcome, PaymentOutcome.NotEnded)
+        parkingDb.updateParkingEndTime('PO 156VN', datetime(2024, 3, 1, 9, 30))
+        self.assertFalse(parkingDb.wasFeePaid('PO 156VN'))
+        payments = []
+        parkingDb.addEventListener(lambda eventType, registration, eventTime, **details:
+                                   payments.append(registration) if eventType == ParkingEventType.Payment else None)
+
+        result = paymentManager.pay('PO 156VN', idempotencyKey='station-1/0001')
+        self.assertEqual((result.outcome, result.amount), (PaymentOutcome.Approved, 3.0))
+        retried = paymentManager.pay('PO 156VN', idempotencyKey='station-1/0001') # e.g. the response was lost
+        self.assertEqual((retried.outcome, retried.reference), (PaymentOutcome.Approved, result.reference))
+        self.assertEqual(paymentManager.pay('PO 156VN').outcome, PaymentOutcome.AlreadyPaid)
+        self.assertEqual(terminal.charges, [('station-1/0001', 3.0)])
+        self.assertEqual(payments, ['PO 156VN']) # settled through ParkingDB, listeners hear of it once
+        self.assertTrue(parkingDb.wasFeePaid('PO 156VN'))
+        self.assertEqual(paymentManager.pay('WY 8686W').outcome, PaymentOutcome.NoSession)
+
+        # a declined card frees the session for the next attempt
+        parkingDb.addCarEntryRecord('WY 8686W', datetime(2024, 3, 1, 8))
+        parkingDb.updateParkingEndTime('WY 8686W', datetime(2024, 3, 1, 8, 30))
+        paymentManager.terminal = SimulatedPaymentTerminal(declineRate=1.0)
+        self.assertEqual(paymentManager.pay('WY 8686W').outcome, PaymentOutcome.Declined)
+        paymentManager.terminal = terminal
+        self.assertEqual(paymentManager.pay('WY 8686W').outcome, PaymentOutcome.Approved)
+        self.assertEqual([payment.Status for payment in paymentManager.getPayments('WY 8686W')], ['Declined', 'Approved'])
+        with self.assertRaises(TypeError): # a terminal has to implement charge()
+            PaymentTerminal()
+
+    def testConcurrentPaymentsChargeEachSessionOnce(self):
+        with tempfile.TemporaryDirectory() as directory:
+            parkingDb = ParkingDB(f"sqlite:///{directory}/parking.db")
+            terminal = SimulatedPaymentTerminal(latency=0.002)
+            paymentManager = PaymentManager(parkingDb, terminal)
+            plates = [f'PO {car:03d}AA' for car in range(60)]
+            for car, plate in enumerate(plates):
+                parkingDb.addCarEntryRecord(plate, datetime(2024, 3, 1, 8))
+                parkingDb.updateParkingEndTime(plate, datetime(2024, 3, 1, 9) + timedelta(minutes=car))
+            # every car is paid 5 times at once: a double tapped button (same key) and three other pay stations
+            attempts = [(plate, f'{plate}/{attempt}') for plate in plates for attempt in (0, 0, 1, 2, 3)]
+            with ThreadPoolExecutor(16) as executor:
+                results = list(executor.map(lambda attempt: paymentManager.pay(attempt[0], idempotencyKey=attempt[1]), attempts))
+
+            self.assertEqual(len(terminal.charges), len(plates))
+            self.assertEqual(sorted(amount for _, amount in terminal.charges),
+                             sorted(parkingDb.getFee(plate) for plate in plates))
+            self.assertTrue(all(parkingDb.wasFeePaid(plate) for plate in plates))
+            approved = [result for result in results if result.outcome == PaymentOutcome.Approved]
+            self.assertEqual(len({result.idempotencyKey for result in approved}), len(plates))
+            self.assertTrue(all(result.outcome in (PaymentOutcome.Approved, PaymentOutcome.AlreadyPaid, PaymentOutcome.InProgress)
+                                for result in results))
+            parkingDb.engine.dispose()
+
+
+class TestGateSimulator(unittest.TestCase):
+    def testSimulatedDayRunsThroughGatesAndPayments(self):
+        parkingDb = ParkingDB("sqlite://")
+        clock = VirtualClock(datetime(2024, 3, 1, 6))
+        simulator = GateSimulator(parkingDb, arrivalRate=120, departureRate=0.5, entranceLanes=2, seed=3, clock=clock,
+                                  paymentManager=PaymentManager(parkingDb, SimulatedPaymentTerminal(declineRate=0.2, seed=3), clock.now))
+        report = simulator.run(cars=300)
+        self.assertEqual(report.cars["exited"], 300)
+        self.assertEqual(report.cars["stuck"], 0)
+        self.assertGreater(report.cars["declinedPayments"], 0) # retried until approved
+        self.assertEqual(parkingDb.getNumberOfCarsInAParkingLot(), 0)
+        self.assertEqual(parkingDb.getTableLength(), 300)
+        self.assertGreater(report.simulatedTime, 3600) # hours of parking in a fraction of the real time
+        self.assertLess(report.realTime, report.simulatedTime / 100)
+        # records carry virtual times, so durations and fees are those of the simulated stays
+        columns = parkingDb.Parking_lot_table.columns
+        firstEntrance, averageDuration = parkingDb.engine.execute(select(func.min(columns.Entrance_time),
+                                                                         func.avg(columns.Parking_duration))).fetchone()
+        self.assertGreaterEqual(firstEntrance, datetime(2024, 3, 1, 6))
+        self.assertGreater(averageDuration, 60)
+        self.assertEqual(set(report.queues), {"entrance", "exit"})
+        self.assertEqual(len(report.stages["end of parking and payment"]), 300 + report.cars["declinedPayments"])
+
+    def testCarLingeringUnderBarrierDelaysLane(self):
+        parkingDb = ParkingDB("sqlite://")
+        lingering = SensorTrace([(3.0, (False, True, False)), (30.0, (False, False, True))])
+        normal = GateSimulator(parkingDb, arrivalRate=60, seed=5).run(cars=20)
+        slow = GateSimulator(ParkingDB("sqlite://"), arrivalRate=60, sensorTrace=lingering, seed=5).run(cars=20)
+        self.assertEqual((normal.cars["exited"], slow.cars["exited"]), (20, 20))
+        self.assertGreater(min(slow.waits["lane passage"]), max(normal.waits["lane passage"]))
+
+
+    def testStuckCarsAreNotCountedAsPassed(self):
+        parkingDb = ParkingDB("sqlite://")
+        blocking = SensorTrace([(3.0, (False, True, False))]) # never leaves the space under the barrier
+        simulator = GateSimulator(parkingDb, arrivalRate=60, sensorTrace=blocking, seed=5)
+        simulator.maxCloseAttempts = 3
+        report = simulator.run(cars=5)
+        self.assertEqual(report.cars["stuck"], 5)
+        self.assertEqual((report.cars["entered"], report.cars["exited"], report.peakOccupancy), (0, 0, 0))
+        self.assertEqual(parkingDb.getTableLength(), 0)
+
+class TestMetrics(unittest.TestCase):
+    def testExpositionFormatAndNoOpSwitch(self):
+        registry = MetricsRegistry()
+        requests = registry.counter("requests_total", "Requests", ("path",))
+        latency = registry.histogram("latency_seconds", "Latency", ("stage",), buckets=(0.1, 1.0))
+        requests.inc('/"stats"')
+        latency.observe(0.05, "ocr")
+        latency.observe(0.5, "ocr")
+        with latency.time("filter"):
+            pass
+        registry.setEnabled(False)
+        requests.inc('/"stats"')
+        latency.observe(5.0, "ocr")
+        lines = registry.exposition().splitlines()
+        self.assertIn('requests_total{path="/\\"stats\\""} 1', lines)
+        self.assertIn('latency_seconds_bucket{stage="ocr",le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{stage="ocr",le="+Inf"} 2', lines)
+        self.assertIn('latency_seconds_sum{stage="ocr"} 0.55', lines)
+        self.assertIn('latency_seconds_count{stage="filter"} 1', lines)
+        self.assertIn('# TYPE latency_seconds histogram', lines)
+
+    def testDatabaseCallsAndGateDecisionsAreRecorded(self):
+        dbCalls = metrics.histogram("parking_db_call_seconds", "")
+        decisions = metrics.counter("gate_decisions_total", "")
+        callsBefore = dbCalls.getCount("addCarEntryRecord")
+        deniedBefore = decisions.get("Exit", "denied")
+        parkingDb = ParkingDB("sqlite://")
+        parkingDb.addCarEntryRecord('PO 156VN')
+        parkingDb.addCarEntryRecord('WY 8686W')
+        self.assertEqual(dbCalls.getCount("addCarEntryRecord"), callsBefore + 2)
+        gate = GateController(GateType.Exit, None, TollBarManager(), parkingDb)
+        gate.vehiclePlateNumber = 'PO 156VN'
+        self.assertFalse(gate.isPassageAllowed())
+        self.assertEqual(decisions.get("Exit", "denied"), deniedBefore + 1)
+
+    def testMetricsEndpointAndDumpFile(self):
+        response = Main.app.test_client().get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain; version=0.0.4"))
+        self.assertIn("# TYPE parking_db_call_seconds histogram", response.get_data(as_text=True))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "metrics_test.prom")
+            metrics.startDumping(path, interval=60)
+            metrics.stopDumping() # dumps once more when stopped
+            with open(path) as dumpFile:
+                self.assertIn("# TYPE gate_decisions_total counter", dumpFile.read())
+            self.assertEqual(os.listdir(directory), ["metrics_test.prom"])
+
+
+class TestOcrWorkerPool(unittest.TestCase):
+    def testCropsAreReadInWorkerProcesses(self):
+        image = np.random.default_rng(0).integers(0, 256, (480, 640), dtype=np.uint8)
+        crops = [image[50:150, 20:400], image[200:260, 100:300], image[::2, ::3]] # views, not contiguous
+        with OcrWorkerPool(['en'], workers=2, readerFactory=SimulatedOcrReader) as pool:
+            futures = [pool.submit(crop) for crop in crops]
+            self.assertEqual([future.result(10)[0][1] for future in futures], [simulatedPlateText(crop) for crop in crops])
+            workerPids = pool.getStats()["workerPids"]
+            self.assertEqual(len(set(workerPids)), 2)
+            self.assertNotIn(os.getpid(), workerPids)
+            cameraManager = CameraManager(['en'], ocrCache=StaticOcrCache(), ocrPool=pool)
+            self.assertEqual(cameraManager.readPlateNumbers([crops[0], None, crops[1]]),
+                             [simulatedPlateText(crops[0]), None, simulatedPlateText(crops[1])])
+        self.assertRaises(OcrUnavailable, pool.submit, crops[0])
+
+    def testGateReadOvertakesArchiveBatch(self):
+        crops = [np.full((60, 240), value, dtype=np.uint8) for value in range(12)]
+        with OcrWorkerPool(['en'], workers=1, maxQueueSize=8, readerFactory=functools.partial(SimulatedOcrReader, cpuTime=0.05)) as pool:
+            cameraManager = CameraManager(['en'], ocrCache=StaticOcrCache(), ocrPool=pool)
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                batch = executor.submit(cameraManager.readPlateNumbers, crops)
+                deadline = time.monotonic() + 10
+                while pool.getStats()["queued"] < 6 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual(pool.getStats()["queued"], 6) # the batch leaves the 2 places reserved for the gates
+                gateRead = pool.readtext(crops[0], OcrPriority.EntranceGate, timeout=10)
+                self.assertEqual(gateRead[0][1], simulatedPlateText(crops[0]))
+                self.assertFalse(batch.done()) # served before the archive reads queued earlier
+                self.assertEqual(batch.result(10), [simulatedPlateText(crop) for crop in crops])
+
+    def testExitGateOvertakesArchiveAndQueueIsBounded(self):
+        crop = np.zeros((60, 240), dtype=np.uint8)
+        with OcrWorkerPool(['en'], workers=1, maxQueueSize=8, readerFactory=functools.partial(SimulatedOcrReader, cpuTime=0.05)) as pool:
+            order = []
+            archived = 0
+            with self.assertRaises(OcrUnavailable):
+                for _ in range(10):
+                    pool.submit(crop, OcrPriority.Archive).add_done_callback(lambda future: order.append("archive"))
+                    archived += 1
+            self.assertLessEqual(archived, 7) # 6 queued and one being read, 2 places are left for the gates
+            exitRead = pool.submit(crop, OcrPriority.ExitGate)
+            exitRead.add_done_callback(lambda future: order.append("exit"))
+            exitRead.result(10)
+            self.assertLessEqual(order.index("exit"), 1)
+            self.assertEqual(pool.getStats()["rejected"], 1)
+
+    def testGateFallsBackWhenPoolTimesOut(self):
+        crop = np.full((60, 240), 7, dtype=np.uint8)
+        with OcrWorkerPool(['en'], workers=1, readerFactory=functools.partial(SimulatedOcrReader, cpuTime=0.5)) as pool:
+            archiveRead = pool.submit(crop, OcrPriority.Archive) # keeps the only worker busy
+            cameraManager = CameraManager(['en'], ocrCache=StaticOcrCache(), ocrPool=pool)
+            cameraManager.ocrTimeout = 0.1
+            self.assertEqual(cameraManager.readPlateNumber(crop), simulatedPlateText(crop)) # read locally
+            cameraManager.ocrFallback = OcrFallback.Manual
+            self.assertIsNone(cameraManager.readPlateNumber(crop))
+            self.assertEqual(archiveRead.result(10)[0][1], simulatedPlateText(crop))
+            self.assertEqual(pool.getStats()["timeout"], 2)
+
+
+class TestBenchmarkSuite(unittest.TestCase):
+    def testSlowerResultsAreReportedAsRegressions(self):
+        baseline = {"db isCarParked": {"value": 0.001, "unit": "s", "higherIsBetter": False},
+                    "GET /": {"value": 1000.0, "unit": "requests/s", "higherIsBetter": True},
+                    "GET /stats": {"value": 500.0, "unit": "requests/s", "higherIsBetter": True},
+                    "plate OCR": {"value": 0.2, "unit": "s", "higherIsBetter": False}}
+        current = {"db isCarParked": {"value": 0.0015, "unit": "s", "higherIsBetter": False},
+                   "GET /": {"value": 1100.0, "unit": "requests/s", "higherIsBetter": True},
+                   "GET /stats": {"value": 300.0, "unit": "requests/s", "higherIsBetter": True},
+                   "plate localization": {"value": 0.05, "unit": "s", "higherIsBetter": False}}
+        regressions = ParkingSystemBenchmark.compareWithBaseline(current, baseline, tolerance=0.25)
+        self.assertEqual([name for name, *_ in regressions], ["db isCarParked", "GET /stats"])
+
+    def testDatabaseOperationsAreRecorded(self):
+        ParkingSystemBenchmark.results.clear()
+        ParkingSystemBenchmark.benchmarkDatabaseOperations(ParkingDB("sqlite://"), tableSizes=(100,), cars=3)
+        self.assertEqual(ParkingSystemBenchmark.results["db wasFeePaid, 100 rows"]["samples"], 3)
+        self.assertEqual(len(ParkingSystemBenchmark.results), 10)
+
+
+class TestStartup(unittest.TestCase):
+    def testWebAppDoesNotLoadVisionLibraries(self):
+        code = "import sys, Main\nprint([m for m in ('cv2', 'imutils', 'easyocr', 'torch', 'matplotlib') if m in sys.modules])"
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.splitlines()[-1], "[]")
+
+    def testGateStartupDefersOcrImport(self):
+        code = "import sys, AutomatedParkingSystem\nAutomatedParkingSystem.AutomatedParkingSystem()\nprint('easyocr' in sys.modules)"
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.splitlines()[-1], "False")
+
 
 class TestAutomatedParkingSystem(unittest.TestCase):
     def testCarEntersParkingLotScenario(self):
@@ -0,0 +1,175 @@
+from DataBaseManager import Payment
+from sqlalchemy import select, literal, String
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime
+from enum import Enum
+from abc import ABC, abstractmethod
+import threading
+import random
+import uuid
+import time
+
+class PaymentMethod(Enum):
+    Card = 'card'
+    Cash = 'cash'
+
+class PaymentStatus(Enum):
+    Pending = 'Pending' # claimed, the terminal has not answered yet
+    Approved = 'Approved'
+    Declined = 'Declined'
+
+class PaymentOutcome(Enum):
+    Approved = 0
+    Declined = 1
+    AlreadyPaid = 2
+    InProgress = 3 # another pay station is paying this session right now
+    NotEnded = 4 # parking has not been ended, the fee is unknown
+    NoSession = 5
+
+
+class TerminalResult:
+    def __init__(self, approved, reference=None, message=None) -> None:
+        self.approved = approved
+        self.reference = reference
+        self.message = message
+
+
+class PaymentTerminal(ABC):
+    # Interface of a card terminal / cash machine. charge() must be idempotent for the same key: a repeated
+    # call returns the result of the first charge instead of charging again, as payment acquirers do.
+    @abstractmethod
+    def charge(self, amount, method, idempotencyKey):
+        # returns a TerminalResult
+        pass
+
+
+class SimulatedPaymentTerminal(PaymentTerminal):
+    # local terminal for tests and development, declines a random declineRate part of the charges
+    def __init__(self, latency=0.0, declineRate=0.0, seed=None) -> None:
+        self.latency = latency # time in sec of one charge
+        self.declineRate = declineRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.results = {}
+        self.charges = [] # (idempotency key, amount) of every approved charge, money actually taken
+
+    def charge(self, amount, method, idempotencyKey):
+        time.sleep(self.latency)
+        with self.lock:
+            result = self.results.get(idempotencyKey)
+            if result is None:
+                if self.random.random() < self.declineRate:
+                    result = TerminalResult(False, message="declined")
+                else:
+                    result = TerminalResult(True, reference=f"SIM-{len(self.results) + 1:08d}")
+                    self.charges.append((idempotencyKey, amount))
+                self.results[idempotencyKey] = result
+            return result
+
+
+class PaymentResult:
+    def __init__(self, outcome, amount=None, idempotencyKey=None, reference=None) -> None:
+        self.outcome = outcome
+        self.amount = amount
+        self.idempotencyKey = idempotencyKey
+        self.reference = reference
+
+    def __repr__(self):
+        return "<PaymentResult(outcome={0}, amount={1}, idempotencyKey={2}, reference={3})>".format(
+            self.outcome.name, self.amount, self.idempotencyKey, self.reference)
+
+
+class PaymentManager:
+    # Pay station side of the parking lot. A payment is claimed, charged and settled:
+    #  1. claim: one transaction locks the open session, checks it is not paid and inserts a Pending row into
+    #     Payments; the unique idempotency key and the one-active-payment-per-session index reject duplicates,
+    #  2. charge: the terminal is called outside of any transaction with the same idempotency key,
+    #  3. settle: compare-and-set UPDATEs move the payment out of Pending and the session to IsPaid.
+    # Retrying pay() with the same key after a crash or a timeout resumes the payment without charging twice.
+    def __init__(self, parkingDb, terminal=None, clock=datetime.now) -> None:
+        self.parkingDb = parkingDb
+        self.terminal = terminal if terminal is not None else SimulatedPaymentTerminal()
+        self.clock = clock # datetime of the payment records
+        self.paymentsTable = Payment.__table__
+
+    def newIdempotencyKey(self):
+        return uuid.uuid4().hex
+
+    def pay(self, registration, method=PaymentMethod.Card, idempotencyKey=None):
+        idempotencyKey = idempotencyKey or self.newIdempotencyKey()
+        try:
+            result = self._claim(registration, method, idempotencyKey)
+        except IntegrityError:
+            # a concurrent claim of the same key or of the same session won
+            result = self._findPayment(idempotencyKey)
+            if result is None:
+                return PaymentResult(PaymentOutcome.InProgress, idempotencyKey=idempotencyKey)
+        if isinstance(result, PaymentResult):
+            return result
+        return self._chargeAndSettle(result)
+
+    def _findPayment(self, idempotencyKey):
+        columns = self.paymentsTable.columns
+        mapper_stmt = select(columns.ID, columns.Idempotency_key, columns.Session_ID, columns.Registration_number,
+                             columns.Amount, columns.Method, columns.Status, columns.Terminal_reference).\
+                where(columns.Idempotency_key == idempotencyKey)
+        payment = self.parkingDb.engine.execute(mapper_stmt).fetchone()
+        if payment is None:
+            return None
+        if payment.Status == PaymentStatus.Pending.value:
+            return payment
+        # settled before, report the first attempt
+        outcome = PaymentOutcome.Approved if payment.Status == PaymentStatus.Approved.value else PaymentOutcome.Declined
+        return PaymentResult(outcome, payment.Amount, idempotencyKey, payment.Terminal_reference)
+
+    def _claim(self, registration, method, idempotencyKey):
+        # returns the Pending payment row to charge, or the PaymentResult when there is nothing to charge
+        payment = self._findPayment(idempotencyKey)
+        if payment is not None:
+            return payment # retried key
+        columns = self.parkingDb.Parking_lot_table.columns
+        with self.parkingDb.engine.begin() as connection:
+            # row lock on PostgreSQL; SQLite serializes writers and the unique index guards the claim on both
+            session = connection.execute(select(columns.ID, columns.End_time, columns.Fee, columns.IsPaid).
+                                         where(columns.Registration_number == literal(registration, String)).
+                                         where(columns.Exit_time == None).
+                                         with_for_update()).fetchone()
+            if session is None:
+                return PaymentResult(PaymentOutcome.NoSession, idempotencyKey=idempotencyKey)
+            if session.IsPaid:
+                return PaymentResult(PaymentOutcome.AlreadyPaid, session.Fee, idempotencyKey)
+            if session.End_time is None:
+                return PaymentResult(PaymentOutcome.NotEnded, idempotencyKey=idempotencyKey)
+            connection.execute(self.paymentsTable.insert().values(
+                    Idempotency_key=idempotencyKey, Session_ID=session.ID, Registration_number=registration,
+                    Amount=session.Fee, Method=method.value, Status=PaymentStatus.Pending.value,
+                    Created_time=self.clock().replace(microsecond=0)))
+        return self._findPayment(idempotencyKey)
+
+    def _chargeAndSettle(self, payment):
+        idempotencyKey = payment.Idempotency_key
+        if payment.Amount:
+            terminalResult = self.terminal.charge(payment.Amount, PaymentMethod(payment.Method), idempotencyKey)
+        else:
+            terminalResult = TerminalResult(True, message="nothing to pay") # grace period or monthly pass
+        settled = self.parkingDb.settlePayment(payment.ID, payment.Session_ID, payment.Registration_number, terminalResult.approved,
+                                               terminalResult.reference, self.clock().replace(microsecond=0))
+        if not settled:
+            # a retry of the same key settled it first
+            return self._findPayment(idempotencyKey)
+        return PaymentResult(PaymentOutcome.Approved if terminalResult.approved else PaymentOutcome.Declined,
+                             payment.Amount, idempotencyKey, terminalResult.reference)
+
+    def resumePendingPayments(self):
+        # settles payments left Pending by a crashed pay station, the terminal returns the result of the first charge
+        columns = self.paymentsTable.columns
+        mapper_stmt = select(columns.Idempotency_key).where(columns.Status == PaymentStatus.Pending.value)
+        return [self.pay(None, idempotencyKey=idempotencyKey)
+                for idempotencyKey, in self.parkingDb.engine.execute(mapper_stmt).fetchall()]
+
+    def getPayments(self, registration):
+        columns = self.paymentsTable.columns
+        mapper_stmt = select(self.paymentsTable).\
+                where(columns.Registration_number == registration).\
+                order_by(columns.ID)
+        return self.parkingDb.engine.execute(mapper_stmt).fetchall()
@@ -0,0 +1,72 @@
+from collections import OrderedDict
+import threading
+import time
+import cv2
+import numpy as np
+
+def plateImageHash(plateImage):
+    # difference hash: 64 bits telling whether each pixel of an 9x8 thumbnail is brighter than its right neighbour
+    if plateImage.ndim == 3:
+        plateImage = cv2.cvtColor(plateImage, cv2.COLOR_BGR2GRAY)
+    thumbnail = cv2.resize(plateImage, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = thumbnail[:, 1:] > thumbnail[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hammingDistance(firstHash, secondHash):
+    return bin(firstHash ^ secondHash).count('1')
+
+
+class PlateReadCache:
+    # Remembers recent plate reads of one gate. A car idling in front of the barrier produces nearly the
+    # same plate crop on every loop iteration, so its plate is reused instead of running OCR again.
+    def __init__(self, maxSize=16, ttl=10.0, maxHashDistance=6, clock=time.monotonic) -> None:
+        self.entries = OrderedDict() # plate hash -> (plate number, time of read, confidence of the read)
+        self.maxSize = maxSize
+        self.ttl = ttl # time in sec
+        self.maxHashDistance = maxHashDistance # bits that may differ between crops of the same plate
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _evictExpired(self, now):
+        for plateHash in [plateHash for plateHash, (_, readTime, _) in self.entries.items() if now - readTime > self.ttl]:
+            del self.entries[plateHash]
+            self.evictions += 1
+
+    def lookup(self, plateImage):
+        return self.lookupWithConfidence(plateImage)[0]
+
+    def lookupWithConfidence(self, plateImage):
+        # (plate number, confidence), (None, None) on a miss
+        plateHash = plateImageHash(plateImage)
+        with self.lock:
+            now = self.clock()
+            self._evictExpired(now)
+            for cachedHash, (plateNumber, _, confidence) in self.entries.items():
+                if hammingDistance(plateHash, cachedHash) <= self.maxHashDistance:
+                    self.entries.move_to_end(cachedHash)
+                    self.hits += 1
+                    return plateNumber, confidence
+            self.misses += 1
+            return None, None
+
+    def store(self, plateImage, plateNumber, confidence=None):
+        if plateNumber is None:
+            return
+        plateHash = plateImageHash(plateImage)
+        with self.lock:
+            self.entries[plateHash] = (plateNumber, self.clock(), confidence)
+            self.entries.move_to_end(plateHash)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def getStats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self.entries)}
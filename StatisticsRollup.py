@@ -0,0 +1,224 @@
+from DataBaseManager import ParkingEventType, StatisticsGranularity
+from sqlalchemy import select, func, literal, union_all, and_
+from sqlalchemy.dialects import postgresql, sqlite
+from datetime import timedelta
+import threading
+import atexit
+
+class PeriodStats:
+    # change of one hourly or daily row, added to the row when flushed
+    def __init__(self) -> None:
+        self.entries = 0
+        self.exits = 0
+        self.peakOccupancy = 0
+        self.revenue = 0.0
+        self.durationTotal = 0.0
+        self.endedSessions = 0
+
+    def toRow(self, periodStart):
+        return {"Period_start": periodStart, "Entries": self.entries, "Exits": self.exits,
+                "Peak_occupancy": self.peakOccupancy, "Revenue": self.revenue,
+                "Duration_total": self.durationTotal, "Ended_sessions": self.endedSessions}
+
+
+class StatisticsRollup:
+    # Maintains the hourly and daily summary tables. Gate events are added up in memory and written every
+    # flushInterval with one upsert per table; backfill() recomputes the summaries from the Parking_lot rows.
+    # Revenue and parking duration are counted in the period in which parking ended (fee computed), a fee
+    # recalculated later (ParkingDB.recalculateFees, updateFee) corrects that period; a recalculation run by
+    # another process is not seen, backfill() the range afterwards.
+    # Peak occupancy is read from Parking_lot when the periods are written, the gates of other processes
+    # park cars too and an occupancy counted from the events of this process would drift.
+    def __init__(self, parkingDb, flushInterval=10.0) -> None:
+        self.parkingDb = parkingDb
+        self.flushInterval = flushInterval # time in sec
+        self.lock = threading.Lock()
+        self.pendingStats = {granularity: {} for granularity in StatisticsGranularity}
+        self.stopEvent = threading.Event()
+        self.parkingDb.addEventListener(self.onDatabaseEvent)
+        self.flusherThread = threading.Thread(target=self._runFlusher, name="statistics-rollup", daemon=True)
+        self.flusherThread.start()
+
+    def _getPeriodStats(self, granularity, time):
+        periodStart = granularity.truncate(time)
+        periodStats = self.pendingStats[granularity].get(periodStart)
+        if periodStats is None:
+            periodStats = self.pendingStats[granularity][periodStart] = PeriodStats()
+        return periodStats
+
+    def onDatabaseEvent(self, eventType, registration, eventTime, **details):
+        if eventType == ParkingEventType.Payment:
+            return
+        with self.lock:
+            for granularity in StatisticsGranularity:
+                periodStats = self._getPeriodStats(granularity, eventTime)
+                if eventType == ParkingEventType.Entry:
+                    periodStats.entries += 1
+                elif eventType == ParkingEventType.Exit:
+                    periodStats.exits += 1
+                elif eventType == ParkingEventType.End:
+                    periodStats.revenue += details["fee"]
+                    periodStats.durationTotal += details["minutes"]
+                    periodStats.endedSessions += 1
+                else:
+                    # fee recalculated, the period of the end of parking gets the difference
+                    periodStats.revenue += details["fee"] - (details["previousFee"] or 0.0)
+                    periodStats.durationTotal += details["minutes"] - (details["previousMinutes"] or 0)
+
+    def _selectGateEvents(self, connection, start, end):
+        # (occupancy at start, entry and exit counts per event time in [start, end) in time order)
+        columns = self.parkingDb.Parking_lot_table.columns
+
+        def inRange(column):
+            conditions = [column != None]
+            if start is not None:
+                conditions.append(column >= start)
+            if end is not None:
+                conditions.append(column < end)
+            return and_(*conditions)
+
+        occupancy = 0
+        if start is not None:
+            occupancy = connection.execute(select(func.count(columns.ID)).
+                                           where(columns.Entrance_time < start).
+                                           where((columns.Exit_time == None) | (columns.Exit_time >= start))).scalar()
+        # entries and exits in time order, the database sorts them
+        entries = select(columns.Entrance_time.label("Event_time"), literal(1).label("Entries"), literal(0).label("Exits")).\
+                where(inRange(columns.Entrance_time))
+        exits = select(columns.Exit_time.label("Event_time"), literal(0).label("Entries"), literal(1).label("Exits")).\
+                where(inRange(columns.Exit_time))
+        gateEvents = union_all(entries, exits).subquery()
+        mapper_stmt = select(gateEvents.c.Event_time, func.sum(gateEvents.c.Entries), func.sum(gateEvents.c.Exits)).\
+                group_by(gateEvents.c.Event_time).\
+                order_by(gateEvents.c.Event_time)
+        return occupancy, connection.execute(mapper_stmt)
+
+    def _setPeakOccupancies(self, connection, periods):
+        # peak occupancy of the given hourly periods and of the days they belong to, counted from Parking_lot;
+        # an hour without gate events keeps the occupancy it started with
+        hours = sorted(periods[StatisticsGranularity.Hour])
+        if not hours:
+            return
+        occupancy, gateEvents = self._selectGateEvents(connection, hours[0], hours[-1] + timedelta(hours=1))
+        gateEvent = next(gateEvents, None)
+        for hour in hours:
+            while gateEvent is not None and gateEvent[0] < hour:
+                occupancy += gateEvent[1] - gateEvent[2]
+                gateEvent = next(gateEvents, None)
+            peakOccupancy = occupancy
+            while gateEvent is not None and gateEvent[0] < hour + timedelta(hours=1):
+                occupancy += gateEvent[1] - gateEvent[2]
+                peakOccupancy = max(peakOccupancy, occupancy)
+                gateEvent = next(gateEvents, None)
+            for granularity in StatisticsGranularity:
+                periodStats = periods[granularity][granularity.truncate(hour)]
+                periodStats.peakOccupancy = max(periodStats.peakOccupancy, peakOccupancy)
+        gateEvents.close()
+
+    def _upsert(self, connection, table, rows):
+        # INSERT ... ON CONFLICT (Period_start) DO UPDATE adding the counters to the stored row
+        dialect = postgresql if self.parkingDb.engine.dialect.name == "postgresql" else sqlite
+        greatest = func.greatest if dialect is postgresql else func.max
+        stmt = dialect.insert(table)
+        columns = table.columns
+        stmt = stmt.on_conflict_do_update(index_elements=[columns.Period_start], set_={
+            "Entries": columns.Entries + stmt.excluded.Entries,
+            "Exits": columns.Exits + stmt.excluded.Exits,
+            "Peak_occupancy": greatest(columns.Peak_occupancy, stmt.excluded.Peak_occupancy),
+            "Revenue": columns.Revenue + stmt.excluded.Revenue,
+            "Duration_total": columns.Duration_total + stmt.excluded.Duration_total,
+            "Ended_sessions": columns.Ended_sessions + stmt.excluded.Ended_sessions})
+        connection.execute(stmt, rows)
+
+    def flush(self):
+        with self.lock:
+            pendingStats = self.pendingStats
+            self.pendingStats = {granularity: {} for granularity in StatisticsGranularity}
+        if not any(pendingStats.values()):
+            return
+        with self.parkingDb.engine.begin() as connection:
+            self._setPeakOccupancies(connection, pendingStats)
+            for granularity, periods in pendingStats.items():
+                if periods:
+                    self._upsert(connection, granularity.table,
+                                 [periodStats.toRow(periodStart) for periodStart, periodStats in periods.items()])
+
+    def _runFlusher(self):
+        while not self.stopEvent.wait(self.flushInterval):
+            try:
+                self.flush()
+            except Exception as error:
+                print(f"Could not write statistics: {error!r}")
+
+    def close(self):
+        self.stopEvent.set()
+        self.parkingDb.removeEventListener(self.onDatabaseEvent)
+        self.flusherThread.join()
+        self.flush()
+
+    def backfill(self, start=None, end=None):
+        # Recomputes the summaries of the periods in [start, end) from Parking_lot, e.g. after enabling the
+        # rollup on an existing database. start and end are rounded down to whole days. Events of the range
+        # arriving while it runs may be counted twice, run it for past days or while the gates are stopped.
+        start = StatisticsGranularity.Day.truncate(start) if start is not None else None
+        end = StatisticsGranularity.Day.truncate(end) if end is not None else None
+        self.flush()
+        columns = self.parkingDb.Parking_lot_table.columns
+
+        def inRange(column):
+            conditions = [column != None]
+            if start is not None:
+                conditions.append(column >= start)
+            if end is not None:
+                conditions.append(column < end)
+            return and_(*conditions)
+
+        periods = {granularity: {} for granularity in StatisticsGranularity}
+        def getPeriodStats(granularity, time):
+            periodStart = granularity.truncate(time)
+            periodStats = periods[granularity].get(periodStart)
+            if periodStats is None:
+                periodStats = periods[granularity][periodStart] = PeriodStats()
+            return periodStats
+
+        with self.parkingDb.engine.connect() as connection:
+            connection = connection.execution_options(stream_results=True)
+            _, gateEvents = self._selectGateEvents(connection, start, end)
+            for eventTime, entryCount, exitCount in gateEvents:
+                for granularity in StatisticsGranularity:
+                    periodStats = getPeriodStats(granularity, eventTime)
+                    periodStats.entries += entryCount
+                    periodStats.exits += exitCount
+
+            mapper_stmt = select(columns.End_time, func.sum(columns.Fee), func.sum(columns.Parking_duration), func.count(columns.ID)).\
+                    where(inRange(columns.End_time)).\
+                    group_by(columns.End_time)
+            for endTime, revenue, durationTotal, endedSessions in connection.execute(mapper_stmt):
+                for granularity in StatisticsGranularity:
+                    periodStats = getPeriodStats(granularity, endTime)
+                    periodStats.revenue += revenue or 0.0
+                    periodStats.durationTotal += durationTotal or 0.0
+                    periodStats.endedSessions += endedSessions
+            self._setPeakOccupancies(connection, periods)
+
+        with self.parkingDb.engine.begin() as connection:
+            for granularity in StatisticsGranularity:
+                table = granularity.table
+                connection.execute(table.delete().where(inRange(table.columns.Period_start)))
+                rows = [periodStats.toRow(periodStart) for periodStart, periodStats in periods[granularity].items()]
+                if rows:
+                    connection.execute(table.insert(), rows)
+
+
+shared_statistics_rollups = {}
+shared_statistics_rollups_lock = threading.Lock()
+
+def getSharedStatisticsRollup(parkingDb):
+    # one rollup per ParkingDB, fed by the gate events of the process
+    with shared_statistics_rollups_lock:
+        statisticsRollup = shared_statistics_rollups.get(parkingDb)
+        if statisticsRollup is None:
+            statisticsRollup = StatisticsRollup(parkingDb)
+            atexit.register(statisticsRollup.close)
+            shared_statistics_rollups[parkingDb] = statisticsRollup
+        return statisticsRollup
@@ -0,0 +1,95 @@
+from datetime import datetime, time, timedelta
+import math
+
+microseconds_per_hour = 3_600_000_000
+microseconds_per_day = 24 * microseconds_per_hour
+
+def roundFee(fee):
+    # round half up to whole cents, written so np.floor gives the same result for arrays
+    return math.floor(fee * 100 + 0.5) / 100
+
+def toMicroseconds(times):
+    import numpy as np
+    return np.array(times, dtype="datetime64[us]").astype(np.int64)
+
+
+class TariffBand:
+    # price of parking between two full hours of every day, e.g. TariffBand(7, 19, 3.0) for the day rate
+    def __init__(self, startHour, endHour, pricePerHour) -> None:
+        if not 0 <= startHour < endHour <= 24:
+            raise ValueError(f"invalid tariff band hours {startHour}-{endHour}")
+        self.startHour = startHour
+        self.endHour = endHour
+        self.pricePerHour = float(pricePerHour)
+
+    def __repr__(self):
+        return "<TariffBand({0}-{1}, {2}/h)>".format(self.startHour, self.endHour, self.pricePerHour)
+
+
+class Tariff:
+    # Fee of a parking session: every day of the session is charged by the time spent in each band, capped
+    # at dailyCap per calendar day. Sessions up to gracePeriod minutes and cars with a monthly pass are free.
+    # calculateFee (one session) and calculateFees (NumPy arrays of sessions) do the same float operations
+    # in the same order, so both give exactly the same fees.
+    def __init__(self, bands=None, dailyCap=None, gracePeriod=0) -> None:
+        self.bands = sorted(bands, key=lambda band: band.startHour) if bands else [TariffBand(0, 24, 2.0)]
+        for previousBand, band in zip(self.bands, self.bands[1:]):
+            if band.startHour < previousBand.endHour:
+                raise ValueError(f"overlapping tariff bands {previousBand} and {band}")
+        self.dailyCap = dailyCap
+        self.gracePeriod = gracePeriod # minutes
+
+    # ---- one session ----
+    def calculateDuration(self, entranceTime, endTime):
+        # minutes
+        return ((endTime - entranceTime) // timedelta(microseconds=1)) / 60_000_000
+
+    def calculateFee(self, entranceTime, endTime, hasMonthlyPass=False):
+        durationUs = (endTime - entranceTime) // timedelta(microseconds=1)
+        if hasMonthlyPass or durationUs <= self.gracePeriod * 60_000_000:
+            return 0.0
+        fee = 0.0
+        dayStart = datetime.combine(entranceTime.date(), time())
+        while dayStart < endTime:
+            dayFee = 0.0
+            for band in self.bands:
+                bandStart = dayStart + timedelta(hours=band.startHour)
+                bandEnd = dayStart + timedelta(hours=band.endHour)
+                overlapUs = max((min(endTime, bandEnd) - max(entranceTime, bandStart)) // timedelta(microseconds=1), 0)
+                dayFee = dayFee + overlapUs * band.pricePerHour / microseconds_per_hour
+            if self.dailyCap is not None:
+                dayFee = min(dayFee, self.dailyCap)
+            fee = fee + dayFee
+            dayStart += timedelta(days=1)
+        return roundFee(fee)
+
+    # ---- many sessions at once ----
+    def calculateDurations(self, entranceTimes, endTimes):
+        return (toMicroseconds(endTimes) - toMicroseconds(entranceTimes)) / 60_000_000
+
+    def calculateFees(self, entranceTimes, endTimes, hasMonthlyPass=None):
+        # entranceTimes and endTimes are sequences of datetimes, hasMonthlyPass a sequence of bools
+        import numpy as np # batch path only, the web app and the gates never load NumPy for it
+        entranceUs = toMicroseconds(entranceTimes)
+        endUs = toMicroseconds(endTimes)
+        fees = np.zeros(len(entranceUs))
+        if len(entranceUs) == 0:
+            return fees
+        firstDayStart = entranceUs - entranceUs % microseconds_per_day
+        days = int(((endUs - firstDayStart) // microseconds_per_day).max()) + 1
+        for day in range(days):
+            dayStart = firstDayStart + day * microseconds_per_day
+            dayFees = np.zeros(len(entranceUs))
+            for band in self.bands:
+                bandStart = dayStart + band.startHour * microseconds_per_hour
+                bandEnd = dayStart + band.endHour * microseconds_per_hour
+                overlapUs = np.maximum(np.minimum(endUs, bandEnd) - np.maximum(entranceUs, bandStart), 0)
+                dayFees = dayFees + overlapUs * band.pricePerHour / microseconds_per_hour
+            if self.dailyCap is not None:
+                dayFees = np.minimum(dayFees, self.dailyCap)
+            fees = fees + dayFees
+        fees = np.floor(fees * 100 + 0.5) / 100
+        isFree = endUs - entranceUs <= self.gracePeriod * 60_000_000
+        if hasMonthlyPass is not None:
+            isFree |= np.asarray(hasMonthlyPass, dtype=bool)
+        return np.where(isFree, 0.0, fees)
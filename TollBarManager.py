@@ -7,8 +7,14 @@ try:
     import RPi.GPIO as GPIO
 except:
     import mock.GPIO as GPIO # mock gpio as it only runs on rpi
+from MetricsManager import metrics
+import asyncio
+import threading
 import time
 
+barrier_motion_seconds = metrics.histogram("barrier_motion_seconds", "Duration of barrier movements", ("direction",))
+barrier_obstructions = metrics.counter("barrier_obstructions_total", "Closing movements obstructed by a vehicle under the barrier")
+
 class SensorLocation(Enum):
     BeforeTollBar = 0
     UnderTollBar = 1
@@ -19,40 +25,69 @@ class Sensor():
         self.port = portGPIO
         self.location = location
         self.value = False
+        self.pendingValue = False # last raw reading that differs from value
+        self.pendingCount = 0 # number of consecutive raw readings equal to pendingValue
 
 class BarrierState(Enum):
     Closed = 0
     Open = 1
+    Opening = 2
+    Closing = 3
+
+class ObstructionBehaviour(Enum):
+    Pause = 0 # stop closing until the vehicle leaves, then continue (a foreground motion stops in the Open state)
+    Reverse = 1 # open the barrier again and restart the open timer
+
+class MotionProfile():
+    def __init__(self, stepDegrees=1, stepInterval=0.0) -> None:
+        self.stepDegrees = stepDegrees # servo degrees per step
+        self.stepInterval = stepInterval # time in sec between steps
 
 class Barrier():
     def __init__(self, portGPIO) -> None:
         self.port = portGPIO
         self.state = BarrierState.Closed
         self.postition = 0
+        self.targetPosition = 0
 
 class TollBarManager:
-    def __init__(self, sensorBeforeTollBarPort=17, sensorUnderTollBarPort=18, sensorBehindTollBarPort=19, barrierPort=20) -> None:
-        GPIO.setmode(GPIO.BCM)
+    def __init__(self, sensorBeforeTollBarPort=17, sensorUnderTollBarPort=18, sensorBehindTollBarPort=19, barrierPort=20,
+                 gpio=None, clock=time.perf_counter) -> None:
+        self.gpio = gpio if gpio is not None else GPIO # any object with the RPi.GPIO interface, e.g. a simulated one
+        self.clock = clock # time in sec of the barrier timer
+        self.gpio.setmode(self.gpio.BCM)
         # SETUP SENSORS
-        GPIO.setup(sensorBeforeTollBarPort, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(sensorUnderTollBarPort, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(sensorBehindTollBarPort, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(barrierPort, GPIO.OUT)
+        self.gpio.setup(sensorBeforeTollBarPort, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+        self.gpio.setup(sensorUnderTollBarPort, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+        self.gpio.setup(sensorBehindTollBarPort, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+        self.gpio.setup(barrierPort, self.gpio.OUT)
         self.sensors = [Sensor(sensorBeforeTollBarPort, SensorLocation.BeforeTollBar),
                         Sensor(sensorUnderTollBarPort, SensorLocation.UnderTollBar),
                         Sensor(sensorBehindTollBarPort, SensorLocation.BehindTollBar)]
         # SETUP BARRIER AND SERVO
         self.barrier = Barrier(barrierPort)
-        GPIO.setup(self.barrier.port, GPIO.OUT)
-        self.servo = GPIO.PWM(self.barrier.port, 50) # GPIO as PWM output, with 50Hz frequency
+        self.gpio.setup(self.barrier.port, self.gpio.OUT)
+        self.servo = self.gpio.PWM(self.barrier.port, 50) # GPIO as PWM output, with 50Hz frequency
         self.openGateTime = 7 # time in sec
         self.startTimerForBarrier = 0
         self.endTimer = 0
         self.minDuty = 5
         self.maxDuty = 10
+        self.debounceSamples = 1 # consecutive equal readings needed before a sensor changes its value
+        self.sensorPollInterval = 0.01 # time in sec between sensor reads while waiting for a vehicle under the barrier
+        self.openPosition = 90 # servo degrees
+        self.closedPosition = 0 # servo degrees
+        self.motionProfile = MotionProfile()
+        self.obstructionBehaviour = ObstructionBehaviour.Reverse
+        self.obstructionCount = 0
+        self.motionThread = None
+        self.isMotionInBackground = True # False moves the barrier inside startOpening/startClosing, e.g. in a simulation
+        self.motionStopEvent = threading.Event()
+        self.motionDone = threading.Event()
+        self.motionDone.set()
 
     def __del__(self):
-        GPIO.cleanup()
+        self.gpio.cleanup()
     
     def getSensorByLocation(self, location):
         if location == SensorLocation.BeforeTollBar:
@@ -82,32 +117,127 @@ class TollBarManager:
     
     def updateSensors(self):
         for sensor in self.sensors:
-            sensor.value = GPIO.input(sensor.port)
+            reading = self.gpio.input(sensor.port)
+            if self.debounceSamples <= 1:
+                sensor.value = reading
+                continue
+            if reading == sensor.value:
+                sensor.pendingCount = 0
+                continue
+            if reading == sensor.pendingValue and sensor.pendingCount > 0:
+                sensor.pendingCount += 1
+            else:
+                sensor.pendingValue = reading
+                sensor.pendingCount = 1
+            if sensor.pendingCount >= self.debounceSamples:
+                sensor.value = reading
+                sensor.pendingCount = 0
+
+    def enableSensorEvents(self, callback, bouncetime=50):
+        # callback(channel) is called from the GPIO thread on every edge of any sensor, bouncetime in ms
+        for sensor in self.sensors:
+            self.gpio.add_event_detect(sensor.port, self.gpio.BOTH, callback=callback, bouncetime=bouncetime)
+
+    def disableSensorEvents(self):
+        for sensor in self.sensors:
+            self.gpio.remove_event_detect(sensor.port)
     
     def deg2duty(self, deg):
         return (deg - 0) * (self.maxDuty- self.minDuty) / 180 + self.minDuty
     
-    def openBarrier(self):
-        if self.barrier.state == BarrierState.Open:
-            return
+    def _isClosingObstructed(self):
+        # fresh reading of the under-bar sensor, the motion thread must not wait for the next updateSensors
+        underTollBarSensor = self.getSensorByLocation(SensorLocation.UnderTollBar)
+        return bool(underTollBarSensor.value or self.gpio.input(underTollBarSensor.port))
+
+    def _runMotion(self, targetPosition):
+        direction = "open" if targetPosition > self.barrier.postition else "close"
+        try:
+            with barrier_motion_seconds.time(direction):
+                while not self.motionStopEvent.is_set():
+                    position = self.barrier.postition
+                    if targetPosition < position and self._isClosingObstructed():
+                        self.obstructionCount += 1
+                        barrier_obstructions.inc()
+                        if self.obstructionBehaviour == ObstructionBehaviour.Reverse:
+                            targetPosition = self.openPosition
+                            self.barrier.targetPosition = targetPosition
+                            self.barrier.state = BarrierState.Opening
+                        elif not self.isMotionInBackground:
+                            # the caller waits inside startClosing and cannot update the sensors meanwhile,
+                            # the barrier stays open and closing is retried after openGateTime
+                            break
+                        else:
+                            self.motionStopEvent.wait(self.sensorPollInterval)
+                            continue
+                    if position == targetPosition:
+                        break
+                    step = min(self.motionProfile.stepDegrees, abs(targetPosition - position))
+                    self.barrier.postition = position + step if targetPosition > position else position - step
+                    self.servo.ChangeDutyCycle(self.deg2duty(self.barrier.postition))
+                    if self.motionProfile.stepInterval > 0:
+                        self.motionStopEvent.wait(self.motionProfile.stepInterval)
+                if self.barrier.postition == self.closedPosition:
+                    self.barrier.state = BarrierState.Closed
+                    self.startTimerForBarrier = 0
+                else:
+                    # fully open, or stopped half-way which is treated as open for safety
+                    self.barrier.state = BarrierState.Open
+                    self.startTimerForBarrier = self.clock()
+        finally:
+            self.motionDone.set()
+
+    def _startMotion(self, targetPosition, movingState):
+        self.stopMotion()
+        self.barrier.state = movingState
+        self.barrier.targetPosition = targetPosition
+        self.motionStopEvent.clear()
+        self.motionDone.clear()
         self.servo.start(0)
-        for deg in range(91): # loop from 0 to 90
-            duty_cycle = self.deg2duty(deg)
-            self.servo.ChangeDutyCycle(duty_cycle)
-            self.barrier.postition = deg
-        self.barrier.state = BarrierState.Open
-        self.startTimerForBarrier = time.perf_counter()
+        if not self.isMotionInBackground:
+            self._runMotion(targetPosition)
+            return
+        self.motionThread = threading.Thread(target=self._runMotion, args=(targetPosition,), name="BarrierMotion", daemon=True)
+        self.motionThread.start()
+
+    def stopMotion(self):
+        self.motionStopEvent.set()
+        if self.motionThread is not None and self.motionThread is not threading.current_thread():
+            self.motionThread.join()
+        self.motionThread = None
+
+    def isMoving(self):
+        return not self.motionDone.is_set()
+
+    def getPosition(self):
+        return self.barrier.postition
+
+    def waitForMotion(self, timeout=None):
+        return self.motionDone.wait(timeout)
+
+    async def waitForMotionAsync(self, pollInterval=0.01):
+        while self.isMoving():
+            await asyncio.sleep(pollInterval)
+
+    def startOpening(self):
+        # starts moving the barrier up in the background, also reverses a barrier that is closing
+        if self.barrier.state in (BarrierState.Open, BarrierState.Opening):
+            return
+        self._startMotion(self.openPosition, BarrierState.Opening)
+
+    def startClosing(self):
+        # starts moving the barrier down in the background once it was open for openGateTime
+        if self.barrier.state != BarrierState.Open:
+            return False
+        if self.clock() - self.startTimerForBarrier < self.openGateTime:
+            return False
+        self._startMotion(self.closedPosition, BarrierState.Closing)
+        return True
+    
+    def openBarrier(self):
+        self.startOpening()
+        self.waitForMotion()
     
     def closeBarrier(self):
-        if self.barrier.state == BarrierState.Closed:
-            return
-        if time.perf_counter() - self.startTimerForBarrier >= self.openGateTime:
-            self.servo.start(0)
-            for deg in range(91): # loop from 90 to 0
-                while self.isVehicleUnderTollBar(): # prevent from closing if vehicle under barrier
-                    self.updateSensors()
-                duty_cycle = self.deg2duty(deg)
-                self.servo.ChangeDutyCycle(-duty_cycle)
-                self.barrier.postition = 90 - deg
-            self.barrier.state = BarrierState.Closed
-            self.startTimerForBarrier = 0
+        if self.startClosing():
+            self.waitForMotion()